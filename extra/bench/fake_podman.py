@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+A fake podman for launch benchmarks.
+
+    FAKE_PODMAN_STATE=DIR [FAKE_PODMAN_CONFIG=FILE] fake_podman.py ARGS...
+
+It models the container lifecycle that shared-run drives (run -d,
+container exists, wait --condition running, exec, kill, rm) with
+configurable latencies and a global storage lock, like the lock
+rootless podman takes on its storage for most commands.  Containers are
+files in $FAKE_PODMAN_STATE/containers and every invocation appends a
+JSON line (command, start, end, time spent waiting for the lock) to
+$FAKE_PODMAN_STATE/invocations.jsonl.
+
+FAKE_PODMAN_CONFIG is a JSON file that overrides entries of LATENCY:
+"startup" is paid by every invocation, "<command>" outside the lock and
+"<command>_locked" while holding the storage lock.  "exec_run": false
+skips running the command of exec on the host.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import subprocess
+
+LATENCY = {
+    "startup": 0.03,
+    "run": 0.25, "run_locked": 0.1,
+    "exists_locked": 0.005,
+    "wait_poll": 0.05,
+    "exec": 0.05, "exec_locked": 0.01,
+    "kill": 0.05, "kill_locked": 0.01,
+    "rm": 0.05, "rm_locked": 0.05,
+    "help": 0.02,
+    "exec_run": True,
+}
+COMMANDS = ["run", "exec", "container", "wait", "kill", "rm"]
+# The help texts shared-run parses to filter its options
+HELP_DIR = os.environ.get(
+    "FAKE_PODMAN_HELP_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..",
+                 "test", "mock_bin"))
+
+
+class FakePodman:
+    def __init__(self, state, conf):
+        self.state = state
+        self.conf = conf
+        self.cdir = os.path.join(state, "containers")
+        os.makedirs(self.cdir, exist_ok=True)
+        self.lock_wait = 0.0
+        self.cmd_start = None
+
+    def locked(self, op, func=None):
+        """
+        Hold the storage lock for the locked latency of op and call func
+        under it.  Returns what func returns or the container names.
+        """
+        start = time.time()
+        with open(os.path.join(self.state, "storage.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.lock_wait += time.time() - start
+            time.sleep(self.conf.get(f"{op}_locked", 0))
+            return func() if func else self._read_all()
+
+    def _read_all(self):
+        return set(os.listdir(self.cdir))
+
+    def _cfile(self, name):
+        return os.path.join(self.cdir, name)
+
+    def _status(self, name):
+        try:
+            with open(self._cfile(name)) as f:
+                return json.load(f)["status"]
+        except (OSError, ValueError):
+            return None
+
+    def _set_status(self, name, status):
+        tmp = f"{self._cfile(name)}.{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump({"status": status, "time": time.time()}, f)
+        os.rename(tmp, self._cfile(name))
+
+    def run(self, args):
+        name = args[args.index("--name") + 1] if "--name" in args \
+            else f"c{os.getpid()}"
+
+        def create():
+            if os.path.exists(self._cfile(name)):
+                return False
+            self._set_status(name, "created")
+            return True
+
+        if not self.locked("run", create):
+            sys.stderr.write(f"Error: the container name \"{name}\" is "
+                             "already in use\n")
+            return 125
+        # Mounting the rootfs, the hooks and starting the runtime
+        time.sleep(self.conf.get("run", 0))
+        self._set_status(name, "running")
+        print(name)
+        return 0
+
+    def container(self, args):
+        if args[:1] != ["exists"]:
+            return 125
+        names = self.locked("exists")
+        return 0 if args[-1] in names else 1
+
+    def wait(self, args):
+        name = args[-1]
+        while True:
+            status = self._status(name)
+            if status is None:
+                sys.stderr.write(f"Error: no container with name {name}\n")
+                return 125
+            if status == "running" or "--condition" not in args:
+                return 0
+            time.sleep(self.conf.get("wait_poll", 0.05))
+
+    def exec(self, args):
+        names = self.locked("exec")
+        # The container name is the first argument naming a container
+        idx = next((i for i, a in enumerate(args) if a in names), None)
+        if idx is None or self._status(args[idx]) != "running":
+            sys.stderr.write("Error: no running container\n")
+            return 125
+        time.sleep(self.conf.get("exec", 0))
+        # The rank is running from here on
+        self.cmd_start = time.time()
+        cmd = args[idx + 1:]
+        if cmd and self.conf.get("exec_run", True):
+            return subprocess.call(cmd)
+        return 0
+
+    def kill(self, args):
+        self.locked("kill")
+        if self._status(args[-1]) is None:
+            return 125
+        time.sleep(self.conf.get("kill", 0))
+        self._set_status(args[-1], "exited")
+        return 0
+
+    def rm(self, args):
+        self.locked("rm")
+        time.sleep(self.conf.get("rm", 0))
+        try:
+            os.remove(self._cfile(args[-1]))
+        except OSError:
+            return 1
+        return 0
+
+
+def main(argv):
+    state = os.environ["FAKE_PODMAN_STATE"]
+    conf = dict(LATENCY)
+    if os.environ.get("FAKE_PODMAN_CONFIG"):
+        with open(os.environ["FAKE_PODMAN_CONFIG"]) as f:
+            conf.update(json.load(f))
+    start = time.time()
+    time.sleep(conf["startup"])
+    cmd = next((a for a in argv if a in COMMANDS), None)
+    args = argv[argv.index(cmd) + 1:] if cmd else []
+    podman = FakePodman(state, conf)
+    # podman-hpc runs podman --help for its own help epilog
+    is_help = args[:1] == ["--help"] or (not cmd and "--help" in argv)
+    if is_help:
+        time.sleep(conf["help"])
+        help_file = os.path.join(HELP_DIR, f"{cmd or 'podman'}_help.txt")
+        try:
+            with open(help_file) as f:
+                sys.stdout.write(f.read())
+        except OSError:
+            pass
+        ret = 0
+    elif cmd:
+        ret = getattr(podman, cmd)(args)
+    else:
+        ret = 0
+    rec = {"command": cmd, "sub": args[0] if cmd == "container" and args
+           else None, "help": is_help, "ret": ret,
+           "start": start, "end": time.time(),
+           "cmd_start": podman.cmd_start,
+           "lock_wait": round(podman.lock_wait, 6), "pid": os.getpid()}
+    fd = os.open(os.path.join(state, "invocations.jsonl"),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(fd, (json.dumps(rec) + "\n").encode())
+    os.close(fd)
+    return ret
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Time the hook: building its mount plan and applying it.
+
+    hook_bench.py [--modules-dir DIR] [--runs 5] [--plan-only] [--assemble]
+                  [--rootfs DIR] [--jobs 4] [--synthetic N [--workdir DIR]]
+                  [MODULE ...]
+
+The plan of the given modules (default: gpu and mpich) is built with a
+cold plan cache (reading the modules and expanding their globs) and a
+warm one (only checking modification times).
+
+Unless --plan-only is given, the plan is then applied with the mount
+binary, with mount(2) and with mount(2) in --jobs threads.  This must
+run as root (e.g. under sudo or unshare -r).  The benchmark moves into
+a private mount namespace and, for each run and mode, applies the
+copies and bind mounts to a scratch root filesystem on a tmpfs, the
+same way the OCI hook does.  With --assemble the modules are treated as
+if they had "assemble: true".
+
+With --synthetic N a modules directory with N generated modules, each
+copying a few files and bind mounting a few libraries from a scratch
+host directory, is used instead of --modules-dir.  Put it with
+--workdir on the filesystem the real module sources live on (e.g. a
+shared /usr/common): the parallel mode gains the most when each copy
+and stat waits on a network filesystem.
+
+With --rootfs (an unpacked image, e.g. from podman-hpc import-squash or
+podman export) running ldconfig in it is compared with installing a
+cached ld.so.cache, as the hook does for a known image and module set.
+
+The output is JSON with the best and mean time of each step.
+"""
+import os
+import json
+import time
+import ctypes
+import shutil
+import argparse
+import tempfile
+from subprocess import run
+import podman_hpc.hook_tool as ht
+
+CLONE_NEWNS = 0x00020000
+
+
+def timings(times):
+    return {"best_seconds": round(min(times), 4),
+            "mean_seconds": round(sum(times) / len(times), 4)}
+
+
+def make_modules(root, count, files=8):
+    """
+    Write count synthetic modules (and the host files they use) under
+    root.  Returns the modules directory and the module names.
+    """
+    mdir = os.path.join(root, "modules.d")
+    os.makedirs(mdir)
+    names = []
+    for m in range(count):
+        name = f"synth{m}"
+        host = os.path.join(root, "host", name)
+        os.makedirs(host)
+        for i in range(files):
+            for kind in ["etc", "lib"]:
+                with open(os.path.join(host, f"{kind}{i}.so"), "wb") as f:
+                    f.write(os.urandom(16384))
+        with open(os.path.join(mdir, f"{name}.yaml"), "w") as f:
+            f.write(f"name: {name}\nenv: ENABLE_{name.upper()}\n"
+                    f"copy:\n  - {host}/etc*:/etc/{name}/\n"
+                    f"bind:\n  - {host}/lib*:/usr/lib64/{name}/\n")
+        names.append(name)
+    return mdir, names
+
+
+def time_plan(env, modulesd, runs, cache):
+    """
+    Time get_plan with a cold and a warm plan cache.  The cache is left
+    in place for applying the plan (it holds the staging directories of
+    assembled modules).
+    """
+    cold = []
+    warm = []
+    for _ in range(runs):
+        shutil.rmtree(cache, ignore_errors=True)
+        start = time.time()
+        plan = ht.get_plan(env, modulesd, cache)
+        cold.append(time.time() - start)
+        start = time.time()
+        ht.get_plan(env, modulesd, cache)
+        warm.append(time.time() - start)
+    return plan, {"actions": len(plan["actions"]),
+                  "cold": timings(cold), "warm": timings(warm)}
+
+
+def time_ldconfig(rootfs, runs):
+    """
+    Time ldconfig in a root filesystem against installing its cached
+    output.
+    """
+    cache = tempfile.mkdtemp(prefix="hook-cache-")
+    ldconfig = []
+    cached = []
+    try:
+        for _ in range(runs):
+            start = time.time()
+            run(["chroot", rootfs, "/sbin/ldconfig"], check=True)
+            ldconfig.append(time.time() - start)
+        dir_fd = ht.open_ldcache_dir(cache)
+        ht.save_ldcache(dir_fd, "bench",
+                        os.path.join(rootfs, "etc", "ld.so.cache"))
+        os.close(dir_fd)
+        for _ in range(runs):
+            start = time.time()
+            ht.install_ldcache(cache, "bench", rootfs)
+            cached.append(time.time() - start)
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
+    return {"ldconfig": timings(ldconfig), "cached": timings(cached)}
+
+
+def apply_plan(plan, root, jobs=1):
+    ht.mount("tmpfs", root, "tmpfs", 0)
+    start = time.time()
+    try:
+        ht.run_plan(root, plan, jobs)
+        elapsed = time.time() - start
+        with open("/proc/self/mounts") as f:
+            mounts = sum(1 for line in f if f" {root}/" in line)
+    finally:
+        ht._libc.umount2(root.encode(), ht.MNT_DETACH)
+    return elapsed, mounts
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("modules", nargs="*", default=["gpu", "mpich"])
+    p.add_argument("--modules-dir", default="/etc/podman_hpc/modules.d")
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--plan-only", action="store_true",
+                   help="only time building the plan (no root needed)")
+    p.add_argument("--assemble", action="store_true",
+                   help="assemble the modules (one staging directory each)")
+    p.add_argument("--rootfs",
+                   help="image root to time ldconfig against a cached "
+                        "ld.so.cache (needs root)")
+    p.add_argument("--jobs", type=int, default=4,
+                   help="threads for the parallel mode")
+    p.add_argument("--synthetic", type=int, metavar="N",
+                   help="generate N modules instead of using --modules-dir")
+    p.add_argument("--workdir",
+                   help="where to create the synthetic modules")
+    args = p.parse_args()
+    synth = None
+    if args.synthetic:
+        synth = tempfile.mkdtemp(prefix="hook-synth-", dir=args.workdir)
+        args.modules_dir, args.modules = make_modules(synth, args.synthetic)
+    cache = tempfile.mkdtemp(prefix="hook-cache-")
+    try:
+        bench(args, cache)
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
+        if synth:
+            shutil.rmtree(synth, ignore_errors=True)
+
+
+def bench(args, cache):
+
+    if args.assemble:
+        read_confs = ht.read_confs
+
+        def assembled(mdir):
+            confs = read_confs(mdir)
+            for conf in confs.values():
+                conf["assemble"] = True
+            return confs
+
+        ht.read_confs = assembled
+
+    confs = ht.read_confs(args.modules_dir)
+    missing = [m for m in args.modules if m not in confs]
+    if missing:
+        raise SystemExit(f"Unknown modules: {' '.join(missing)}")
+    env = {confs[m]["env"]: "1" for m in args.modules}
+    res = {"modules": args.modules}
+    plan, res["plan"] = time_plan(env, args.modules_dir, args.runs, cache)
+    res["plan"]["groups"] = len(plan["groups"])
+    if args.rootfs:
+        res["ld_so_cache"] = time_ldconfig(args.rootfs, args.runs)
+    if args.plan_only:
+        print(json.dumps(res, indent=2))
+        return
+    if ht._libc.unshare(CLONE_NEWNS) != 0:
+        e = ctypes.get_errno()
+        raise SystemExit(f"unshare failed: {os.strerror(e)}")
+    ht.mount("none", "/", None, ht.MS_REC | ht.MS_PRIVATE)
+
+    root = tempfile.mkdtemp(prefix="hook-bench-")
+    for mode, jobs in [("binary", 1), ("syscall", 1),
+                       ("parallel", args.jobs)]:
+        ht._mount_binary = mode == "binary"
+        times = []
+        for _ in range(args.runs):
+            elapsed, mounts = apply_plan(plan, root, jobs)
+            times.append(elapsed)
+        res[mode] = {"jobs": jobs, "mounts": mounts}
+        res[mode].update(timings(times))
+    os.rmdir(root)
+    res["speedup"] = round(res["binary"]["best_seconds"] /
+                           max(res["syscall"]["best_seconds"], 1e-6), 1)
+    res["parallel_speedup"] = round(
+        res["syscall"]["best_seconds"] /
+        max(res["parallel"]["best_seconds"], 1e-6), 1)
+    print(json.dumps(res, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Time importing a large synthetic package with and without bytecode.
+
+    import_bench.py [--modules 5000] [--runs 5] [--workdir DIR]
+
+A package tree with the requested number of modules is generated and
+imported in a fresh interpreter, first with -B and no .pyc files (what
+every rank does when the image has no bytecode and can't keep it), then
+after compileall (what migrate --compile-python puts in the squash
+file).  The output is JSON with the best and mean time of each mode.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from subprocess import run
+
+MODULE = '''"""Synthetic module {n}."""
+import os
+
+
+class Thing{n}:
+    def __init__(self, value={n}):
+        self.value = value
+
+    def scaled(self, factor=2):
+        return [self.value * factor + i for i in range(8)]
+
+
+def helper_{n}(items):
+    return {{os.path.basename(str(k)): v for k, v in enumerate(items)}}
+
+
+TABLE = {table}
+'''
+
+
+def make_tree(root, modules, per_pkg=100):
+    """
+    Write a package named synth with the given number of modules, split
+    into subpackages of per_pkg modules, and an all module importing
+    every one of them.
+    """
+    top = os.path.join(root, "synth")
+    os.makedirs(top)
+    open(os.path.join(top, "__init__.py"), "w").close()
+    names = []
+    for n in range(modules):
+        pkg = f"p{n // per_pkg}"
+        pdir = os.path.join(top, pkg)
+        if not os.path.exists(pdir):
+            os.makedirs(pdir)
+            open(os.path.join(pdir, "__init__.py"), "w").close()
+        table = repr({f"k{i}": i * n for i in range(20)})
+        with open(os.path.join(pdir, f"m{n}.py"), "w") as f:
+            f.write(MODULE.format(n=n, table=table))
+        names.append(f"synth.{pkg}.m{n}")
+    with open(os.path.join(top, "all.py"), "w") as f:
+        for name in names:
+            f.write(f"import {name}\n")
+
+
+def time_import(root, python, runs, no_bytecode):
+    com = [python]
+    if no_bytecode:
+        com.append("-B")
+    com.extend(["-c", "import synth.all"])
+    env = dict(os.environ, PYTHONPATH=root)
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        run(com, env=env, check=True)
+        times.append(time.time() - start)
+    return {"best_seconds": round(min(times), 3),
+            "mean_seconds": round(sum(times) / len(times), 3)}
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("--modules", type=int, default=5000)
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--python", default=sys.executable,
+                   help="interpreter to time")
+    p.add_argument("--workdir",
+                   help="where to create the tree (e.g. a squashfuse "
+                        "or fuse-overlayfs mount)")
+    args = p.parse_args()
+    root = tempfile.mkdtemp(prefix="import-bench-", dir=args.workdir)
+    try:
+        make_tree(root, args.modules)
+        res = {"modules": args.modules, "python": args.python}
+        res["source_only"] = time_import(root, args.python, args.runs, True)
+        run([args.python, "-m", "compileall", "-q", root], check=True)
+        res["precompiled"] = time_import(root, args.python, args.runs,
+                                         False)
+        res["speedup"] = round(res["source_only"]["best_seconds"] /
+                               res["precompiled"]["best_seconds"], 2)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print(json.dumps(res, indent=2))
+
+
+if __name__ == "__main__":
+    main()
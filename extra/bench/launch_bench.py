@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Time shared-run launches of many local ranks against a fake podman.
+
+    launch_bench.py [--ranks 1,2,4,...,512] [--config FILE]
+                    [--image IMAGE] [COMMAND ...]
+
+For each rank count a fresh fake podman (fake_podman.py in this
+directory) is set up and that many podman-hpc shared-run processes are
+started at once with the Slurm variables shared-run reads
+(SLURM_LOCALID, SLURM_STEP_TASKS_PER_NODE), so they go through
+_shared_run exactly like srun would start them on one node.  Local rank
+0 starts the container, every rank waits for it and execs COMMAND
+(default: true) in it, and the last one to finish tears it down.
+
+The output is JSON with, per rank count, the time until every rank's
+command was running, the teardown time (from the last command exiting
+to the container being removed), the total time, the number of podman
+invocations per command and the time spent waiting for the storage
+lock.  --config is a JSON file with fake podman latencies (see
+fake_podman.py).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from subprocess import Popen, DEVNULL, PIPE, TimeoutExpired
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+# A rank: podman-hpc as srun would start it
+RANK = "from podman_hpc.podman_hpc import main; main()"
+
+
+def make_bin(root):
+    """
+    Create a bin directory with the fake podman and the other binaries
+    SiteConfig looks for.
+    """
+    bindir = os.path.join(root, "bin")
+    os.makedirs(bindir)
+    os.symlink(os.path.join(BENCH_DIR, "fake_podman.py"),
+               os.path.join(bindir, "podman"))
+    os.symlink(shutil.which("true"), os.path.join(bindir, "runc"))
+    os.symlink(os.path.join(REPO_DIR, "bin", "fuse-overlayfs-wrap"),
+               os.path.join(bindir, "fuse-overlayfs-wrap"))
+    return bindir
+
+
+def read_invocations(state):
+    res = []
+    try:
+        with open(os.path.join(state, "invocations.jsonl")) as f:
+            for line in f:
+                res.append(json.loads(line))
+    except OSError:
+        pass
+    return res
+
+
+def summarize(ranks, start, end, invocations, failed):
+    counts = {}
+    for inv in invocations:
+        name = inv["command"] or "podman"
+        if inv["sub"]:
+            name = f"{name} {inv['sub']}"
+        if inv["help"]:
+            name = f"{name} --help"
+        counts[name] = counts.get(name, 0) + 1
+    execs = [i for i in invocations
+             if i["command"] == "exec" and i["cmd_start"]]
+    rms = [i for i in invocations if i["command"] == "rm"]
+    res = {"ranks": ranks, "failed": failed,
+           "total_seconds": round(end - start, 3),
+           "podman_calls": len(invocations),
+           "invocations": dict(sorted(counts.items())),
+           "lock_wait_seconds": round(sum(i["lock_wait"]
+                                          for i in invocations), 3)}
+    if len(execs) == ranks:
+        res["first_running_seconds"] = round(
+            min(i["cmd_start"] for i in execs) - start, 3)
+        res["time_to_running_seconds"] = round(
+            max(i["cmd_start"] for i in execs) - start, 3)
+    if execs and rms:
+        res["teardown_seconds"] = round(
+            max(i["end"] for i in rms) - max(i["end"] for i in execs), 3)
+    return res
+
+
+def launch(ranks, root, env, image, command, timeout):
+    """
+    Start ranks shared-run processes and wait for them.
+    """
+    state = os.path.join(root, f"state-{ranks}")
+    os.makedirs(state)
+    env = dict(env, FAKE_PODMAN_STATE=state,
+               SLURM_STEP_TASKS_PER_NODE=str(ranks))
+    procs = []
+    start = time.time()
+    for rank in range(ranks):
+        renv = dict(env, SLURM_LOCALID=str(rank), SLURM_PROCID=str(rank))
+        procs.append(Popen([sys.executable, "-c", RANK, "shared-run",
+                            image] + command, env=renv, stdout=DEVNULL,
+                           stderr=PIPE))
+    failed = 0
+    errors = []
+    for proc in procs:
+        try:
+            _, err = proc.communicate(timeout=max(timeout - (time.time() -
+                                                             start), 1))
+        except TimeoutExpired:
+            proc.kill()
+            _, err = proc.communicate()
+        if proc.returncode != 0:
+            failed += 1
+            errors.append(err.decode(errors="replace").strip())
+    end = time.time()
+    res = summarize(ranks, start, end, read_invocations(state), failed)
+    if errors:
+        res["first_error"] = errors[0][-500:]
+    return res
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("command", nargs="*", default=["true"])
+    p.add_argument("--ranks", default=",".join(str(2**i)
+                                               for i in range(10)),
+                   help="comma separated rank counts (default: 1..512)")
+    p.add_argument("--config", help="JSON file with fake podman latencies")
+    p.add_argument("--image", default="ubuntu:22.04")
+    p.add_argument("--timeout", type=float, default=600,
+                   help="seconds to wait for each launch")
+    args = p.parse_args()
+
+    root = tempfile.mkdtemp(prefix="launch-bench-")
+    try:
+        bindir = make_bin(root)
+        env = dict(os.environ)
+        env.update({
+            "PATH": f"{bindir}:{env.get('PATH', '')}",
+            "PYTHONPATH": os.pathsep.join(
+                [REPO_DIR] + ([env["PYTHONPATH"]]
+                              if env.get("PYTHONPATH") else [])),
+            "SQUASH_DIR": os.path.join(root, "squash"),
+            # Ignore the site configuration of this host
+            "PODMANHPC_CONFIG_FILE": os.path.join(root, "none.yaml"),
+        })
+        if args.config:
+            env["FAKE_PODMAN_CONFIG"] = os.path.abspath(args.config)
+        results = []
+        for ranks in [int(n) for n in args.ranks.split(",")]:
+            results.append(launch(ranks, root, env, args.image,
+                                  args.command, args.timeout))
+            print(json.dumps(results[-1]), file=sys.stderr)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compare the default pull (graph root + migrate) with pull --direct.
+
+    pull_bench.py IMAGE [IMAGE ...]
+
+Each image is pulled into a fresh squash directory with both modes.  The
+report has the total time, the peak and final local disk use (graph root
+and staging directory) and the squash directory size.  On nodes where
+/tmp is RAM backed the local disk use is memory use.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from subprocess import run
+from podman_hpc.podman_hpc import UsageMonitor, _dir_usage
+from podman_hpc.siteconfig import SiteConfig
+
+
+def bench(image, direct, conf, workdir):
+    sqdir = tempfile.mkdtemp(prefix="squash-", dir=workdir)
+    local = [conf.graph_root, conf.squash_staging_dir]
+    base = sum(_dir_usage(p) for p in local if os.path.exists(p))
+    monitors = [UsageMonitor(p) for p in local]
+    for p, m in zip(local, monitors):
+        os.makedirs(p, exist_ok=True)
+        m.start()
+    com = ["podman-hpc", "--squash-dir", sqdir, "pull"]
+    if direct:
+        com.append("--direct")
+    com.append(image)
+    start = time.time()
+    proc = run(com)
+    elapsed = time.time() - start
+    peak = sum(m.stop() for m in monitors)
+    final = sum(_dir_usage(p) for p in local)
+    res = {
+        "image": image,
+        "mode": "direct" if direct else "default",
+        "ok": proc.returncode == 0,
+        "seconds": round(elapsed, 2),
+        "peak_local_mib": round(max(peak - base, 0) / 2**20, 1),
+        "final_local_mib": round(max(final - base, 0) / 2**20, 1),
+        "squash_dir_mib": round(_dir_usage(sqdir) / 2**20, 1),
+    }
+    shutil.rmtree(sqdir, ignore_errors=True)
+    return res
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("images", nargs="+")
+    p.add_argument("--workdir", help="where to create squash directories")
+    p.add_argument("--rmi", action="store_true",
+                   help="remove the image from the graph root between runs")
+    args = p.parse_args()
+    conf = SiteConfig()
+    results = []
+    for image in args.images:
+        for direct in [False, True]:
+            if args.rmi:
+                run(["podman-hpc", "rmi", "-f", image])
+            results.append(bench(image, direct, conf, args.workdir))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
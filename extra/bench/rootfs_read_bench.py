@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+File open/read microbenchmark for the container rootfs.
+
+Run inside a container to time opening and reading every file under a
+set of directories:
+
+    rootfs_read_bench.py walk /usr/lib /usr/lib64
+
+Or compare the default fuse-overlayfs rootfs with --read-only-squash
+for an image that has already been migrated (requires python3 in the
+image):
+
+    rootfs_read_bench.py compare IMAGE
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from subprocess import run, PIPE
+
+
+def walk(dirs, max_files, block):
+    nfiles = 0
+    nbytes = 0
+    t_open = 0.0
+    start = time.time()
+    for d in dirs:
+        for root, _, files in os.walk(d):
+            for fn in files:
+                pth = os.path.join(root, fn)
+                if not os.path.isfile(pth) or os.path.islink(pth):
+                    continue
+                t0 = time.time()
+                try:
+                    f = open(pth, "rb", buffering=0)
+                except OSError:
+                    continue
+                t_open += time.time() - t0
+                with f:
+                    while True:
+                        buf = f.read(block)
+                        if not buf:
+                            break
+                        nbytes += len(buf)
+                nfiles += 1
+                if nfiles >= max_files:
+                    break
+    elapsed = time.time() - start
+    return {
+        "files": nfiles,
+        "bytes": nbytes,
+        "seconds": round(elapsed, 4),
+        "opens_per_sec": round(nfiles / t_open, 1) if t_open else None,
+        "read_mb_per_sec": round(nbytes / elapsed / 2**20, 1)
+        if elapsed else None,
+    }
+
+
+def compare(image, dirs, max_files, block, repeat):
+    here = os.path.dirname(os.path.abspath(__file__))
+    inner = ["python3", "/bench/rootfs_read_bench.py", "walk",
+             "--max-files", str(max_files), "--block", str(block)] + dirs
+    modes = {
+        "fuse-overlayfs": [],
+        "read-only-squash": ["--read-only-squash"],
+    }
+    results = {}
+    for mode, flags in modes.items():
+        runs = []
+        for _ in range(repeat):
+            com = ["podman-hpc", "run", "--rm"] + flags + \
+                  ["-v", f"{here}:/bench:ro", image] + inner
+            t0 = time.time()
+            proc = run(com, stdout=PIPE)
+            res = json.loads(proc.stdout.decode().splitlines()[-1])
+            res["launch_seconds"] = round(time.time() - t0, 4)
+            runs.append(res)
+        results[mode] = runs
+    return results
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    sub = p.add_subparsers(dest="cmd", required=True)
+    w = sub.add_parser("walk")
+    w.add_argument("dirs", nargs="+")
+    c = sub.add_parser("compare")
+    c.add_argument("image")
+    c.add_argument("--dirs", nargs="+", default=["/usr/lib", "/usr/lib64"])
+    c.add_argument("--repeat", type=int, default=3)
+    for s in [w, c]:
+        s.add_argument("--max-files", type=int, default=20000)
+        s.add_argument("--block", type=int, default=1 << 20)
+    args = p.parse_args()
+    if args.cmd == "walk":
+        res = walk(args.dirs, args.max_files, args.block)
+    else:
+        res = compare(args.image, args.dirs, args.max_files, args.block,
+                      args.repeat)
+    print(json.dumps(res))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
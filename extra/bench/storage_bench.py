@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Time ImageStore and MigrateUtils operations on a synthetic image store.
+
+    storage_bench.py [--images 20] [--layers 5] [--shared 2]
+                     [--files 100] [--file-size 4096] [--seed 0]
+                     [--runs 3] [--squash N] [--workdir DIR]
+                     [--output FILE]
+
+A source store is generated with storage_gen.py (in this directory) and
+these operations are timed against it, each as the best of --runs:
+
+  resolve_name   get_img_info by short name (synth/imgN)
+  resolve_id     get_img_info by a 12 character ID prefix
+  layer_walk     _get_img_layers from the top layer of every image
+  add_recs       adding the layer and image records of every image to
+                 an empty destination store, one image at a time
+  drop_tag       dropping the tag of every image
+  del_rec        deleting every image record
+  copy           _copy_image_info, _copy_required_layers and
+                 _copy_overlay of every image into an empty store
+  squash         with --squash N, mksquashfs of the rootfs of the first
+                 N images (the layer diffs merged bottom-up) with the
+                 options of the default squash profile
+
+The output is JSON with the parameters, the podman-hpc version and, per
+operation, the number of operations, the seconds and the milliseconds
+per operation, so results of different releases can be compared.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from subprocess import Popen, PIPE, check_call
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(BENCH_DIR))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from storage_gen import generate_store  # noqa: E402
+from podman_hpc.migrate2scratch import ImageStore, MigrateUtils  # noqa: E402
+
+
+def podman_hpc_version():
+    """
+    Returns the podman-hpc version without importing the CLI module
+    (which runs podman for its help text).
+    """
+    fn = os.path.join(REPO_DIR, "podman_hpc", "podman_hpc.py")
+    with open(fn) as f:
+        m = re.search(r'^__version__ = "([^"]+)"', f.read(), re.M)
+    return m.group(1) if m else None
+
+
+def timed(func, ops, runs, setup=None):
+    """
+    Returns the best time of runs calls of func.  setup is called before
+    each run, outside of the timing.
+    """
+    best = None
+    for _ in range(runs):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"ops": ops, "seconds": round(best, 6),
+            "per_op_ms": round(best * 1000 / ops, 4) if ops else None}
+
+
+def build_rootfs(mu, img, rootfs):
+    """
+    Merge the layer diffs of an image into rootfs, base layer first.
+    """
+    layers = mu._get_img_layers(mu.src, img["layer"])
+    os.makedirs(rootfs)
+    for layer in reversed(layers):
+        diff = os.path.join(mu.src.overlay_dir, layer["id"], "diff")
+        check_call(["cp", "-a", f"{diff}/.", rootfs])
+
+
+def squash(mu, images, workdir, mksq_bin):
+    """
+    Build the rootfs of each image and squash it.  Returns the timing of
+    the mksquashfs runs and the total squash file size.
+    """
+    options = mu.get_mksq_options()
+    elapsed = 0.0
+    size = 0
+    for img in images:
+        rootfs = os.path.join(workdir, "rootfs")
+        sqf = os.path.join(workdir, f"{img['id']}.sqsh")
+        build_rootfs(mu, img, rootfs)
+        cmd = [mksq_bin, rootfs, sqf, "-noappend", "-no-progress"] + options
+        start = time.perf_counter()
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        _, err = proc.communicate()
+        elapsed += time.perf_counter() - start
+        if proc.returncode != 0:
+            raise OSError(f"mksquashfs failed: {err.decode().strip()}")
+        size += os.path.getsize(sqf)
+        shutil.rmtree(rootfs)
+        os.remove(sqf)
+    ops = len(images)
+    return {"ops": ops, "seconds": round(elapsed, 6),
+            "per_op_ms": round(elapsed * 1000 / ops, 4) if ops else None,
+            "squash_bytes": size}
+
+
+def run_bench(root, args):
+    src_dir = os.path.join(root, "src")
+    dst_dir = os.path.join(root, "dst")
+    start = time.perf_counter()
+    gen = generate_store(src_dir, args.images, args.layers, args.shared,
+                         args.files, args.file_size, args.seed)
+    generate_seconds = time.perf_counter() - start
+    mu = MigrateUtils(src=src_dir, dst=dst_dir)
+
+    def fresh_dst():
+        shutil.rmtree(dst_dir, ignore_errors=True)
+        mu._lazy_init_called = False
+        mu._lazy_init()
+        mu.dst.init_storage()
+
+    fresh_dst()
+    images = [mu.src.get_img_info(i)[0] for i in gen["ids"]]
+    short = [n[len("localhost/"):-len(":latest")] for n in gen["names"]]
+    layers = {img["id"]: mu._get_img_layers(mu.src, img["layer"])
+              for img in images}
+    nimg = len(images)
+    results = {}
+
+    results["resolve_name"] = timed(
+        lambda: [mu.src.get_img_info(n) for n in short], nimg, args.runs)
+    results["resolve_id"] = timed(
+        lambda: [mu.src.get_img_info(i[:12]) for i in gen["ids"]], nimg,
+        args.runs)
+    results["layer_walk"] = timed(
+        lambda: [mu._get_img_layers(mu.src, img["layer"])
+                 for img in images], nimg, args.runs)
+
+    def add_recs():
+        for img in images:
+            mu.dst.add_recs("layers", layers[img["id"]])
+            mu.dst.add_recs("images", [dict(img, names=list(img["names"]))])
+
+    def populated_dst():
+        fresh_dst()
+        add_recs()
+
+    results["add_recs"] = timed(add_recs, 2 * nimg, args.runs, fresh_dst)
+    results["drop_tag"] = timed(
+        lambda: [mu.dst.drop_tag(img["names"]) for img in images], nimg,
+        args.runs, populated_dst)
+    results["del_rec"] = timed(
+        lambda: [mu.dst.del_rec("images", img["id"]) for img in images],
+        nimg, args.runs, populated_dst)
+
+    def copy():
+        for img in images:
+            mu._copy_image_info(img["id"])
+            mu._copy_required_layers(layers[img["id"]])
+            mu._copy_overlay(img["id"], layers[img["id"]])
+
+    results["copy"] = timed(copy, nimg, args.runs, fresh_dst)
+    # Check the copies like migrate does
+    dst = ImageStore(dst_dir)
+    copied = sum(1 for img in images
+                 if mu._verify_overlay(layers[img["id"]]))
+    results["copy"]["verified"] = copied == nimg and \
+        len(dst.layers) == gen["layers"]
+
+    if args.squash:
+        mksq_bin = args.mksquashfs or shutil.which("mksquashfs.static") or \
+            shutil.which("mksquashfs")
+        if not mksq_bin:
+            results["squash"] = {"skipped": "mksquashfs not found"}
+        else:
+            sqdir = os.path.join(root, "squash")
+            os.makedirs(sqdir)
+            results["squash"] = squash(mu, images[:args.squash], sqdir,
+                                       mksq_bin)
+
+    params = {k: getattr(args, k) for k in
+              ["images", "layers", "shared", "files", "file_size", "seed",
+               "runs", "squash"]}
+    return {"version": podman_hpc_version(), "params": params,
+            "store": {"images": nimg, "layers": gen["layers"],
+                      "generate_seconds": round(generate_seconds, 3)},
+            "results": results}
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("--images", type=int, default=20)
+    p.add_argument("--layers", type=int, default=5)
+    p.add_argument("--shared", type=int, default=2,
+                   help="base layers shared by all images")
+    p.add_argument("--files", type=int, default=100,
+                   help="files per layer")
+    p.add_argument("--file-size", type=int, default=4096)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--squash", type=int, default=0, metavar="N",
+                   help="squash the first N images")
+    p.add_argument("--mksquashfs", help="mksquashfs binary")
+    p.add_argument("--workdir", help="directory for the stores "
+                   "(default: a temporary directory)")
+    p.add_argument("--output", help="write the JSON results to a file")
+    args = p.parse_args()
+
+    root = tempfile.mkdtemp(prefix="storage-bench-", dir=args.workdir)
+    try:
+        res = run_bench(root, args)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    out = json.dumps(res, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    print(out)
+
+
+if __name__ == "__main__":
+    main()
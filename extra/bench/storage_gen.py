@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Generate a synthetic containers/storage image store.
+
+    storage_gen.py DIR [--images 20] [--layers 5] [--shared 2]
+                   [--files 100] [--file-size 4096] [--seed 0]
+
+Every image has --layers layers.  The bottom --shared layers are the
+same base layers for all images (like images built from one base
+image) and the rest are unique to the image.  Each layer has --files
+files of --file-size random bytes in its diff directory.  The layout
+(images.json, layers.json, the image directories with their manifest
+and config, the overlay link files and l/ symlinks and the tar-split
+files) is what podman writes, so ImageStore and MigrateUtils can use
+it as a source store.
+"""
+import os
+import gzip
+import json
+import base64
+import random
+import hashlib
+import argparse
+import string
+
+
+def _digest(*parts):
+    return hashlib.sha256(":".join(str(p) for p in parts).encode()
+                          ).hexdigest()
+
+
+def _big_data_name(key):
+    return "=" + base64.b64encode(key.encode("utf-8")).decode("utf-8")
+
+
+def _write_layer(root, layer_id, link, files, file_size, rng):
+    """
+    Write the overlay directory of a layer and return its diff size.
+    """
+    ldir = os.path.join(root, "overlay", layer_id)
+    diff = os.path.join(ldir, "diff")
+    for sub in ["diff", "work", "empty"]:
+        os.makedirs(os.path.join(ldir, sub), exist_ok=True)
+    with open(os.path.join(ldir, "link"), "w") as f:
+        f.write(link)
+    os.symlink(os.path.join("..", layer_id, "diff"),
+               os.path.join(root, "overlay", "l", link))
+    # Spread the files over a few directories like a real layer
+    size = 0
+    for i in range(files):
+        sub = os.path.join(diff, "usr", f"lib{i % 8}")
+        os.makedirs(sub, exist_ok=True)
+        data = rng.getrandbits(file_size * 8).to_bytes(file_size,
+                                                      "little")
+        with open(os.path.join(sub, f"{layer_id[:8]}-{i}.so"), "wb") as f:
+            f.write(data)
+        size += file_size
+    tsplit = os.path.join(root, "overlay-layers",
+                          f"{layer_id}.tar-split.gz")
+    with gzip.open(tsplit, "wb") as f:
+        f.write(json.dumps({"type": 1, "payload": layer_id}).encode())
+    return size
+
+
+def generate_store(root, images=20, layers=5, shared=2, files=100,
+                   file_size=4096, seed=0):
+    """
+    Write a synthetic image store to root.  Returns a dictionary with
+    the image names, image IDs and the number of layers.
+
+    Inputs:
+    root: directory for the store (created)
+    images: number of images
+    layers: layers per image
+    shared: number of base layers shared by all images
+    files: files per layer
+    file_size: bytes per file
+    seed: seed for the IDs, link names and file contents
+    """
+    rng = random.Random(seed)
+    shared = min(shared, layers)
+    for sub in ["overlay/l", "overlay-images", "overlay-layers"]:
+        os.makedirs(os.path.join(root, sub), exist_ok=True)
+    layer_recs = []
+    image_recs = []
+
+    def new_layer(name, parent):
+        layer_id = _digest(seed, "layer", name)
+        link = "".join(rng.choice(string.ascii_uppercase + string.digits)
+                       for _ in range(26))
+        size = _write_layer(root, layer_id, link, files, file_size, rng)
+        rec = {"id": layer_id, "created": "2024-01-01T00:00:00Z",
+               "compressed-diff-digest": f"sha256:{_digest(layer_id, 'c')}",
+               "compressed-size": size // 2,
+               "diff-digest": f"sha256:{layer_id}", "diff-size": size,
+               "compression": 2, "uidset": [0], "gidset": [0]}
+        if parent:
+            rec["parent"] = parent
+        layer_recs.append(rec)
+        return layer_id
+
+    base = None
+    for i in range(shared):
+        base = new_layer(f"base{i}", base)
+    for n in range(images):
+        top = base
+        for i in range(layers - shared):
+            top = new_layer(f"img{n}-{i}", top)
+        img_id = _digest(seed, "image", n)
+        name = f"localhost/synth/img{n}:latest"
+        idir = os.path.join(root, "overlay-images", img_id)
+        os.makedirs(idir)
+        config = json.dumps({"architecture": "amd64", "os": "linux",
+                             "config": {"Cmd": ["/bin/sh"]},
+                             "rootfs": {"type": "layers"}}).encode()
+        manifest = json.dumps({"schemaVersion": 2, "config": {
+            "digest": f"sha256:{img_id}", "size": len(config)}}).encode()
+        big_data = {f"sha256:{img_id}": config, "manifest": manifest}
+        for key, data in big_data.items():
+            with open(os.path.join(idir, _big_data_name(key)), "wb") as f:
+                f.write(data)
+        with open(os.path.join(idir, "manifest"), "wb") as f:
+            f.write(manifest)
+        image_recs.append({
+            "id": img_id, "digest": f"sha256:{_digest(img_id, 'm')}",
+            "names": [name], "names-history": [name], "layer": top,
+            "big-data-names": list(big_data),
+            "big-data-sizes": {k: len(v) for k, v in big_data.items()},
+            "created": "2024-01-01T00:00:00Z"})
+    for typ, recs in [("images", image_recs), ("layers", layer_recs)]:
+        with open(os.path.join(root, f"overlay-{typ}", f"{typ}.json"),
+                  "w") as f:
+            json.dump(recs, f)
+        open(os.path.join(root, f"overlay-{typ}", f"{typ}.lock"),
+             "w").close()
+    return {"names": [img["names"][0] for img in image_recs],
+            "ids": [img["id"] for img in image_recs],
+            "layers": len(layer_recs)}
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("dir")
+    p.add_argument("--images", type=int, default=20)
+    p.add_argument("--layers", type=int, default=5)
+    p.add_argument("--shared", type=int, default=2)
+    p.add_argument("--files", type=int, default=100)
+    p.add_argument("--file-size", type=int, default=4096)
+    p.add_argument("--seed", type=int, default=0)
+    args = p.parse_args()
+    res = generate_store(args.dir, args.images, args.layers, args.shared,
+                         args.files, args.file_size, args.seed)
+    print(json.dumps({"images": len(res["names"]), "layers": res["layers"]}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import os
+import io
+import re
+import sys
+import json
+import socket
+import tarfile
+import logging
+from .migrate2scratch import ImageLock, write_checksum
+from .import_archive import _HashReader
+from .squash_index import index_filename
+
+BUNDLE_VERSION = 1
+BUFSIZE = 16 << 20
+# Formats of the IDs and overlay link names used in store paths
+_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+_LINK_RE = re.compile(r"^[A-Z0-9]{26}$")
+
+
+def _check_manifest(manifest):
+    """
+    Check the IDs and link names of a bundle manifest before any of them
+    is used in a store path, so a crafted bundle can't write outside the
+    store.  Raises ValueError if one is malformed.
+
+    Inputs:
+    manifest: contents of bundle.json
+    """
+    try:
+        img = manifest["image"]
+        ids = [img["id"], img["layer"]]
+        for rec in manifest["layers"]:
+            ids.append(rec["id"])
+            if "parent" in rec:
+                ids.append(rec["parent"])
+        links = manifest["links"]
+        ids.extend(links)
+        link_names = list(links.values())
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError("Invalid bundle manifest")
+    for id in ids:
+        if not isinstance(id, str) or not _ID_RE.match(id):
+            raise ValueError(f"Invalid ID in bundle: {id!r}")
+    for link in link_names:
+        if not isinstance(link, str) or not _LINK_RE.match(link):
+            raise ValueError(f"Invalid link in bundle: {link!r}")
+
+
+def _image_layers(store, top_id):
+    """
+    Returns the layer records of an image, top layer first.
+    """
+    by_id = {rec["id"]: rec for rec in store.layers}
+    layers = []
+    layer_id = top_id
+    while layer_id:
+        rec = by_id[layer_id]
+        layers.append(rec)
+        layer_id = rec.get("parent")
+    return layers
+
+
+def _open_tar(fn, mode):
+    """
+    Open a bundle for streaming.  "-" is stdin/stdout.
+    """
+    if fn == "-":
+        fobj = sys.stdout.buffer if mode == "w|" else sys.stdin.buffer
+        tf = tarfile.open(fileobj=fobj, mode=mode, bufsize=BUFSIZE)
+    else:
+        tf = tarfile.open(fn, mode=mode, bufsize=BUFSIZE)
+    tf.copybufsize = BUFSIZE
+    return tf
+
+
+def _add_json(tf, name, data):
+    raw = json.dumps(data).encode()
+    ti = tarfile.TarInfo(name)
+    ti.size = len(raw)
+    tf.addfile(ti, io.BytesIO(raw))
+
+
+def export_bundle(store, image, out):
+    """
+    Write everything the image store needs for a squashed image into a
+    single file that can be read sequentially.
+
+    The bundle is an uncompressed tar.  bundle.json comes first and
+    describes the image, its layers and the files that follow.  The
+    files are written in the order they are needed and checksums.json,
+    with the sha256 of every file, comes last so nothing has to be read
+    twice.
+
+    Inputs:
+    store: ImageStore holding the squashed image
+    image: image name or ID
+    out: bundle file name ("-" for stdout)
+    """
+    img_info, _ = store.get_img_info(image)
+    if not img_info:
+        raise ValueError(f"Image {image} not found in {store.base}")
+    img_id = img_info["id"]
+    layers = _image_layers(store, img_info["layer"])
+    links = {rec["id"]: store.read_link_file(rec["id"]) for rec in layers}
+    sqf = store.get_squash_filename(links[img_info["layer"]])
+    if not os.path.exists(sqf):
+        raise ValueError(f"Image {image} has no squash file")
+
+    files = []
+    imgd = os.path.join(store.images_dir, img_id)
+    for fn in sorted(os.listdir(imgd)):
+        files.append((f"images/{fn}", os.path.join(imgd, fn)))
+    for rec in layers:
+        ts = os.path.join(store.layers_dir, f"{rec['id']}.tar-split.gz")
+        if os.path.exists(ts):
+            files.append((f"layers/{rec['id']}.tar-split.gz", ts))
+    files.append(("squash", sqf))
+    if os.path.exists(index_filename(sqf)):
+        files.append(("index", index_filename(sqf)))
+
+    manifest = {
+        "version": BUNDLE_VERSION,
+        "image": img_info,
+        "layers": layers,
+        "links": links,
+        "files": {name: os.path.getsize(pth) for name, pth in files},
+    }
+    checksums = {}
+    with _open_tar(out, "w|") as tf:
+        _add_json(tf, "bundle.json", manifest)
+        for name, pth in files:
+            ti = tf.gettarinfo(pth, arcname=name)
+            ti.uid = ti.gid = 0
+            ti.uname = ti.gname = ""
+            with open(pth, "rb") as f:
+                reader = _HashReader(f)
+                tf.addfile(ti, reader)
+            checksums[name] = reader.digest()
+            logging.debug(f"Added {name} to bundle")
+        _add_json(tf, "checksums.json", checksums)
+    return img_id
+
+
+class BundleImport:
+    """
+    Class to restore a bundle written by export_bundle into an image
+    store.
+
+    Files are written to temporary names next to their targets while the
+    bundle is read.  Only once every checksum has been verified are they
+    renamed into place, and the layer and image records are added last.
+    """
+
+    def __init__(self, store):
+        """
+        Inputs:
+        store: destination ImageStore (writable)
+        """
+        self.store = store
+        self.suffix = f".tmp-{socket.gethostname()}-{os.getpid()}"
+        self.manifest = None
+        self.tmp_files = {}
+        self.digests = {}
+
+    def _target(self, name):
+        """
+        Returns the final path of a bundle member.
+        """
+        store = self.store
+        img_id = self.manifest["image"]["id"]
+        if name == "squash":
+            link = self._link(self.manifest["image"]["layer"])
+            return store.get_squash_filename(link)
+        if name == "index":
+            return index_filename(self._target("squash"))
+        typ, fn = name.split("/", 1)
+        if "/" in fn or fn.startswith("."):
+            raise ValueError(f"Invalid bundle entry {name}")
+        if typ == "images":
+            return os.path.join(store.images_dir, img_id, fn)
+        if typ == "layers":
+            return os.path.join(store.layers_dir, fn)
+        raise ValueError(f"Invalid bundle entry {name}")
+
+    def _link(self, layer_id):
+        # Layers already in the store keep their link
+        lf = os.path.join(self.store.overlay_dir, layer_id, "link")
+        if os.path.exists(lf):
+            return open(lf).read()
+        return self.manifest["links"][layer_id]
+
+    def _write_member(self, tf, m):
+        tgt = self._target(m.name)
+        os.makedirs(os.path.dirname(tgt), exist_ok=True)
+        tmp = f"{tgt}{self.suffix}"
+        self.tmp_files[tmp] = tgt
+        reader = _HashReader(tf.extractfile(m))
+        with open(tmp, "wb", buffering=0) as f:
+            while True:
+                buf = reader.read(BUFSIZE)
+                if not buf:
+                    break
+                f.write(buf)
+            os.fsync(f.fileno())
+        self.digests[m.name] = reader.digest()
+
+    def _verify(self, checksums):
+        files = self.manifest["files"]
+        if set(checksums) != set(files) or set(self.digests) != set(files):
+            raise ValueError("Bundle is incomplete")
+        for name, digest in self.digests.items():
+            if checksums[name] != digest:
+                raise ValueError(f"Checksum mismatch for {name}")
+
+    def _commit(self):
+        store = self.store
+        for tmp, tgt in self.tmp_files.items():
+            os.rename(tmp, tgt)
+        self.tmp_files = {}
+        write_checksum(self._target("squash"), self.digests["squash"],
+                       self.manifest["files"]["squash"])
+        for rec in self.manifest["layers"]:
+            ldir = os.path.join(store.overlay_dir, rec["id"])
+            os.makedirs(os.path.join(ldir, "diff"), exist_ok=True)
+            lf = os.path.join(ldir, "link")
+            link = self._link(rec["id"])
+            if not os.path.exists(lf):
+                with open(f"{lf}{self.suffix}", "w") as f:
+                    f.write(link)
+                os.rename(f"{lf}{self.suffix}", lf)
+            lname = os.path.join(store.overlay_dir, "l", link)
+            if not os.path.lexists(lname):
+                os.symlink(os.path.join("..", rec["id"], "diff"), lname)
+        store.add_recs("layers", list(reversed(self.manifest["layers"])))
+        # Adding the image record last commits the import
+        img_info = self.manifest["image"]
+        store.drop_tag(img_info["names"])
+        store.add_recs("images", [img_info])
+
+    def _cleanup(self):
+        for tmp in self.tmp_files:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        if self.manifest:
+            imgd = os.path.join(self.store.images_dir,
+                                self.manifest["image"]["id"])
+            # Drop the image directory if we created it
+            if os.path.isdir(imgd) and not os.listdir(imgd):
+                os.rmdir(imgd)
+        self.tmp_files = {}
+
+    def run(self, bundle):
+        """
+        Import a bundle.  Returns the image ID.
+
+        Inputs:
+        bundle: bundle file name ("-" for stdin)
+        """
+        self.store.init_storage()
+        self.store.refresh()
+        lock = None
+        try:
+            with _open_tar(bundle, "r|") as tf:
+                for m in tf:
+                    if self.manifest is None:
+                        if m.name != "bundle.json":
+                            raise ValueError("Not a squash bundle")
+                        self.manifest = json.load(tf.extractfile(m))
+                        if self.manifest.get("version") != BUNDLE_VERSION:
+                            raise ValueError("Unsupported bundle version")
+                        _check_manifest(self.manifest)
+                        img_id = self.manifest["image"]["id"]
+                        if self.store.chk_image(img_id):
+                            logging.info("Image already in the store")
+                            return img_id
+                        lock = ImageLock(self.store, img_id)
+                        lock.acquire()
+                        self.store.refresh()
+                        if self.store.chk_image(img_id):
+                            logging.info("Imported by another process")
+                            return img_id
+                        continue
+                    if m.name == "checksums.json":
+                        self._verify(json.load(tf.extractfile(m)))
+                        self._commit()
+                        return self.manifest["image"]["id"]
+                    self._write_member(tf, m)
+            raise ValueError("Bundle is truncated")
+        finally:
+            self._cleanup()
+            if lock:
+                lock.release()
+
+
+def import_bundle(store, bundle):
+    """
+    Restore a bundle into an image store.  Returns the image ID.
+
+    Inputs:
+    store: destination ImageStore (writable)
+    bundle: bundle file name ("-" for stdin)
+    """
+    return BundleImport(store).run(bundle)
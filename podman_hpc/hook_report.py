@@ -0,0 +1,117 @@
+import json
+import logging
+
+PERCENTILES = [50, 90, 99]
+
+
+def read_records(fn):
+    """
+    Read the JSON lines timing records written by the hook.  Lines that
+    can't be parsed (e.g. a record cut short by a full disk) are skipped.
+    """
+    res = []
+    bad = 0
+    with open(fn) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                bad += 1
+                continue
+            if isinstance(rec, dict) and "kind" in rec and "name" in rec:
+                res.append(rec)
+    if bad:
+        logging.warning(f"Skipped {bad} malformed records in {fn}")
+    return res
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of a list of values (nearest rank).
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(-(-p * len(values) // 100)), 1)
+    return values[rank - 1]
+
+
+def summarize(records, since=None):
+    """
+    Aggregate timing records across containers.
+
+    Inputs:
+    records: records from read_records
+    since: only use records of hooks started at or after this time
+    """
+    phases = {}
+    rules = {}
+    containers = set()
+    for rec in records:
+        if since is not None and rec.get("start", 0) < since:
+            continue
+        containers.add(rec.get("container"))
+        if rec["kind"] == "phase":
+            phases.setdefault(rec["name"], []).append(rec["duration"])
+        elif rec["kind"] == "rule":
+            r = rules.setdefault(rec["name"], {"durations": [], "srcs": [],
+                                               "bytes": [],
+                                               "pattern": rec.get("pattern")})
+            r["durations"].append(rec["duration"])
+            r["srcs"].append(rec.get("srcs", 0))
+            r["bytes"].append(rec.get("bytes", 0))
+
+    def stats(durations):
+        res = {"count": len(durations), "max": max(durations)}
+        for p in PERCENTILES:
+            res[f"p{p}"] = percentile(durations, p)
+        return res
+
+    summary = {"containers": len(containers), "phases": {}, "rules": {}}
+    for name, durations in phases.items():
+        summary["phases"][name] = stats(durations)
+    for name, r in rules.items():
+        summary["rules"][name] = stats(r["durations"])
+        summary["rules"][name]["srcs"] = max(r["srcs"])
+        summary["rules"][name]["mean_bytes"] = \
+            sum(r["bytes"]) / len(r["bytes"])
+        summary["rules"][name]["pattern"] = r["pattern"]
+    return summary
+
+
+def _row(name, st, width, extra=""):
+    cols = " ".join(f"{st[f'p{p}'] * 1000:>9.1f}" for p in PERCENTILES)
+    return (f"{name:<{width}} {st['count']:>6}{extra} {cols} "
+            f"{st['max'] * 1000:>9.1f}")
+
+
+def format_report(summary):
+    """
+    Format a summary as percentile tables (in milliseconds) of the hook
+    phases and of the module rules with their source patterns, slowest
+    rules first.
+    """
+    pcols = " ".join(f"{f'P{p} (ms)':>9}" for p in PERCENTILES)
+    lines = [f"Containers: {summary['containers']}", ""]
+    # Keep the order the hook runs the phases in
+    order = ["plan", "setns", "actions", "ldcache", "ldconfig", "total"]
+    phases = sorted(summary["phases"].items(),
+                    key=lambda i: (order.index(i[0]) if i[0] in order
+                                   else len(order), i[0]))
+    lines.append(f"{'PHASE':<12} {'COUNT':>6} {pcols} {'MAX (ms)':>9}")
+    for name, st in phases:
+        lines.append(_row(name, st, 12))
+    if summary["rules"]:
+        width = max(24, max(len(n) for n in summary["rules"]))
+        lines.append("")
+        lines.append(f"{'RULE':<{width}} {'COUNT':>6} {'SRCS':>6} "
+                     f"{'MiB':>8} {pcols} {'MAX (ms)':>9}  PATTERN")
+        rules = sorted(summary["rules"].items(),
+                       key=lambda i: -i[1]["p50"])
+        for name, st in rules:
+            extra = f" {st['srcs']:>6} {st['mean_bytes'] / 2**20:>8.1f}"
+            line = _row(name, st, width, extra)
+            if st.get("pattern"):
+                line += f"  {st['pattern']}"
+            lines.append(line)
+    return "\n".join(lines)
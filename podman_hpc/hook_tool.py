@@ -9,9 +9,46 @@ import json
 import yaml
 import shutil
 import re
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob, iglob
+from podman_hpc.trace import Tracer
 
 _MOD_ENV = "PODMANHPC_MODULES_DIR"
+_CACHE_ENV = "PODMANHPC_HOOK_CACHE"
+_JOBS_ENV = "PODMANHPC_HOOK_JOBS"
+_TIMING_ENV = "PODMANHPC_HOOK_TIMING"
+PLAN_VERSION = 5
+# Where assembled modules mount their staging directories in the container
+_HOST_DIR = "/opt/udiImage/host"
+# Rule types of a module
+_RULES = ["copy", "bind"]
+_GLOB_CHARS = re.compile(r"[*?[]")
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_REMOUNT = 32
+MS_NOATIME = 1024
+MS_NODIRATIME = 2048
+MS_BIND = 4096
+MS_REC = 16384
+MS_PRIVATE = 1 << 18
+MS_RELATIME = 1 << 21
+MNT_DETACH = 2
+# statvfs flags of a mount, the mount flags and mount options they map to.
+# A remount in a user namespace has to keep these or it fails with EPERM.
+_LOCKED_FLAGS = [
+    (os.ST_RDONLY, MS_RDONLY, "ro"),
+    (os.ST_NOSUID, MS_NOSUID, "nosuid"),
+    (os.ST_NODEV, MS_NODEV, "nodev"),
+    (os.ST_NOEXEC, MS_NOEXEC, "noexec"),
+    (os.ST_NOATIME, MS_NOATIME, "noatime"),
+    (os.ST_NODIRATIME, MS_NODIRATIME, "nodiratime"),
+    (os.ST_RELATIME, MS_RELATIME, "relatime"),
+]
 
 _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
 _libc.mount.argtypes = (
@@ -22,9 +59,17 @@ _libc.mount.argtypes = (
     ctypes.c_char_p,
 )
 logger = None
+# Set to use the mount binary for bind mounts (e.g. to compare timings)
+_mount_binary = False
+# Worker threads of run_plan collect their log lines here
+_local = threading.local()
 
 
 def log(msg):
+    buf = getattr(_local, "buf", None)
+    if buf is not None:
+        buf.append(msg)
+        return
     if logger:
         logger.write(f"{msg}\n")
 
@@ -41,18 +86,82 @@ def setns(pid, ns):
         raise OSError(e, errno.errorcode[e])
 
 
+def mount(src, tgt, fstype=None, flags=0, data=None):
+    """
+    Call mount(2) directly.  Raises an OSError on failure.
+    """
+    def enc(s):
+        return s.encode() if s is not None else None
+
+    if _libc.mount(enc(src), enc(tgt), enc(fstype), flags, enc(data)) == -1:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), tgt)
+
+
 def bind_mount(src, tgt):
     """
     bind mount a file into a namespace.
+
+    This uses mount(2) to avoid a fork/exec per mount and falls back to
+    the mount binary if the call fails.
     """
     # Create mount point
     if os.path.isdir(src) and not os.path.exists(tgt):
         os.makedirs(tgt)
     elif not os.path.exists(tgt):
         open(tgt, "w").close()
+    if not _mount_binary:
+        try:
+            mount(src, tgt, None, MS_BIND | MS_REC)
+            return
+        except OSError as ex:
+            log(f"\t\tmount(2) of {src} failed: {ex}, trying mount binary")
     subprocess.check_output(["mount", "--rbind", src, tgt])
 
 
+def locked_flags(tgt):
+    """
+    Returns the mount flags and mount options of the mount at tgt that a
+    remount has to keep.
+    """
+    f_flag = os.statvfs(tgt).f_flag
+    flags = 0
+    opts = []
+    for st, ms, opt in _LOCKED_FLAGS:
+        if f_flag & st:
+            flags |= ms
+            opts.append(opt)
+    return flags, opts
+
+
+def ro_bind_mount(src, tgt):
+    """
+    bind mount a directory read-only.
+
+    The bind is remounted read-only keeping the flags of the mount it
+    came from (nosuid, nodev, ...), which are locked in a user namespace.
+    Raises an OSError if the remount fails.
+    """
+    bind_mount(src, tgt)
+    flags, opts = locked_flags(tgt)
+    if not _mount_binary:
+        try:
+            mount(None, tgt, None, MS_BIND | MS_REMOUNT | MS_RDONLY | flags)
+            return
+        except OSError as ex:
+            log(f"\t\tread-only remount of {tgt} failed: {ex}, trying "
+                "mount binary")
+    opts = ",".join(["remount", "bind", "ro"] +
+                    [o for o in opts if o != "ro"])
+    try:
+        subprocess.check_output(["mount", "-o", opts, tgt],
+                                stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as ex:
+        log(f"\t\tmount -o {opts} {tgt} failed: "
+            f"{(ex.output or b'').decode().strip()}")
+        raise OSError(f"Unable to remount {tgt} read-only") from ex
+
+
 def copy(src, tgt, symlinks=True):
     if os.path.isdir(src):
         shutil.copytree(
@@ -67,27 +176,132 @@ def copy(src, tgt, symlinks=True):
 
 
 def ldconfig():
+    """
+    Run ldconfig in the current root.  Returns True if it succeeded.
+    """
     if not os.path.exists("/sbin/ldconfig"):
-        return
+        return False
     ret = "unknown"
+    start = time.time()
     try:
         ret = subprocess.check_output(["/sbin/ldconfig"])
     except subprocess.CalledProcessError:
         log(f"ldconfig failed: {ret}")
+        return False
+    log(f"ldconfig took {time.time() - start:.3f}s")
+    return True
 
 
-def resolve_src_and_dest(rule, root_path, modulesd=os.path.abspath("")):
-    # extract source and destination patterns from the rule
-    rs, rd = (rule + ":").split(":")[:2]
+def image_id(cid, bundle="."):
+    """
+    Look up the image ID of a container in the containers.json of the
+    podman store the bundle directory belongs to
+    (<graph root>/overlay-containers/<id>/userdata).
+    """
+    fn = os.path.join(bundle, "..", "..", "containers.json")
+    try:
+        with open(fn) as f:
+            recs = json.load(f)
+    except (OSError, ValueError):
+        return None
+    for rec in recs:
+        if rec.get("id") == cid:
+            return rec.get("image")
+    return None
 
-    # expand vars
-    rs = os.path.expanduser(os.path.expandvars(rs))
-    rd = os.path.expanduser(os.path.expandvars(rd))
 
+def ldcache_key(img, plan, rp):
+    """
+    Returns the key of the ld.so.cache of a container: the image, the
+    module plan (including the modification times of its sources) and
+    the linker configuration in the container root.
+    """
+    h = hashlib.sha256(img.encode())
+    h.update(json.dumps([plan["actions"], plan["deps"]]).encode())
+    for act in plan["actions"]:
+        h.update(str(_mtime(act[2])).encode())
+    for fn in [os.path.join(rp, "etc", "ld.so.conf")] + \
+            sorted(glob(os.path.join(rp, "etc", "ld.so.conf.d", "*"))):
+        h.update(fn.encode())
+        try:
+            with open(fn, "rb") as f:
+                h.update(f.read())
+        except OSError:
+            pass
+    return h.hexdigest()
+
+
+def install_ldcache(cache_dir, key, rp):
+    """
+    Install a cached ld.so.cache into a container root.  Returns False
+    if there is no cached copy.
+    """
+    cached = os.path.join(cache_dir, "ld.so.cache", key)
+    if not os.path.exists(cached):
+        return False
+    tgt = os.path.join(rp, "etc", "ld.so.cache")
+    tmp = f"{tgt}.{os.getpid()}"
+    try:
+        shutil.copyfile(cached, tmp)
+        os.rename(tmp, tgt)
+    except OSError as ex:
+        log(f"Unable to install cached ld.so.cache: {ex}")
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return False
+    return True
+
+
+def open_ldcache_dir(cache_dir):
+    """
+    Open the ld.so.cache cache directory so it can still be written to
+    after the chroot into the container.
+    """
+    pth = os.path.join(cache_dir, "ld.so.cache")
+    try:
+        os.makedirs(pth, exist_ok=True)
+        return os.open(pth, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError as ex:
+        log(f"Unable to open ld.so.cache cache: {ex}")
+        return None
+
+
+def save_ldcache(dir_fd, key, src="/etc/ld.so.cache"):
+    """
+    Save the ld.so.cache generated by ldconfig into the cache directory.
+    """
+    tmp = f"{key}.{os.getpid()}"
+    try:
+        with open(src, "rb") as f:
+            data = f.read()
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644,
+                     dir_fd=dir_fd)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp, key, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    except OSError as ex:
+        log(f"Unable to save ld.so.cache: {ex}")
+
+
+def _src_pattern(rule, modulesd):
+    """
+    Returns the absolute source pattern of a rule.
+    """
+    rs = (rule + ":").split(":")[0]
+    rs = os.path.expanduser(os.path.expandvars(rs))
     # ensure source pattern is absolute path
     if not os.path.isabs(rs):
         rs = os.path.join(modulesd, rs)
-    rs = os.path.abspath(os.path.expanduser(os.path.expandvars(rs)))
+    return os.path.abspath(os.path.expanduser(os.path.expandvars(rs)))
+
+
+def resolve_src_and_dest(rule, root_path, modulesd=os.path.abspath("")):
+    # extract source and destination patterns from the rule
+    rd = (rule + ":").split(":")[1]
+
+    # expand vars
+    rs = _src_pattern(rule, modulesd)
+    rd = os.path.expanduser(os.path.expandvars(rd))
 
     # error checks
     if not os.path.isabs(rd):
@@ -139,22 +353,451 @@ def resolve_src_and_dest(rule, root_path, modulesd=os.path.abspath("")):
     return {src: os.path.normpath(dest(src)) for src in iglob(rs)}
 
 
+def link(src, tgt):
+    """
+    Replace the target with a symlink to src (a path in the container).
+    """
+    if os.path.lexists(tgt):
+        if os.path.isdir(tgt) and not os.path.islink(tgt):
+            raise IsADirectoryError(errno.EISDIR, "Is a directory", tgt)
+        os.unlink(tgt)
+    os.symlink(src, tgt)
+
+
+def link_tree(src, tgt, entries, rp="/"):
+    """
+    Make the files of a staged directory appear at tgt.  If tgt doesn't
+    exist in the container it becomes a single symlink to src (a path in
+    the container).  Otherwise each entry gets a symlink, and an entry
+    that can't be linked (e.g. a directory is in the way) falls back to
+    its original copy or bind.  Nothing is done if a parent directory is
+    already a symlink into a staging directory.
+
+    Inputs:
+    src: staged directory in the container
+    tgt: target directory on the host side
+    entries: list of [name, action, original source]
+    rp: container root path
+    """
+    d = tgt
+    while len(d) > len(rp.rstrip("/")) + 1:
+        d = os.path.dirname(d)
+        if os.path.islink(d) and os.readlink(d).startswith(_HOST_DIR):
+            return
+    if not os.path.lexists(tgt):
+        os.makedirs(os.path.dirname(tgt), exist_ok=True)
+        os.symlink(src, tgt)
+        return
+    for name, a, orig in entries:
+        try:
+            link(os.path.join(src, name), os.path.join(tgt, name))
+        except OSError as ex:
+            log(f"\t\tlink of {name} failed: {ex}, {a} {orig}")
+            _ACTIONS[a](orig, os.path.join(tgt, name))
+
+
+_ACTIONS = {"copy": copy, "bind": bind_mount, "robind": ro_bind_mount,
+            "link": link}
+
+
 def do_plugin(rp, mod, modulesd):
     """
     set up to do copies and bind mounts
     handle wildcards appropriately
     """
     log(f"Module: {mod}")
+    actions, _ = plan_module(mod, modulesd)
+    run_plan(rp, {"actions": actions})
 
-    actions = {"copy": copy, "bind": bind_mount}
 
-    for a in actions:
-        for rule in mod.get(a) or []:
+def _mtime(pth):
+    try:
+        return os.stat(pth).st_mtime_ns
+    except OSError:
+        return None
+
+
+def plan_module(mod, modulesd):
+    """
+    Resolve the copy and bind rules of a module.  Returns a list of
+    [module, action, source, destination, rule] with destinations
+    relative to the container root, and the set of host directories the
+    glob expansion depends on.  rule is [key, source pattern] of the
+    module rule the action comes from, with keys like "bind[2]" (the
+    third bind rule).
+    """
+    actions = []
+    deps = set()
+    for a in _RULES:
+        for i, rule in enumerate(mod.get(a) or []):
             log(f"\t{rule}")
-            for src, tgt in resolve_src_and_dest(rule, rp, modulesd).items():
-                os.makedirs(os.path.dirname(tgt), exist_ok=True)
-                log(f"\t\t{a}: {src} to {tgt}")
-                actions[a](src, tgt)
+            rs = _src_pattern(rule, modulesd)
+            m = _GLOB_CHARS.search(rs)
+            deps.add(os.path.dirname(rs[:m.start()] if m else rs))
+            for src, dst in resolve_src_and_dest(rule, "/",
+                                                 modulesd).items():
+                deps.add(os.path.dirname(src))
+                actions.append([mod.get("name"), a, src, dst,
+                                [f"{a}[{i}]", rs]])
+    return actions, deps
+
+
+def _stage(src, tgt, allow_copy=True):
+    """
+    Put a file or directory into a staging directory.  Files are
+    hardlinked.  If that fails (another filesystem, or a file of another
+    user with fs.protected_hardlinks) the file is copied if allow_copy is
+    set and the OSError is raised otherwise.
+    """
+    os.makedirs(os.path.dirname(tgt), exist_ok=True)
+    if os.path.isdir(src):
+        shutil.copytree(src, tgt, symlinks=True)
+        return
+    try:
+        os.link(src, tgt)
+    except OSError:
+        if not allow_copy:
+            raise
+        shutil.copy2(src, tgt)
+
+
+def assemble_module(name, actions, cache_dir):
+    """
+    Stage the files a module copies or binds into one directory and
+    mount that instead.  The selected files are hardlinked under
+    <cache_dir>/assembled/<module>-<key> at their destination
+    paths, once per node since the key covers the actions and the
+    modification times of their sources.  The plan then has one
+    read-only bind of the staging directory to /opt/udiImage/host/
+    <module> and a link_tree action per destination directory.
+    Directory and device binds are kept as they are, and so is any file
+    that can't be staged.  Bind sources are never copied, so a file that
+    can't be hardlinked keeps its bind; copy sources are copied instead.
+    The staging actions are timed as the
+    "assemble" rule of the module.
+    """
+    h = hashlib.sha256(json.dumps(actions).encode())
+    for act in actions:
+        h.update(str(_mtime(act[2])).encode())
+    stage = os.path.join(cache_dir, "assembled",
+                         f"{name}-{h.hexdigest()[:16]}")
+    host = os.path.join(_HOST_DIR, name)
+    staged = os.path.exists(stage)
+    tmp = f"{stage}.tmp-{os.getpid()}"
+    res = []
+    dirs = {}
+    for act in actions:
+        mod, a, src, dst = act[:4]
+        if a == "bind" and not os.path.isfile(src):
+            res.append(act)
+            continue
+        if not staged:
+            try:
+                _stage(src, os.path.join(tmp, dst[1:]),
+                       allow_copy=a == "copy")
+            except (OSError, shutil.Error) as ex:
+                log(f"\tUnable to stage {src}, keeping the {a}: {ex}")
+                res.append(act)
+                continue
+        elif not os.path.lexists(os.path.join(stage, dst[1:])):
+            res.append(act)
+            continue
+        d = os.path.dirname(dst)
+        dirs.setdefault(d, []).append([os.path.basename(dst), a, src])
+    if not staged and os.path.exists(tmp):
+        try:
+            os.rename(tmp, stage)
+        except OSError:
+            # Another hook staged it first
+            shutil.rmtree(tmp, ignore_errors=True)
+    if not dirs:
+        return res
+    rule = ["assemble", stage]
+    trees = [[name, "robind", stage, host, rule]]
+    for d in sorted(dirs):
+        trees.append([name, "link_tree", os.path.join(host, d[1:]), d,
+                      rule, dirs[d]])
+    return trees + res
+
+
+def group_actions(actions):
+    """
+    Split the actions of a plan into groups that can run concurrently.
+    Actions whose destinations are the same or nested (e.g. a copy into
+    a directory that is later bind mounted over) end up in one group and
+    keep their plan order.  Returns lists of action indexes ordered by
+    their first action.
+    """
+    parent = list(range(len(actions)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        parent[find(i)] = find(j)
+
+    owner = {}
+    below = {}
+    for i, act in enumerate(actions):
+        dst = os.path.normpath(act[3])
+        if dst in owner:
+            union(i, owner[dst])
+        for j in below.get(dst, []):
+            union(i, j)
+        d = dst
+        while d != "/":
+            d = os.path.dirname(d)
+            if d in owner:
+                union(i, owner[d])
+            below.setdefault(d, []).append(i)
+        owner.setdefault(dst, i)
+    groups = {}
+    for i in range(len(actions)):
+        groups.setdefault(find(i), []).append(i)
+    return sorted(groups.values())
+
+
+def build_plan(confs, enabled, modulesd, cache_dir=None):
+    """
+    Compile the enabled modules into a mount plan.  The plan records the
+    modification times of the host directories its globs were expanded
+    in, so changes on the host invalidate it.
+
+    Modules with "assemble: true" use assemble_module to replace their
+    per file copies and bind mounts with a staging directory in
+    cache_dir.  The actions are grouped with group_actions so the
+    grouping is cached with the plan.
+    """
+    plan = {"modules": enabled, "actions": [], "deps": {}}
+    deps = set()
+    for m in enabled:
+        log(f"Loading {m}")
+        actions, mdeps = plan_module(confs[m], modulesd)
+        if confs[m].get("assemble") and cache_dir:
+            actions = assemble_module(m, actions, cache_dir)
+        elif confs[m].get("assemble"):
+            log(f"No hook cache directory, not assembling {m}")
+        plan["actions"].extend(actions)
+        deps |= mdeps
+    plan["deps"] = {d: _mtime(d) for d in sorted(deps)}
+    plan["groups"] = group_actions(plan["actions"])
+    return plan
+
+
+def plan_valid(plan):
+    return all(_mtime(d) == t for d, t in plan["deps"].items())
+
+
+def _copied_bytes(src):
+    try:
+        if not os.path.isdir(src):
+            return os.path.getsize(src)
+        return sum(os.path.getsize(os.path.join(d, f))
+                   for d, _, files in os.walk(src) for f in files)
+    except OSError:
+        return 0
+
+
+def _run_action(rp, act):
+    mod, a, src, dst = act[:4]
+    tgt = os.path.join(rp, dst[1:])
+    log(f"\t\t{a}: {src} to {tgt}")
+    if a == "link_tree":
+        link_tree(src, tgt, act[5], rp)
+        return
+    os.makedirs(os.path.dirname(tgt), exist_ok=True)
+    _ACTIONS[a](src, tgt)
+
+
+def _apply(rp, act, stats, i):
+    start = time.time()
+    _run_action(rp, act)
+    if stats is not None:
+        size = _copied_bytes(act[2]) if act[1] == "copy" else 0
+        stats[i] = (time.time() - start, size)
+
+
+def run_plan(rp, plan, jobs=1, stats=None):
+    """
+    Replay the copies and bind mounts of a plan into a container root.
+
+    With more than one job the action groups of the plan run in a
+    thread pool.  The threads have to be started after setns and chroot
+    so they share the container mount namespace.  Log lines are written
+    in plan order once every group is done, and the first failing action
+    in plan order is raised.
+
+    Inputs:
+    rp: container root path
+    plan: plan from get_plan
+    jobs: number of action groups to run concurrently
+    stats: optional list, as long as the actions, that gets the duration
+           and the bytes copied of every action
+    """
+    actions = plan["actions"]
+    groups = plan.get("groups") or group_actions(actions)
+    if jobs <= 1 or len(groups) < 2:
+        for i, act in enumerate(actions):
+            _apply(rp, act, stats, i)
+        return
+    out = [None] * len(actions)
+
+    def run_group(group):
+        for i in group:
+            _local.buf = []
+            try:
+                _apply(rp, actions[i], stats, i)
+                out[i] = (_local.buf, None)
+            except (OSError, shutil.Error,
+                    subprocess.CalledProcessError) as ex:
+                # Later actions of the group depend on this one
+                out[i] = (_local.buf, ex)
+                return
+            finally:
+                _local.buf = None
+
+    def run_groups(chunk):
+        for group in chunk:
+            run_group(group)
+
+    # One chunk of groups per thread keeps the overhead per action low
+    jobs = min(jobs, len(groups))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        list(pool.map(run_groups, [groups[i::jobs] for i in range(jobs)]))
+    first = None
+    for res in out:
+        if res is None:
+            continue
+        lines, ex = res
+        for line in lines:
+            log(line)
+        if ex is not None and first is None:
+            first = ex
+    if first is not None:
+        raise first
+
+
+def rule_records(plan, stats):
+    """
+    Sum up the action timings of run_plan per module rule (e.g.
+    "gpu:bind[2]").  Returns timing records with the rule, its source
+    pattern, the number of sources, the bytes copied and the total
+    duration, in plan order.
+    """
+    res = {}
+    for act, st in zip(plan["actions"], stats):
+        if st is None:
+            continue
+        key, pattern = act[4] if len(act) > 4 else (act[1], "")
+        name = f"{act[0]}:{key}"
+        if name not in res:
+            res[name] = {"kind": "rule", "name": name, "module": act[0],
+                         "action": act[1], "rule": key,
+                         "pattern": pattern, "srcs": 0, "bytes": 0,
+                         "duration": 0.0}
+        rec = res[name]
+        rec["srcs"] += 1
+        rec["bytes"] += st[1]
+        rec["duration"] += st[0]
+    for rec in res.values():
+        rec["duration"] = round(rec["duration"], 6)
+    return list(res.values())
+
+
+def open_timing(fn):
+    """
+    Open the timing sink of the hook for appending.  Returns None (and
+    logs why) if it can't be opened.
+    """
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(fn)), exist_ok=True)
+        return os.open(fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    except OSError as ex:
+        log(f"Unable to open timing file {fn}: {ex}")
+        return None
+
+
+def write_timing(fd, records, **common):
+    """
+    Append timing records as JSON lines.  They are written with a single
+    write so the records of concurrent hooks don't interleave.
+    """
+    data = "".join(json.dumps(dict(common, **rec)) + "\n"
+                   for rec in records)
+    try:
+        os.write(fd, data.encode())
+    except OSError as ex:
+        log(f"Unable to write timing records: {ex}")
+    finally:
+        os.close(fd)
+
+
+def _load_cache(cache_file, conf_key):
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get("version") != PLAN_VERSION or \
+       cache.get("conf_key") != conf_key:
+        return None
+    return cache
+
+
+def _save_cache(cache_file, cache):
+    tmp = f"{cache_file}.{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.rename(tmp, cache_file)
+    except OSError as ex:
+        log(f"Unable to save plan cache: {ex}")
+
+
+def get_plan(cf_env, modulesd, cache_dir=None):
+    """
+    Returns the mount plan for the modules enabled in the container
+    environment.  Plans are cached per modules directory in cache_dir,
+    keyed by the modification times of the module files, so a container
+    start only has to stat files instead of reading every module and
+    expanding its globs.
+
+    Inputs:
+    cf_env: container environment
+    modulesd: modules directory
+    cache_dir: plan cache directory (None to disable the cache)
+    """
+    conf_key = {fn: _mtime(fn) for fn in sorted(glob(f"{modulesd}/*.yaml"))}
+    cache_file = None
+    cache = None
+    if cache_dir:
+        name = hashlib.sha1(os.path.abspath(modulesd).encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, f"plan-{name[:16]}.json")
+        cache = _load_cache(cache_file, conf_key)
+    confs = None
+    if cache is None:
+        confs = read_confs(modulesd)
+        log(json.dumps(confs, indent=2))
+        cache = {"version": PLAN_VERSION, "conf_key": conf_key,
+                 "envs": {m: c["env"] for m, c in confs.items()},
+                 "plans": {}}
+    enabled = sorted(m for m, env in cache["envs"].items() if env in cf_env)
+    key = ",".join(enabled)
+    plan = cache["plans"].get(key)
+    if plan and plan_valid(plan):
+        log(f"Using cached plan for {key}")
+        return plan
+    if confs is None:
+        confs = read_confs(modulesd)
+    plan = build_plan(confs, enabled, modulesd, cache_dir)
+    if cache_file:
+        cache["plans"][key] = plan
+        _save_cache(cache_file, cache)
+    return plan
 
 
 def read_confs(mdir):
@@ -168,6 +811,7 @@ def read_confs(mdir):
 def main():
     global logger
 
+    start = time.time()
     inp = json.load(sys.stdin)
     pid = inp["pid"]
     cf = json.load(open("config.json"))
@@ -181,7 +825,6 @@ def main():
     plug_conf_fn = cf_env.get(
         _MOD_ENV, f"{sys.prefix}/etc/podman_hpc/modules.d"
     )
-    plug_conf = read_confs(plug_conf_fn)
 
     lf = cf_env.get("LOG_PLUGIN")
     if lf:
@@ -190,19 +833,63 @@ def main():
     log(json.dumps(inp, indent=2))
     log("config.json")
     log(json.dumps(cf, indent=2))
+    # The timing sink and the trace are on the host, open them before
+    # entering the container
+    timing_fd = None
+    if cf_env.get(_TIMING_ENV):
+        timing_fd = open_timing(cf_env[_TIMING_ENV])
+    tracer = Tracer("hook", cf_env)
+    records = []
+
+    def phase(name, since):
+        now = time.time()
+        records.append({"kind": "phase", "name": name,
+                        "duration": round(now - since, 6)})
+        tracer.add(name, since, now, container=inp.get("id"))
+        return time.time()
+
     rp = cf["root"]["path"]
+    cache_dir = cf_env.get(_CACHE_ENV)
+    t = time.time()
+    plan = get_plan(cf_env, plug_conf_fn, cache_dir)
+    img = image_id(inp.get("id")) if cache_dir else None
+    t = phase("plan", t)
+
+    try:
+        jobs = int(cf_env.get(_JOBS_ENV, 1))
+    except ValueError:
+        jobs = 1
 
     setns(pid, "mnt")
     os.chroot("/")
-    log(json.dumps(plug_conf, indent=2))
-    for m in plug_conf:
-        if plug_conf[m]["env"] in cf_env:
-            log(f"Loading {m}")
-            do_plugin(rp, plug_conf[m], plug_conf_fn)
-    ret = os.chroot(rp)
-    log(f"chroot return: {ret}")
-
-    ldconfig()
+    t = phase("setns", t)
+    stats = [None] * len(plan["actions"]) if timing_fd is not None \
+        else None
+    run_plan(rp, plan, jobs, stats)
+    t = phase("actions", t)
+    # Reuse the ld.so.cache of an earlier container with the same image
+    # and modules instead of running ldconfig
+    key = ldcache_key(img, plan, rp) if img else None
+    if key and install_ldcache(cache_dir, key, rp):
+        log(f"Using cached ld.so.cache {key}")
+        os.chroot(rp)
+        phase("ldcache", t)
+    else:
+        dir_fd = open_ldcache_dir(cache_dir) if key else None
+        ret = os.chroot(rp)
+        log(f"chroot return: {ret}")
+
+        if ldconfig() and dir_fd is not None:
+            save_ldcache(dir_fd, key)
+        if dir_fd is not None:
+            os.close(dir_fd)
+        phase("ldconfig", t)
+    phase("total", start)
+    tracer.close()
+    if timing_fd is not None:
+        write_timing(timing_fd, records + rule_records(plan, stats),
+                     container=inp.get("id"), start=round(start, 3),
+                     modules=plan["modules"])
 
 
 if __name__ == "__main__":
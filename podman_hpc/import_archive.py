@@ -0,0 +1,655 @@
+import os
+import sys
+import io
+import bz2
+import gzip
+import lzma
+import json
+import base64
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import time
+import logging
+from subprocess import Popen, PIPE
+from .migrate2scratch import MigrateUtils, ImageStore, ImageLock
+from .migrate2scratch import publish_file, squash_file_ok
+from .migrate2scratch import write_checksum
+from .squash_index import build_index, write_index, index_filename
+
+# Archive members up to this size are read into memory and checked for
+# JSON (manifests, configs, index).  Anything else is treated as a layer.
+BLOB_MAX = 4 << 20
+COPY_SIZE = 1 << 20
+
+DOCKER_MANIFEST = "application/vnd.docker.distribution.manifest.v2+json"
+DOCKER_CONFIG = "application/vnd.docker.container.image.v1+json"
+DOCKER_LAYER = "application/vnd.docker.image.rootfs.diff.tar"
+# Compression constants used by containers/storage in layers.json
+COMPRESSION = {None: 0, "bzip2": 1, "gzip": 2, "xz": 3}
+
+
+def sha256_digest(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def chain_ids(diff_ids):
+    """
+    Returns the layer (chain) IDs used by containers/storage for a list
+    of layer diff IDs.
+    """
+    ids = []
+    chain = None
+    for diff_id in diff_ids:
+        if chain is None:
+            chain = diff_id
+        else:
+            chain = sha256_digest(f"{chain} {diff_id}".encode())
+        ids.append(chain.split(":", 1)[1])
+    return ids
+
+
+def normalize_name(name):
+    """
+    Returns the fully qualified form of an image name
+    (e.g. alpine:3 -> docker.io/library/alpine:3).
+    """
+    first = name.split("/", 1)[0]
+    if "/" not in name or ("." not in first and ":" not in first and
+                           first != "localhost"):
+        if "/" not in name:
+            name = f"library/{name}"
+        name = f"docker.io/{name}"
+    if ":" not in name.rsplit("/", 1)[-1] and "@" not in name:
+        name = f"{name}:latest"
+    return name
+
+
+def new_link():
+    """
+    Returns a random overlay link name in the containers/storage style.
+    """
+    return base64.b32encode(os.urandom(16)).decode().rstrip("=")
+
+
+class _HashReader:
+    """
+    File-like wrapper that hashes and counts the bytes read through it.
+    Bytes that were peeked at (e.g. a compression magic) can be pushed
+    back with a prefix.
+    """
+
+    def __init__(self, fobj, prefix=b""):
+        self.fobj = fobj
+        self.prefix = prefix
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, n=-1):
+        if self.prefix:
+            if n is None or n < 0:
+                buf = self.prefix + self.fobj.read()
+            else:
+                buf = self.prefix[:n]
+                if len(buf) < n:
+                    buf += self.fobj.read(n - len(buf))
+                self.prefix = self.prefix[len(buf):]
+            if n is None or n < 0:
+                self.prefix = b""
+        else:
+            buf = self.fobj.read(n)
+        self.hash.update(buf)
+        self.size += len(buf)
+        return buf
+
+    def drain(self):
+        while self.read(COPY_SIZE):
+            pass
+
+    def digest(self):
+        return "sha256:" + self.hash.hexdigest()
+
+
+class ArchiveImporter:
+    """
+    Class to import a docker-archive (docker save) or OCI layout tarball
+    straight into a squash image store, without podman.
+
+    The archive is read once as a stream.  Manifests and configs are kept
+    in memory and each layer is extracted into its own directory in the
+    staging area as it goes by.  Once the whole archive has been read the
+    layers are applied in order (honoring whiteouts) into a root
+    filesystem tree, which is squashed with mksquashfs.  File ownership
+    and modes from the layers are passed to mksquashfs in a pseudo file
+    since the extracted files belong to the user.
+
+    Note: tar-split files aren't generated, so the imported images can
+    be run but not pushed or saved by podman.
+    """
+
+    def __init__(self, conf=None, dst=None, profile=None):
+        """
+        Inputs:
+        conf: a podman_hpc config object
+        dst: base directory of the destination image store
+        profile: name of the squash profile to use
+        """
+        self.mu = MigrateUtils(dst=dst, conf=conf, profile=profile)
+        self.dst_dir = self.mu.dst_dir or os.environ["SQUASH_DIR"]
+        self.dst = None
+        self.blobs = {}
+        self.aliases = {}
+        self.layers = {}
+        self.stage = None
+
+    # Reading the archive ##################################################
+    def _safe_path(self, root, name):
+        """
+        Returns the path of an archive entry under root or None if the
+        entry would land outside of it.
+        """
+        parts = [p for p in name.split("/") if p not in ("", ".")]
+        if not parts or ".." in parts:
+            return None
+        pth = os.path.join(root, *parts)
+        parent = os.path.realpath(os.path.dirname(pth))
+        if parent != root and not parent.startswith(root + os.sep):
+            return None
+        return pth
+
+    @staticmethod
+    def _remove(pth):
+        if os.path.isdir(pth) and not os.path.islink(pth):
+            shutil.rmtree(pth)
+        elif os.path.lexists(pth):
+            os.unlink(pth)
+
+    def _extract_member(self, tf, m, root, info):
+        pth = self._safe_path(root, m.name)
+        if pth is None:
+            if m.name.strip("./"):
+                logging.warning(f"Skipping unsafe path {m.name}")
+            return
+        rel = os.path.relpath(pth, root)
+        os.makedirs(os.path.dirname(pth), mode=0o700, exist_ok=True)
+        if m.isdir():
+            if not os.path.isdir(pth) or os.path.islink(pth):
+                self._remove(pth)
+                os.mkdir(pth, 0o700)
+            os.chmod(pth, (m.mode & 0o777) | 0o700)
+        elif m.isreg():
+            self._remove(pth)
+            with open(pth, "wb") as f:
+                shutil.copyfileobj(tf.extractfile(m), f, COPY_SIZE)
+            os.chmod(pth, (m.mode & 0o777) | 0o600)
+            os.utime(pth, (m.mtime, m.mtime))
+        elif m.issym():
+            self._remove(pth)
+            os.symlink(m.linkname, pth)
+        elif m.islnk():
+            tgt = self._safe_path(root, m.linkname)
+            self._remove(pth)
+            try:
+                os.link(tgt or "", pth, follow_symlinks=False)
+            except OSError:
+                logging.warning(f"Unable to create hard link {m.name}")
+                return
+        elif m.ischr() or m.isblk() or m.isfifo():
+            self._remove(pth)
+            typ = "c" if m.ischr() else "b" if m.isblk() else "i"
+            info["devices"][rel] = (typ, m.mode & 0o7777, m.uid, m.gid,
+                                    m.devmajor, m.devminor)
+            return
+        else:
+            return
+        info["attrs"][rel] = (m.mode & 0o7777, m.uid, m.gid)
+        info["uidset"].add(m.uid)
+        info["gidset"].add(m.gid)
+
+    def _extract_layer(self, name, fobj):
+        """
+        Extract a (possibly compressed) layer tarball into the staging
+        area and record its digests.
+        """
+        magic = fobj.read(6)
+        raw = _HashReader(fobj, prefix=magic)
+        comp = None
+        if magic[:2] == b"\x1f\x8b":
+            comp = "gzip"
+        elif magic[:3] == b"BZh":
+            comp = "bzip2"
+        elif magic[:6] == b"\xfd7zXZ\x00":
+            comp = "xz"
+        elif magic[:4] == b"\x28\xb5\x2f\xfd":
+            raise ValueError(f"Layer {name} is zstd compressed, which "
+                             "is not supported")
+        if comp == "gzip":
+            data = gzip.GzipFile(fileobj=raw, mode="rb")
+        elif comp == "bzip2":
+            data = bz2.BZ2File(raw)
+        elif comp == "xz":
+            data = lzma.LZMAFile(raw)
+        else:
+            data = raw
+        diff = _HashReader(data)
+        os.makedirs(os.path.join(self.stage, "layers"), exist_ok=True)
+        root = tempfile.mkdtemp(dir=os.path.join(self.stage, "layers"))
+        info = {"dir": root, "compression": comp, "attrs": {},
+                "devices": {}, "uidset": set(), "gidset": set()}
+        with tarfile.open(fileobj=diff, mode="r|") as tf:
+            for m in tf:
+                self._extract_member(tf, m, root, info)
+        diff.drain()
+        raw.drain()
+        info["digest"] = raw.digest()
+        info["size"] = raw.size
+        info["diff_digest"] = diff.digest()
+        info["diff_size"] = diff.size
+        self.layers[name] = info
+        logging.debug(f"Extracted layer {name} ({info['diff_digest']})")
+
+    def read_archive(self, archive):
+        """
+        Stream through the archive once, keeping the small JSON blobs
+        and extracting the layers.
+
+        Inputs:
+        archive: path of the tarball ("-" for stdin)
+        """
+        if archive == "-":
+            tf = tarfile.open(fileobj=sys.stdin.buffer, mode="r|*")
+        else:
+            tf = tarfile.open(archive, mode="r|*")
+        with tf:
+            for m in tf:
+                name = os.path.normpath(m.name)
+                if m.issym():
+                    tgt = os.path.join(os.path.dirname(name), m.linkname)
+                    self.aliases[name] = os.path.normpath(tgt)
+                    continue
+                if m.islnk():
+                    self.aliases[name] = os.path.normpath(m.linkname)
+                    continue
+                if not m.isreg():
+                    continue
+                fobj = tf.extractfile(m)
+                if m.size <= BLOB_MAX:
+                    data = fobj.read()
+                    try:
+                        if isinstance(json.loads(data), (dict, list)):
+                            self.blobs[name] = data
+                            continue
+                    except ValueError:
+                        pass
+                    fobj = io.BytesIO(data)
+                try:
+                    self._extract_layer(name, fobj)
+                except (tarfile.TarError, OSError, EOFError) as ex:
+                    # Not every non-JSON member is a layer (e.g. VERSION)
+                    logging.debug(f"Skipping {name}: {ex}")
+
+    def _resolve(self, name):
+        name = os.path.normpath(name)
+        seen = set()
+        while name in self.aliases and name not in seen:
+            seen.add(name)
+            name = self.aliases[name]
+        return name
+
+    def _blob(self, name):
+        name = self._resolve(name)
+        if name not in self.blobs:
+            raise ValueError(f"{name} not found in the archive")
+        return self.blobs[name]
+
+    @staticmethod
+    def _digest_path(digest):
+        alg, hexd = digest.split(":", 1)
+        return f"blobs/{alg}/{hexd}"
+
+    def _oci_manifest(self, desc):
+        """
+        Resolve an OCI descriptor to an image manifest, picking the
+        linux/amd64 entry of a multi-platform index.
+        """
+        data = self._blob(self._digest_path(desc["digest"]))
+        manifest = json.loads(data)
+        if "manifests" not in manifest:
+            return manifest, data
+        entries = manifest["manifests"]
+        for ent in entries:
+            plat = ent.get("platform", {})
+            if plat.get("os") == "linux" and \
+               plat.get("architecture") == "amd64":
+                return self._oci_manifest(ent)
+        return self._oci_manifest(entries[0])
+
+    def get_images(self):
+        """
+        Returns a list of images in the archive, each a dictionary with
+        the config and manifest (raw bytes), the layer member names and
+        the image names.
+        """
+        images = []
+        if "manifest.json" in self.blobs:
+            for ent in json.loads(self.blobs["manifest.json"]):
+                config = self._blob(ent["Config"])
+                layers = [self._resolve(ln) for ln in ent["Layers"]]
+                names = [normalize_name(n) for n in ent.get("RepoTags") or []]
+                images.append({"config": config, "manifest": None,
+                               "layers": layers, "names": names})
+        elif "index.json" in self.blobs:
+            index = json.loads(self.blobs["index.json"])
+            for desc in index.get("manifests", []):
+                manifest, data = self._oci_manifest(desc)
+                config = self._blob(
+                    self._digest_path(manifest["config"]["digest"]))
+                layers = [self._resolve(self._digest_path(ld["digest"]))
+                          for ld in manifest["layers"]]
+                annot = desc.get("annotations", {})
+                ref = annot.get("io.containerd.image.name") or \
+                    annot.get("org.opencontainers.image.ref.name")
+                names = []
+                # A bare ref.name is just a tag
+                if ref and ("/" in ref or ":" in ref):
+                    names.append(normalize_name(ref))
+                images.append({"config": config, "manifest": data,
+                               "layers": layers, "names": names})
+        else:
+            raise ValueError("No manifest.json or index.json found. "
+                             "Is this a docker-archive or OCI archive?")
+        for img in images:
+            for ln in img["layers"]:
+                if ln not in self.layers:
+                    raise ValueError(f"Layer {ln} not found in the archive")
+        return images
+
+    # Building the root filesystem #########################################
+    def _apply_layer(self, info, rootfs, attrs, devices, keep):
+        """
+        Apply an extracted layer on top of rootfs.  Files are moved (or
+        hard linked if the layer is used again later) into place.
+        """
+        ldir = info["dir"]
+        for root, dirs, files in os.walk(ldir):
+            rel = os.path.relpath(root, ldir)
+            rel = "" if rel == "." else rel
+            tdir = os.path.join(rootfs, rel)
+            if ".wh..wh..opq" in files:
+                for fn in os.listdir(tdir):
+                    self._remove(os.path.join(tdir, fn))
+                for dev in [d for d in devices
+                            if not rel or d.startswith(rel + "/")]:
+                    devices.pop(dev)
+            for fn in files + dirs:
+                if fn.startswith(".wh.") and fn != ".wh..wh..opq":
+                    self._remove(os.path.join(tdir, fn[4:]))
+                    devices.pop(os.path.join(rel, fn[4:]), None)
+            subdirs = []
+            for fn in files + dirs:
+                if fn.startswith(".wh."):
+                    continue
+                src = os.path.join(root, fn)
+                tgt = os.path.join(tdir, fn)
+                key = os.path.join(rel, fn)
+                devices.pop(key, None)
+                if key in info["attrs"]:
+                    attrs[key] = info["attrs"][key]
+                if os.path.isdir(src) and not os.path.islink(src):
+                    if not os.path.isdir(tgt) or os.path.islink(tgt):
+                        self._remove(tgt)
+                        os.mkdir(tgt, 0o700)
+                    os.chmod(tgt, os.stat(src).st_mode & 0o7777)
+                    subdirs.append(fn)
+                    continue
+                self._remove(tgt)
+                if keep:
+                    os.link(src, tgt, follow_symlinks=False)
+                else:
+                    os.rename(src, tgt)
+            dirs[:] = subdirs
+        for key, dev in info["devices"].items():
+            devices[key] = dev
+
+    @staticmethod
+    def _pseudo_name(rel):
+        pth = "/" + rel.replace("\\", "\\\\").replace('"', '\\"')
+        return f'"{pth}"'
+
+    def _write_pseudo(self, rootfs, attrs, devices, fn):
+        """
+        Write a mksquashfs pseudo file that sets the ownership and mode
+        of every entry and creates the device nodes.
+        """
+        with open(fn, "w") as f:
+            f.write('"/" m 755 0 0\n')
+            for root, dirs, files in os.walk(rootfs):
+                for name in dirs + files:
+                    pth = os.path.join(root, name)
+                    rel = os.path.relpath(pth, rootfs)
+                    if "\n" in rel or os.path.islink(pth):
+                        continue
+                    # Parent directories without a tar entry get the
+                    # usual defaults, not the private mode they were
+                    # extracted with.  They are recorded for the index.
+                    mode, uid, gid = attrs.setdefault(rel, (0o755, 0, 0))
+                    f.write(f"{self._pseudo_name(rel)} m {mode:o} "
+                            f"{uid} {gid}\n")
+            for rel, (typ, mode, uid, gid, major, minor) in devices.items():
+                if os.path.lexists(os.path.join(rootfs, rel)) or \
+                   not os.path.isdir(os.path.dirname(
+                       os.path.join(rootfs, rel))):
+                    continue
+                name = self._pseudo_name(rel)
+                if typ == "i":
+                    f.write(f"{name} i {mode:o} {uid} {gid} f\n")
+                else:
+                    f.write(f"{name} {typ} {mode:o} {uid} {gid} "
+                            f"{major} {minor}\n")
+
+    def _run_mksq(self, rootfs, pseudo, out):
+        com = [self.mu.mksq_bin, rootfs, out, "-noappend", "-pf", pseudo]
+        com.extend(self.mu.get_mksq_options())
+        proc = Popen(com, stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            logging.error("Squash Failed")
+            logging.error(out.decode("utf-8"))
+            logging.error(err.decode("utf-8"))
+            return False
+        return True
+
+    # Writing the store ####################################################
+    @staticmethod
+    def _rfc3339(ts=None):
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts))
+
+    def _docker_manifest(self, config, layer_infos):
+        """
+        Synthesize a registry manifest for a docker-archive image.
+        """
+        manifest = {
+            "schemaVersion": 2,
+            "mediaType": DOCKER_MANIFEST,
+            "config": {"mediaType": DOCKER_CONFIG, "size": len(config),
+                       "digest": sha256_digest(config)},
+            "layers": [],
+        }
+        for info in layer_infos:
+            mtype = DOCKER_LAYER
+            if info["compression"] == "gzip":
+                mtype += ".gzip"
+            manifest["layers"].append({"mediaType": mtype,
+                                       "size": info["size"],
+                                       "digest": info["digest"]})
+        return json.dumps(manifest).encode()
+
+    def _write_image_dir(self, img_id, config, manifest):
+        mdig = sha256_digest(manifest)
+        items = {
+            f"sha256:{img_id}": config,
+            f"manifest-{mdig}": manifest,
+            "manifest": manifest,
+        }
+        dstd = os.path.join(self.dst.images_dir, img_id)
+        tmpd = f"{dstd}.tmp-{os.getpid()}"
+        if os.path.exists(tmpd):
+            shutil.rmtree(tmpd)
+        os.mkdir(tmpd)
+        for key, data in items.items():
+            fn = "=" + base64.b64encode(key.encode("utf-8")).decode("utf-8")
+            with open(os.path.join(tmpd, fn), "wb") as f:
+                f.write(data)
+        with open(os.path.join(tmpd, "manifest"), "wb") as f:
+            f.write(manifest)
+        if os.path.exists(dstd):
+            shutil.rmtree(dstd)
+        os.rename(tmpd, dstd)
+        return {
+            "digest": mdig,
+            "big-data-names": list(items),
+            "big-data-sizes": {k: len(v) for k, v in items.items()},
+            "big-data-digests": {k: sha256_digest(v)
+                                 for k, v in items.items()},
+        }
+
+    def _write_layers(self, ids, layer_infos):
+        """
+        Create the overlay directories, links and layer records.
+        Returns the link name of the top layer.
+        """
+        recs = []
+        parent = None
+        link = None
+        for layer_id, info in zip(ids, layer_infos):
+            ldir = os.path.join(self.dst.overlay_dir, layer_id)
+            os.makedirs(os.path.join(ldir, "diff"), exist_ok=True)
+            lf = os.path.join(ldir, "link")
+            if os.path.exists(lf):
+                link = open(lf).read()
+            else:
+                link = new_link()
+                with open(f"{lf}.tmp-{os.getpid()}", "w") as f:
+                    f.write(link)
+                os.rename(f"{lf}.tmp-{os.getpid()}", lf)
+            lname = os.path.join(self.dst.overlay_dir, "l", link)
+            if not os.path.lexists(lname):
+                os.symlink(os.path.join("..", layer_id, "diff"), lname)
+            rec = {
+                "id": layer_id,
+                "created": self._rfc3339(),
+                "compressed-diff-digest": info["digest"],
+                "compressed-size": info["size"],
+                "diff-digest": info["diff_digest"],
+                "diff-size": info["diff_size"],
+                "compression": COMPRESSION[info["compression"]],
+                "uidset": sorted(info["uidset"]),
+                "gidset": sorted(info["gidset"]),
+            }
+            if parent:
+                rec["parent"] = parent
+            recs.append(rec)
+            parent = layer_id
+        self.dst.add_recs("layers", recs)
+        return link
+
+    def _import_image(self, img, remaining):
+        config = img["config"]
+        img_id = hashlib.sha256(config).hexdigest()
+        cfg = json.loads(config)
+        layer_infos = [self.layers[ln] for ln in img["layers"]]
+        diff_ids = [info["diff_digest"] for info in layer_infos]
+        if diff_ids != cfg.get("rootfs", {}).get("diff_ids", diff_ids):
+            raise ValueError(f"Layer digests of image {img_id[:12]} don't "
+                             "match its config")
+        for ln in img["layers"]:
+            remaining[ln] -= 1
+        if self.dst.chk_image(img_id):
+            logging.info(f"Image {img_id[:12]} previously imported")
+            return img_id
+        logging.info(f"Importing image {img_id[:12]}")
+        rootfs = tempfile.mkdtemp(prefix="rootfs-", dir=self.stage)
+        attrs = {}
+        devices = {}
+        for ln in img["layers"]:
+            self._apply_layer(self.layers[ln], rootfs, attrs, devices,
+                              keep=remaining[ln] > 0)
+        pseudo = os.path.join(self.stage, f"{img_id}.pseudo")
+        self._write_pseudo(rootfs, attrs, devices, pseudo)
+        sqf = os.path.join(self.stage, f"{img_id}.squash")
+        logging.info(f"Generating squash file for {img_id[:12]}")
+        if not self._run_mksq(rootfs, pseudo, sqf):
+            raise OSError(f"mksquashfs failed for image {img_id[:12]}")
+        idx = None
+        if self.mu.squash_index:
+            # The tree is already unpacked, so no need to mount the squash
+            idx = os.path.join(self.stage, f"{img_id}.idx")
+            write_index(idx, build_index(rootfs, attrs=attrs))
+        shutil.rmtree(rootfs, ignore_errors=True)
+
+        lock = ImageLock(self.dst, img_id)
+        lock.acquire()
+        try:
+            self.dst.refresh()
+            if self.dst.chk_image(img_id):
+                logging.info("Imported by another process")
+                return img_id
+            ids = chain_ids(diff_ids)
+            link = self._write_layers(ids, layer_infos)
+            tgt = self.dst.get_squash_filename(link)
+            if not squash_file_ok(tgt):
+                hasher = hashlib.sha256()
+                size = publish_file(sqf, tgt, hasher=hasher)
+                write_checksum(tgt, "sha256:" + hasher.hexdigest(), size)
+            if idx:
+                publish_file(idx, index_filename(tgt))
+            manifest = img["manifest"] or \
+                self._docker_manifest(config, layer_infos)
+            rec = {"id": img_id, "names": img["names"], "layer": ids[-1],
+                   "metadata": "{}"}
+            rec.update(self._write_image_dir(img_id, config, manifest))
+            rec["created"] = cfg.get("created") or self._rfc3339()
+            # Adding the image record last commits the import
+            self.dst.drop_tag(img["names"])
+            self.dst.add_recs("images", [rec])
+        finally:
+            lock.release()
+            os.unlink(sqf)
+            if idx:
+                os.unlink(idx)
+        return img_id
+
+    def import_archive(self, archive, name=None):
+        """
+        Import all images in an archive.  Returns the list of image IDs.
+
+        Inputs:
+        archive: path of the tarball ("-" for stdin)
+        name: name for the image (only for single image archives)
+        """
+        self.dst = ImageStore(self.dst_dir, read_only=False)
+        self.dst.init_storage()
+        self.dst.refresh()
+        staging = self.mu.staging_dir
+        if staging:
+            os.makedirs(staging, exist_ok=True)
+        self.stage = os.path.realpath(
+            tempfile.mkdtemp(prefix="import-", dir=staging))
+        try:
+            start = time.time()
+            self.read_archive(archive)
+            logging.info(f"Read archive in {time.time() - start:.1f}s")
+            images = self.get_images()
+            if name:
+                if len(images) != 1:
+                    raise ValueError("A name can only be given for an "
+                                     "archive with one image")
+                images[0]["names"] = [normalize_name(name)]
+            remaining = {}
+            for img in images:
+                for ln in img["layers"]:
+                    remaining[ln] = remaining.get(ln, 0) + 1
+            return [self._import_image(img, remaining) for img in images]
+        finally:
+            shutil.rmtree(self.stage, ignore_errors=True)
@@ -1,12 +1,53 @@
 #!/usr/bin/python
 import os
+import re
 import sys
 import json
-from shutil import copytree, copy, which
-from subprocess import Popen, PIPE
+import base64
+import fcntl
+import hashlib
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+import struct
+import tempfile
+import time
+from shutil import copytree, which, rmtree
+from subprocess import Popen, PIPE, STDOUT
 import logging
+from .squash_index import index_squash, index_filename
 
 DEBUG = os.environ.get("DEBUG_M2SQ", False)
+# mksquashfs progress bar, e.g. "[=====-    ] 1234/5678  21%"
+MKSQ_PROGRESS_RE = re.compile(rb"\]\s+(\d+)/(\d+)\s+(\d+)%")
+# Entrypoint that precompiles the bytecode of the image's Python
+# interpreters in the container before running mksquashfs, so the .pyc
+# files end up in the squash file.  Symlinks are resolved so each
+# interpreter only runs once.
+COMPILE_PYTHON_SH = """#!/bin/sh
+seen=" "
+for py in /usr/bin/python* /usr/local/bin/python* /opt/*/bin/python*; do
+    case "$py" in
+        *-config) continue ;;
+    esac
+    [ -x "$py" ] || continue
+    real=$(readlink -f "$py" 2>/dev/null || echo "$py")
+    case "$seen" in
+        *" $real "*) continue ;;
+    esac
+    seen="$seen$real "
+    echo "Compiling bytecode with $py"
+    "$py" -c '
+import compileall, os, sys
+kw = {"workers": 0} if sys.version_info >= (3, 5) else {}
+for p in sys.path:
+    if os.path.isdir(p) and not p.startswith("/sqout"):
+        compileall.compile_dir(p, maxlevels=50, quiet=1, **kw)
+' >/dev/null 2>&1 || echo "Bytecode compilation with $py failed"
+done
+exec "$@"
+"""
 
 
 def merge_recs(recs_list, key):
@@ -24,6 +65,534 @@ def merge_recs(recs_list, key):
     return res
 
 
+def publish_file(src, tgt, bufsize=16 << 20, hasher=None):
+    """
+    Copy a file into place with large sequential writes.  The data is
+    written to a temporary name next to the target, flushed to disk and
+    then renamed, so a partial copy never appears under the target name.
+
+    Inputs:
+    src: source file
+    tgt: target file
+    bufsize: read/write size
+    hasher: optional hashlib object updated with the data as it is copied
+    """
+    tmp = f"{tgt}.tmp-{socket.gethostname()}-{os.getpid()}"
+    size = 0
+    try:
+        with open(src, "rb", buffering=0) as fin, \
+             open(tmp, "wb", buffering=0) as fout:
+            while True:
+                buf = fin.read(bufsize)
+                if not buf:
+                    break
+                fout.write(buf)
+                if hasher:
+                    hasher.update(buf)
+                size += len(buf)
+            os.fsync(fout.fileno())
+        os.rename(tmp, tgt)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return size
+
+
+def write_json(fn, data):
+    """
+    Replace a JSON file atomically so readers never see a partial file.
+
+    Inputs:
+    fn: JSON file name
+    data: data to write
+    """
+    tmp = f"{fn}.tmp-{socket.gethostname()}-{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, fn)
+
+
+def pid_running(pid):
+    """
+    Returns True if a process with this pid is running on this host.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def stale_tmp(fn, name):
+    """
+    Returns True if fn is a temporary file of name (name.tmp-host-pid)
+    left behind by a process on this host that is no longer running.
+    Temporary files of running processes or of other hosts may belong
+    to a concurrent migration sharing the file (e.g. a common layer).
+
+    Inputs:
+    fn: file name in the directory of name
+    name: base name of the target file
+    """
+    prefix = f"{name}.tmp-"
+    if not fn.startswith(prefix):
+        return False
+    host, _, pid = fn[len(prefix):].rpartition("-")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    pid = int(pid)
+    return pid != os.getpid() and not pid_running(pid)
+
+
+def squash_file_ok(fn):
+    """
+    Cheap check that a squash file is complete.  mksquashfs writes the
+    superblock last, so a truncated or partial file either lacks the
+    magic or is shorter than the size recorded in the superblock.
+
+    Inputs:
+    fn: squash file name
+    """
+    try:
+        with open(fn, "rb") as f:
+            sb = f.read(96)
+        size = os.path.getsize(fn)
+    except OSError:
+        return False
+    if len(sb) < 96 or sb[:4] != b"hsqs":
+        return False
+    bytes_used = struct.unpack("<Q", sb[40:48])[0]
+    return bytes_used <= size
+
+
+def checksum_filename(sqf):
+    """
+    Returns the name of the checksum sidecar of a squash file.
+    """
+    return f"{sqf}.json"
+
+
+def write_checksum(sqf, digest, size):
+    """
+    Record the checksum and size of a squash file in its sidecar.
+
+    Inputs:
+    sqf: squash file name
+    digest: digest of the content ("sha256:...")
+    size: size of the file in bytes
+    """
+    write_json(checksum_filename(sqf), {"digest": digest, "size": size})
+
+
+def read_checksum(sqf):
+    """
+    Returns the recorded checksum info of a squash file or None.
+    """
+    try:
+        return json.load(open(checksum_filename(sqf)))
+    except (OSError, ValueError):
+        return None
+
+
+class MigrationJournal:
+    """
+    Class to record the completed steps of a migration in the destination
+    image store, so an interrupted migration can be resumed.
+    """
+
+    def __init__(self, store, img_id):
+        """
+        Inputs:
+        store: destination ImageStore
+        img_id: ID of the image being migrated
+        """
+        self.fn = os.path.join(store.base, "migrations", f"{img_id}.journal")
+        self.data = {"image": img_id, "steps": {}}
+
+    def load(self):
+        """
+        Read the journal if a previous attempt left one.
+        """
+        if os.path.exists(self.fn):
+            try:
+                self.data = json.load(open(self.fn))
+            except ValueError:
+                logging.warning(f"Ignoring unreadable journal {self.fn}")
+        return self
+
+    def _write(self):
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        write_json(self.fn, self.data)
+
+    def get(self, step):
+        """
+        Returns the recorded info for a completed step or None.
+        """
+        return self.data["steps"].get(step)
+
+    def mark(self, step, **info):
+        """
+        Record that a step completed.
+        """
+        info["time"] = time.time()
+        self.data["steps"][step] = info
+        self._write()
+
+    def set(self, key, value):
+        """
+        Record additional information (e.g. the staging directory).
+        """
+        self.data[key] = value
+        self._write()
+
+    def status(self):
+        """
+        Returns a short description of the progress.
+        """
+        done = list(self.data["steps"])
+        if not done:
+            return "starting"
+        return f"completed {', '.join(done)}"
+
+    def remove(self):
+        """
+        Drop the journal once the migration is committed.
+        """
+        if os.path.exists(self.fn):
+            os.unlink(self.fn)
+
+
+class MigrationStatus:
+    """
+    Class to publish the progress of a migration (state, current step,
+    bytes processed and ETA) in the destination image store.  This is
+    what podman-hpc migrate-status reports.
+    """
+
+    # Finished migrations are listed for this long
+    keep_seconds = 86400
+    # Minimum time between writes for byte count updates
+    write_interval = 1
+
+    def __init__(self, store, img_id, image=None):
+        """
+        Inputs:
+        store: destination ImageStore
+        img_id: ID of the image being migrated
+        image: name the migration was requested with
+        """
+        self.store = store
+        self.fn = os.path.join(store.base, "migrations", f"{img_id}.status")
+        now = time.time()
+        self.data = {
+            "id": img_id,
+            "image": image,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "state": "running",
+            "step": None,
+            "bytes_done": 0,
+            "bytes_total": 0,
+            "eta": None,
+            "started": now,
+            "updated": now,
+        }
+        self._last_write = 0
+
+    def update(self, **info):
+        """
+        Update and write the status.  Byte count updates are written at
+        most every write_interval seconds.
+        """
+        self.data.update(info)
+        now = time.time()
+        done = self.data["bytes_done"]
+        total = self.data["bytes_total"]
+        elapsed = now - self.data["started"]
+        if done and total > done:
+            self.data["eta"] = elapsed * (total - done) / done
+        elif total and done >= total:
+            self.data["eta"] = 0
+        self.data["updated"] = now
+        if set(info) <= {"bytes_done"} and \
+           now - self._last_write < self.write_interval:
+            return
+        self._last_write = now
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        write_json(self.fn, self.data)
+
+    @classmethod
+    def list(cls, store):
+        """
+        Returns the status of in-flight and recent migrations, newest
+        first.  Status files of migrations that finished more than
+        keep_seconds ago are removed.
+        """
+        mdir = os.path.join(store.base, "migrations")
+        if not os.path.isdir(mdir):
+            return []
+        res = []
+        for fn in os.listdir(mdir):
+            if not fn.endswith(".status"):
+                continue
+            pth = os.path.join(mdir, fn)
+            try:
+                data = json.load(open(pth))
+            except (OSError, ValueError):
+                continue
+            if data["state"] != "running":
+                if time.time() - data["updated"] > cls.keep_seconds:
+                    os.unlink(pth)
+                    continue
+            elif not os.path.exists(os.path.join(mdir,
+                                                 f"{data['id']}.lock")) \
+                    or ImageLock(store, data["id"]).is_stale():
+                # The worker died without recording the outcome
+                data["state"] = "stale"
+            res.append(data)
+        return sorted(res, key=lambda d: d["started"], reverse=True)
+
+
+class MigrationProgress:
+    """
+    Class to report structured progress events of a migration.  Each
+    event is a dictionary with the event name, a timestamp and event
+    specific fields.  Events are printed to the terminal in a short
+    form and, optionally, appended as JSON lines to a file.
+
+    Events: migrate_start, step_start, step_end, copy, squash_progress,
+    squash_end, migrate_end.
+    """
+
+    # Minimum time between squash percentage lines on the terminal
+    terminal_interval = 2
+    # Copies smaller than this are only written to the JSON lines file
+    terminal_min_copy = 16 << 20
+
+    def __init__(self, stream=None, jsonl=None, terminal=True):
+        """
+        Inputs:
+        stream: terminal stream (default: stdout)
+        jsonl: file to append JSON lines to (optional)
+        terminal: set to False to only write the JSON lines
+        """
+        self.stream = stream
+        self.terminal = terminal
+        self.jsonl = None
+        if jsonl:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl)),
+                        exist_ok=True)
+            self.jsonl = open(jsonl, "a")
+        self._last_pct = 0
+
+    def emit(self, event, **fields):
+        rec = {"time": time.time(), "event": event}
+        rec.update(fields)
+        if self.jsonl:
+            self.jsonl.write(json.dumps(rec) + "\n")
+            self.jsonl.flush()
+        if self.terminal:
+            msg = self._format(rec)
+            if msg:
+                stream = self.stream or sys.stdout
+                stream.write(f"INFO: {msg}\n")
+                stream.flush()
+
+    def _format(self, rec):
+        event = rec["event"]
+        mib = rec.get("bytes", 0) / 2**20
+        if event == "migrate_start":
+            return (f"Migrating {rec['image']} ({rec['layers']} layers, "
+                    f"{mib:.1f} MiB)")
+        if event == "step_start":
+            return f"Step {rec['step']} started"
+        if event == "step_end":
+            return f"Step {rec['step']} done in {rec['seconds']:.1f}s"
+        if event == "copy":
+            if rec["bytes"] < self.terminal_min_copy:
+                return None
+            return (f"Copied {os.path.basename(rec['file'])} ({mib:.1f} "
+                    f"MiB) at {rec['mib_per_sec']:.1f} MiB/s")
+        if event == "squash_progress":
+            now = rec["time"]
+            if rec["percent"] < 100 and \
+               now - self._last_pct < self.terminal_interval:
+                return None
+            self._last_pct = now
+            return f"Squashing {rec['percent']}%"
+        if event == "squash_end":
+            return (f"Squash file is {mib:.1f} MiB, built in "
+                    f"{rec['seconds']:.1f}s ({rec['mib_per_sec']:.1f} "
+                    "MiB/s of image data)")
+        if event == "migrate_end":
+            state = "done" if rec["ok"] else "failed"
+            return f"Migration {state} in {rec['seconds']:.1f}s"
+        return None
+
+    def close(self):
+        if self.jsonl:
+            self.jsonl.close()
+            self.jsonl = None
+
+
+class ImageLock:
+    """
+    Class for an image-scoped lock in the destination image store.  It
+    keeps concurrent processes (possibly on many nodes) from migrating the
+    same image at the same time.
+
+    The lock is a file created exclusively in the store's migrations
+    directory.  The owner refreshes its mtime while it holds the lock.
+    A lock is stale if the owner is gone (same host) or it hasn't been
+    refreshed for stale_timeout seconds.
+    """
+
+    heartbeat_interval = 10
+    stale_timeout = 120
+    poll_interval = 2
+
+    def __init__(self, store, img_id):
+        """
+        Inputs:
+        store: destination ImageStore
+        img_id: ID of the image being migrated
+        """
+        self.img_id = img_id
+        self.fn = os.path.join(store.base, "migrations", f"{img_id}.lock")
+        self.owner = {"host": socket.gethostname(), "pid": os.getpid()}
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _try_create(self):
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        try:
+            fd = os.open(self.fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.owner, f)
+        return True
+
+    def read_owner(self, fn=None):
+        """
+        Returns the owner of the lock (host, pid) or None if unlocked.
+        """
+        try:
+            return json.load(open(fn or self.fn))
+        except (OSError, ValueError):
+            return None
+
+    def _snapshot(self, fn=None):
+        """
+        Returns the modification time and owner of a lock file or None
+        if it doesn't exist.
+        """
+        fn = fn or self.fn
+        try:
+            mtime = os.stat(fn).st_mtime_ns
+        except OSError:
+            return None
+        return mtime, self.read_owner(fn)
+
+    def is_stale(self, snapshot=None):
+        """
+        Returns True if the lock is stale.
+
+        Inputs:
+        snapshot: lock state from _snapshot (default: read it now)
+        """
+        snapshot = snapshot or self._snapshot()
+        if not snapshot:
+            return False
+        mtime, owner = snapshot
+        if time.time() - mtime / 1e9 > self.stale_timeout:
+            return True
+        if owner and owner.get("host") == self.owner["host"]:
+            return not pid_running(owner["pid"])
+        return False
+
+    def _break_stale(self, snapshot):
+        """
+        Remove the stale lock we saw in snapshot.  The file may have been
+        replaced since (another process broke the lock and a new owner
+        took it), so the renamed file is checked and put back if it isn't
+        the one we saw.
+        """
+        # Only one process can win the rename
+        stale = f"{self.fn}.stale-{self.owner['host']}-{self.owner['pid']}"
+        try:
+            os.rename(self.fn, stale)
+        except OSError:
+            return
+        if self._snapshot(stale) != snapshot:
+            # Hard linking fails instead of replacing a newer lock
+            try:
+                os.link(stale, self.fn)
+            except OSError as ex:
+                logging.warning(f"Unable to restore migration lock "
+                                f"{self.fn}: {ex}")
+            os.unlink(stale)
+            return
+        logging.warning(f"Removed stale migration lock {self.fn}")
+        os.unlink(stale)
+
+    def _beat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                os.utime(self.fn)
+            except OSError:
+                pass
+
+    def acquire(self, status=None):
+        """
+        Take the lock, waiting while another live process holds it.
+        Returns True if we had to wait for another process.
+
+        Inputs:
+        status: optional function returning a progress string for
+                the process holding the lock
+        """
+        waited = False
+        last_msg = None
+        while not self._try_create():
+            snapshot = self._snapshot()
+            if self.is_stale(snapshot):
+                self._break_stale(snapshot)
+                continue
+            waited = True
+            owner = self.read_owner() or {}
+            msg = (f"Waiting for migration of {self.img_id[:12]} by "
+                   f"{owner.get('host')}:{owner.get('pid')}")
+            if status:
+                msg += f" ({status()})"
+            if msg != last_msg:
+                sys.stdout.write(f"INFO: {msg}\n")
+                sys.stdout.flush()
+                last_msg = msg
+            time.sleep(self.poll_interval)
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+        return waited
+
+    def release(self):
+        """
+        Drop the lock.
+        """
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+            self._heartbeat = None
+        owner = self.read_owner()
+        if owner == self.owner:
+            os.unlink(self.fn)
+
+
 class ImageStore:
     """
     Class to provide some basic functions for interacting with
@@ -92,6 +661,28 @@ class ImageStore:
         mf = os.path.join(self.images_dir, imgid, "manifest")
         return json.load(open(mf))
 
+    def get_big_data(self, imgid, key):
+        """
+        Returns the contents of a big-data item of an image (e.g. the
+        image config).
+
+        Inputs:
+        imgid: image id
+        key: big-data name (see big-data-names in the image record)
+        """
+        fn = "=" + base64.b64encode(key.encode("utf-8")).decode("utf-8")
+        with open(os.path.join(self.images_dir, imgid, fn), "rb") as f:
+            return f.read()
+
+    def get_image_config(self, imgid):
+        """
+        Returns the parsed image config for the given image ID
+
+        Inputs:
+        imgid: image id
+        """
+        return json.loads(self.get_big_data(imgid, f"sha256:{imgid}"))
+
     def init_storage(self):
         """
         Initializes a directory as an image store.  This creates
@@ -100,21 +691,42 @@ class ImageStore:
         if self.read_only:
             raise ValueError("Cannot init read-only stroage")
 
-        if not os.path.exists(self.base):
-            os.mkdir(self.base)
+        # Other processes may be initializing the same store
+        os.makedirs(self.base, exist_ok=True)
         for ext in ["", "/l", "-images", "-layers"]:
             pth = os.path.join(self.base, f"overlay{ext}")
-            if not os.path.exists(pth):
-                os.mkdir(pth)
+            os.makedirs(pth, exist_ok=True)
         for typ in ["images", "layers"]:
-            pth = f"{self.base}/overlay-{typ}/{typ}.lock"
-            if not os.path.exists(pth):
-                with open(pth, "w") as f:
-                    f.write("")
-            pth = f"{self.base}/overlay-{typ}/{typ}.json"
-            if not os.path.exists(pth):
-                with open(pth, "w") as f:
-                    f.write("[]")
+            for ext, content in [("lock", ""), ("json", "[]")]:
+                pth = f"{self.base}/overlay-{typ}/{typ}.{ext}"
+                if os.path.exists(pth):
+                    continue
+                try:
+                    with open(pth, "x") as f:
+                        f.write(content)
+                except FileExistsError:
+                    pass
+
+    @contextmanager
+    def _locked(self, otype):
+        """
+        Hold the store lock for images or layers while the JSON file is
+        updated.  This is the same lock file used by containers/storage.
+        Filesystems without lock support are used unlocked.
+        """
+        fn = os.path.join(self.base, f"overlay-{otype}", f"{otype}.lock")
+        with open(fn, "a") as f:
+            try:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+            except OSError as ex:
+                logging.debug(f"Unable to lock {fn}: {ex}")
+            try:
+                yield
+            finally:
+                try:
+                    fcntl.lockf(f, fcntl.LOCK_UN)
+                except OSError:
+                    pass
 
     def chk_image(self, id):
         """
@@ -141,17 +753,18 @@ class ImageStore:
             raise ValueError("Cannot init read-only stroage")
 
         fn = os.path.join(self.base, f"overlay-{otype}", f"{otype}.json")
-        data = json.load(open(fn))
-        changed = False
-        out = []
-        for rec in data:
-            if rec[key] == id:
-                changed = True
-                continue
-            out.append(rec)
-        if changed:
-            json.dump(out, open(fn, "w"))
-            logging.debug(f"Updated {fn}")
+        with self._locked(otype):
+            data = json.load(open(fn))
+            changed = False
+            out = []
+            for rec in data:
+                if rec[key] == id:
+                    changed = True
+                    continue
+                out.append(rec)
+            if changed:
+                write_json(fn, out)
+                logging.debug(f"Updated {fn}")
 
     def drop_tag(self, tags):
         """
@@ -165,13 +778,13 @@ class ImageStore:
         if self.read_only:
             raise ValueError("Cannot init read-only stroage")
 
-        data = self.images
- 
-        for img in data:
-            for tag in tags:
-                if tag in img['names']:
-                    img['names'].remove(tag)
-        json.dump(data, open(self.images_json, "w"))
+        with self._locked("images"):
+            data = json.load(open(self.images_json))
+            for img in data:
+                for tag in tags:
+                    if tag in img['names']:
+                        img['names'].remove(tag)
+            write_json(self.images_json, data)
         self.images = data
 
     def add_recs(self, otype, recs):
@@ -189,19 +802,21 @@ class ImageStore:
             raise ValueError("Cannot init read-only stroage")
 
         fn = os.path.join(self.base, f"overlay-{otype}", f"{otype}.json")
-        data = json.load(open(fn))
-        by_id = {}
-        for row in data:
-            by_id[row["id"]] = row
-
-        changed = False
-        for rec in recs:
-            if rec["id"] not in by_id:
-                data.append(rec)
-                changed = True
+        with self._locked(otype):
+            data = json.load(open(fn))
+            by_id = {}
+            for row in data:
+                by_id[row["id"]] = row
+
+            changed = False
+            for rec in recs:
+                if rec["id"] not in by_id:
+                    data.append(rec)
+                    changed = True
+            if changed:
+                write_json(fn, data)
+                logging.debug(f"Updated {fn}")
         if changed:
-            json.dump(data, open(fn, "w"))
-            logging.debug(f"Updated {fn}")
             self.refresh()
 
     def get_squash_filename(self, link):
@@ -225,16 +840,31 @@ class MigrateUtils:
     images = None
     podman_bin = "podman"
     mksq_bin = "mksquashfs.static"
-    mksq_options = ["-comp", "lz4", "-xattrs-exclude", "security.capability"]
+    mksq_options = ["-xattrs-exclude", "security.capability"]
     exclude_list = ["/sqout", "/mksq", "/proc", "/sys", "/dev"]
+    squash_profiles = {"default": {"compression": "lz4"}}
+    squash_profile = "default"
+    slim_profiles = {}
+    slim_profile = None
+    compile_python = False
+    staging_dir = None
+    squashfuse_bin = "squashfuse"
+    squash_index = False
+    src_run_root = None
+    status = None
+    progress = None
+    _bytes_total = 0
     _mksq_inside = "/mksq"
 
-    def __init__(self, src=None, dst=None, conf=None):
+    def __init__(self, src=None, dst=None, conf=None, profile=None,
+                 slim=None):
         """
         Inputs:
         src: base directory of source image store
         dst: base directory of destination image store
         conf: a podman_hpc config object
+        profile: name of the squash profile to use
+        slim: name of the slim profile to use ("none" to disable)
 
         If src isn't provided, then default to user's default store.
 
@@ -247,10 +877,25 @@ class MigrateUtils:
         if conf:
             self.podman_bin = conf.podman_bin
             self.mksq_bin = conf.mksquashfs_bin
+            self.squash_profiles = conf.squash_profiles
+            self.squash_profile = conf.squash_profile
+            self.slim_profiles = conf.slim_profiles
+            self.slim_profile = conf.slim_profile
+            self.compile_python = conf.compile_python
+            self.staging_dir = conf.squash_staging_dir
+            self.squashfuse_bin = conf.squashfuse_bin
+            self.squash_index = conf.squash_index
             if not self.src_dir:
                 self.src_dir = conf.graph_root
             if not self.dst_dir:
                 self.dst_dir = conf.squash_dir
+        if profile:
+            self.squash_profile = profile
+        if slim:
+            self.slim_profile = None if slim == "none" else slim
+        # Fail early on a bad profile name
+        self.get_mksq_options()
+        self.get_exclude_options()
 
     def _lazy_init(self):
         if not self._lazy_init_called:
@@ -319,9 +964,27 @@ class MigrateUtils:
     def _copy_image_info(self, img_id):
         srcd = os.path.join(self.src.images_dir, img_id)
         dstd = os.path.join(self.dst.images_dir, img_id)
-        # Copy image directory
-        if not os.path.exists(dstd):
-            copytree(srcd, dstd)
+        # Copy image directory to a temporary name and move it into place
+        # so an interrupted copy is never mistaken for a complete one.
+        tmpd = f"{dstd}.tmp-{socket.gethostname()}-{os.getpid()}"
+        if os.path.exists(tmpd):
+            rmtree(tmpd)
+        copytree(srcd, tmpd)
+        if os.path.exists(dstd):
+            rmtree(dstd)
+        os.rename(tmpd, dstd)
+
+    def _verify_image_info(self, img_id):
+        srcd = os.path.join(self.src.images_dir, img_id)
+        dstd = os.path.join(self.dst.images_dir, img_id)
+        if not os.path.isdir(dstd):
+            return False
+        for fn in os.listdir(srcd):
+            dfn = os.path.join(dstd, fn)
+            if not os.path.exists(dfn) or \
+               os.path.getsize(dfn) != os.path.getsize(os.path.join(srcd, fn)):
+                return False
+        return True
 
     def _copy_required_layers(self, req_layers):
         for layer in req_layers:
@@ -329,11 +992,25 @@ class MigrateUtils:
             fn = f"{layer_id}.tar-split.gz"
             srcd = os.path.join(self.src.layers_dir, fn)
             dstd = os.path.join(self.dst.layers_dir, fn)
-            if not os.path.exists(dstd):
+            if not os.path.exists(dstd) or \
+               os.path.getsize(dstd) != os.path.getsize(srcd):
                 logging.debug(f"Copy {srcd} to {dstd}")
-                copy(srcd, dstd)
+                self._publish(srcd, dstd)
         self.dst.add_recs("layers", req_layers)
 
+    def _verify_layers(self, req_layers):
+        layer_ids = set([layer["id"] for layer in self.dst.layers])
+        for layer in req_layers:
+            if layer["id"] not in layer_ids:
+                return False
+            fn = f"{layer['id']}.tar-split.gz"
+            srcd = os.path.join(self.src.layers_dir, fn)
+            dstd = os.path.join(self.dst.layers_dir, fn)
+            if os.path.exists(srcd) and (not os.path.exists(dstd) or
+               os.path.getsize(dstd) != os.path.getsize(srcd)):
+                return False
+        return True
+
     def _copy_overlay(self, img_id, layers):
         for layer in layers:
             id = layer["id"]
@@ -349,9 +1026,10 @@ class MigrateUtils:
             # the link
             src = os.path.join(sbpath, "link")
             dst = os.path.join(dbpath, "link")
-            if not os.path.exists(dst):
+            if not os.path.exists(dst) or \
+               open(dst).read() != open(src).read():
                 logging.debug(f"Copy {src} to{dst}")
-                copy(src, dst)
+                self._publish(src, dst)
 
             # Create symlink file
             link = self.dst.read_link_file(id)
@@ -366,48 +1044,291 @@ class MigrateUtils:
             dst = self.dst.get_squash_filename(link)
             if os.path.exists(src) and not os.path.exists(dst):
                 logging.debug(f"Copy {src} to {dst}")
-                copy(src, dst)
+                hasher = hashlib.sha256()
+                size = self._publish(src, dst, hasher=hasher)
+                write_checksum(dst, "sha256:" + hasher.hexdigest(), size)
 
-    def _mksq(self, img_id, top_id):
-        # Get the link name
-        ln = self.dst.read_link_file(top_id)
+    def _verify_overlay(self, layers):
+        for layer in layers:
+            id = layer["id"]
+            src = os.path.join(self.src.overlay_dir, id, "link")
+            dst = os.path.join(self.dst.overlay_dir, id, "link")
+            if not os.path.exists(dst):
+                return False
+            link = open(dst).read()
+            if os.path.exists(src) and link != open(src).read():
+                return False
+            if not os.path.lexists(os.path.join(self.dst.overlay_dir,
+                                                "l", link)):
+                return False
+        return True
+
+    def get_mksq_options(self, profile=None):
+        """
+        Returns the mksquashfs options for a squash profile.
+
+        Inputs:
+        profile: profile name (default: the configured profile)
+
+        A profile is a dictionary with the optional keys compression,
+        block_size, compression_level and options (a list of extra
+        mksquashfs options).
+        """
+        name = profile or self.squash_profile
+        prof = self.squash_profiles.get(name)
+        if prof is None:
+            raise ValueError(f"Unknown squash profile: {name}")
+        opts = ["-comp", prof.get("compression", "lz4")]
+        if prof.get("block_size"):
+            opts.extend(["-b", str(prof["block_size"])])
+        if prof.get("compression_level"):
+            opts.extend(["-Xcompression-level",
+                         str(prof["compression_level"])])
+        opts.extend(prof.get("options", []))
+        opts.extend(self.mksq_options)
+        return opts
+
+    def get_exclude_options(self, slim=None):
+        """
+        Returns the mksquashfs exclude options for a slim profile.  These
+        must come last since -e takes the rest of the command line.
+
+        Inputs:
+        slim: slim profile name (default: the configured profile, if any)
+
+        A slim profile is a dictionary with a list of exclude patterns
+        and an optional regex flag.  Patterns are relative to the image
+        root and use mksquashfs -wildcards syntax (e.g. "usr/share/man"
+        or "... __pycache__" to match at any depth) or, with regex set,
+        -regex syntax.
+        """
+        name = slim or self.slim_profile
+        if not name:
+            return [arg for ex in self.exclude_list for arg in ["-e", ex]]
+        prof = self.slim_profiles.get(name)
+        if prof is None:
+            raise ValueError(f"Unknown slim profile: {name}")
+        # mksquashfs doesn't allow absolute excludes with -wildcards or
+        # -regex, so anchor the fixed ones at the root instead
+        if prof.get("regex"):
+            base = [f"^{re.escape(ex.lstrip('/'))}$"
+                    for ex in self.exclude_list]
+            opts = ["-regex"]
+        else:
+            base = [ex.lstrip("/") for ex in self.exclude_list]
+            opts = ["-wildcards"]
+        return opts + ["-e"] + base + list(prof.get("exclude", []))
+
+    def _run_mksq(self, img_id, outdir, outname, options, excludes=None,
+                  compile_python=None):
+        """
+        Squash the root filesystem of an image into outdir/outname.
+
+        Inputs:
+        img_id: image ID in the source store
+        outdir: directory to write the squash file to
+        outname: squash file name
+        options: mksquashfs options
+        excludes: exclude options (default: get_exclude_options())
+        compile_python: precompile Python bytecode in the container
+                        first (default: the compile_python setting)
+        """
+        if compile_python is None:
+            compile_python = self.compile_python
+        entry = [self._mksq_inside]
+        if compile_python:
+            # The image needs a /bin/sh for this
+            script = os.path.join(outdir, ".compile-python.sh")
+            with open(script, "w") as f:
+                f.write(COMPILE_PYTHON_SH)
+            entry = ["/bin/sh", "/sqout/.compile-python.sh",
+                     self._mksq_inside]
         _mksqstatic = self.mksq_bin
         if not _mksqstatic.startswith("/"):
             _mksqstatic = which(_mksqstatic)
-        tgt = self.dst.get_squash_filename(ln)
-        if os.path.exists(tgt):
-            logging.info("Squash file already generated")
-            return True
-        logging.info(f"Generating squash file {tgt}")
         # To make the squash file we will start up a container
         # with the tgt image and then run mksq in it.
         # This requires a statically linked mksquashfs
-        com = [
-            self.podman_bin, "run", "--rm",
-            "--root", self.src.base,
+        com = [self.podman_bin, "run", "--rm", "--root", self.src.base]
+        if self.src_run_root:
+            com.extend(["--runroot", self.src_run_root])
+        com.extend([
             "-v", f"{_mksqstatic}:{self._mksq_inside}",
-            "-v", f"{self.dst.base}/overlay/l/:/sqout",
+            "-v", f"{outdir}/:/sqout",
             "--user", "0",
-            "--entrypoint", self._mksq_inside,
+            "--entrypoint", entry[0],
             img_id,
-            "/", f"/sqout/{ln}.squash",
-        ]
-        com.extend(self.mksq_options)
-        # Exclude these
-        for ex in self.exclude_list:
-            com.extend(["-e", ex])
-        proc = Popen(com, stdout=PIPE, stderr=PIPE, env=os.environ)
-        out, err = proc.communicate()
+        ])
+        com.extend(entry[1:])
+        com.extend(["/", f"/sqout/{outname}"])
+        com.extend(options)
+        if excludes is None:
+            excludes = self.get_exclude_options()
+        com.extend(excludes)
+        # Read the output as it comes to follow the progress bar
+        proc = Popen(com, stdout=PIPE, stderr=STDOUT, env=os.environ)
+        tail = deque(maxlen=50)
+        last_pct = None
+        buf = b""
+        while True:
+            chunk = proc.stdout.read1(65536)
+            buf += chunk
+            lines = re.split(rb"[\r\n]", buf)
+            buf = lines.pop() if chunk else b""
+            for line in lines:
+                m = MKSQ_PROGRESS_RE.search(line)
+                if not m:
+                    if line.strip():
+                        tail.append(line.decode("utf-8", "replace"))
+                    continue
+                pct = int(m.group(3))
+                if pct != last_pct:
+                    last_pct = pct
+                    self._squash_progress(pct, int(m.group(1)),
+                                          int(m.group(2)))
+            if not chunk:
+                break
+        proc.wait()
 
         if proc.returncode != 0:
             logging.error("Squash Failed")
-            logging.error(out.decode("utf-8"))
-            logging.error(err.decode("utf-8"))
+            logging.error("\n".join(tail))
             return False
+        return True
+
+    def _squash_progress(self, pct, blocks, total_blocks):
+        self._emit("squash_progress", percent=pct, blocks=blocks,
+                   total_blocks=total_blocks)
+        if self._bytes_total:
+            self._update_status(bytes_done=self._bytes_total * pct // 100)
+
+    def _emit(self, event, **fields):
+        if self.progress:
+            self.progress.emit(event, **fields)
+
+    def _publish(self, src, tgt, hasher=None):
+        """
+        publish_file with a copy progress event.
+        """
+        start = time.time()
+        size = publish_file(src, tgt, hasher=hasher)
+        elapsed = time.time() - start
+        self._emit("copy", file=tgt, bytes=size, seconds=elapsed,
+                   mib_per_sec=size / 2**20 / elapsed if elapsed else 0)
+        return size
+
+    def _mksq(self, img_id, top_id, journal=None):
+        # Get the link name
+        ln = self.dst.read_link_file(top_id)
+        tgt = self.dst.get_squash_filename(ln)
+        if os.path.exists(tgt):
+            if squash_file_ok(tgt):
+                logging.info("Squash file already generated")
+                return True
+            logging.warning(f"Removing incomplete squash file {tgt}")
+            os.unlink(tgt)
+        logging.info(f"Generating squash file {tgt}")
+        if self.slim_profile:
+            logging.info(f"Using slim profile {self.slim_profile}")
+        # Build the squash file on local disk and then publish it to the
+        # store in one sequential copy.
+        if self.staging_dir:
+            os.makedirs(self.staging_dir, exist_ok=True)
+        stage = tempfile.mkdtemp(prefix=f"{ln}-", dir=self.staging_dir)
+        if journal:
+            journal.set("stage", {"host": socket.gethostname(),
+                                  "path": stage})
+        try:
+            start = time.time()
+            ok = self._run_mksq(img_id, stage, f"{ln}.squash",
+                                self.get_mksq_options())
+            if not ok and self.compile_python:
+                logging.warning("Squashing with Python bytecode compilation "
+                                "failed, retrying without it")
+                ok = self._run_mksq(img_id, stage, f"{ln}.squash",
+                                    self.get_mksq_options(),
+                                    compile_python=False)
+            if not ok:
+                return False
+            elapsed = time.time() - start
+            sqf = os.path.join(stage, f"{ln}.squash")
+            self._emit("squash_end", bytes=os.path.getsize(sqf),
+                       input_bytes=self._bytes_total, seconds=elapsed,
+                       mib_per_sec=self._bytes_total / 2**20 / elapsed
+                       if elapsed else 0)
+            logging.debug(f"Publishing squash file to {tgt}")
+            # The checksum is computed during the copy
+            hasher = hashlib.sha256()
+            size = self._publish(sqf, tgt, hasher=hasher)
+            write_checksum(tgt, "sha256:" + hasher.hexdigest(), size)
+            if self.squash_index:
+                self._index_squash(sqf, stage, index_filename(tgt))
+        finally:
+            rmtree(stage, ignore_errors=True)
 
         logging.info("Created squash image")
         return True
 
+    def _index_squash(self, sqf, stage, tgt):
+        """
+        Build the content index of a staged squash file and publish it
+        next to the squash file.  The index is optional, so failures
+        (e.g. no squashfuse on this node) are only logged and the
+        migration goes on without it.
+        """
+        idx = os.path.join(stage, os.path.basename(tgt))
+        try:
+            index_squash(sqf, os.path.join(stage, "mnt"), idx,
+                         squashfuse_bin=self.squashfuse_bin)
+            self._publish(idx, tgt)
+        except OSError as ex:
+            logging.warning(f"Unable to index squash file, skipping the "
+                            f"index: {ex}")
+
+    def _verify_squash(self, top_id, journal):
+        ln = self.dst.read_link_file(top_id)
+        tgt = self.dst.get_squash_filename(ln)
+        if not squash_file_ok(tgt):
+            return False
+        size = os.path.getsize(tgt)
+        csum = read_checksum(tgt)
+        if csum and csum.get("size") != size:
+            return False
+        info = journal.get("squash")
+        return not info or info.get("size") == size
+
+    def _cleanup_partial(self, img_id, layers, journal):
+        """
+        Remove temporary files left behind by an interrupted migration
+        of this image.  Layers are shared between images, so only the
+        files of dead processes on this host are removed.
+        """
+        stage = journal.data.get("stage")
+        if stage and stage["host"] == socket.gethostname():
+            rmtree(stage["path"], ignore_errors=True)
+        paths = [os.path.join(self.dst.images_dir, img_id)]
+        for layer in layers:
+            paths.append(os.path.join(self.dst.layers_dir,
+                                      f"{layer['id']}.tar-split.gz"))
+            paths.append(os.path.join(self.dst.overlay_dir, layer["id"],
+                                      "link"))
+            lf = os.path.join(self.src.overlay_dir, layer["id"], "link")
+            if os.path.exists(lf):
+                paths.append(self.dst.get_squash_filename(open(lf).read()))
+        for pth in paths:
+            pdir, name = os.path.split(pth)
+            if not os.path.isdir(pdir):
+                continue
+            for fn in os.listdir(pdir):
+                if not stale_tmp(fn, name):
+                    continue
+                logging.debug(f"Removing partial file {fn}")
+                tmp = os.path.join(pdir, fn)
+                if os.path.isdir(tmp):
+                    rmtree(tmp, ignore_errors=True)
+                else:
+                    os.unlink(tmp)
+
     def migrate_image(self, image):
         self._lazy_init()
         logging.debug(f"Migrating {image}")
@@ -433,30 +1354,93 @@ class MigrateUtils:
             logging.info("Previously migrated")
             return True
 
-        # Check if previously tagged image exist
-        dimg = None
-        if fullname:
-            dimg, _ = self.dst.get_img_info(fullname)
+        # Only one process migrates an image at a time.  Others wait for
+        # it to finish and then use the result.
+        lock = ImageLock(self.dst, img_id)
+        lock.acquire(status=lambda: MigrationJournal(
+            self.dst, img_id).load().status())
+        try:
+            self.dst.refresh()
+            if self.dst.chk_image(img_id):
+                logging.info("Migrated by another process")
+                return True
+            self.status = MigrationStatus(self.dst, img_id, image)
+            start = time.time()
+            try:
+                ok = self._migrate_locked(img_info, rld)
+            except BaseException as ex:
+                self._update_status(state="failed", error=str(ex) or
+                                    type(ex).__name__)
+                self._emit("migrate_end", image=image, ok=False,
+                           seconds=time.time() - start)
+                raise
+            self._update_status(state="done" if ok else "failed")
+            self._emit("migrate_end", image=image, ok=ok,
+                       seconds=time.time() - start)
+            return ok
+        finally:
+            lock.release()
+
+    def _update_status(self, **info):
+        if self.status:
+            self.status.update(**info)
+
+    def _migrate_locked(self, img_info, rld):
+        img_id = img_info["id"]
+        top_id = img_info["layer"]
+        # Resume from the journal of an earlier attempt if there is one
+        journal = MigrationJournal(self.dst, img_id).load()
+        if journal.data["steps"]:
+            logging.info("Resuming interrupted migration")
+        self._cleanup_partial(img_id, rld, journal)
+        total = sum(layer.get("diff-size", 0) for layer in rld)
+        self._bytes_total = total
+        self._update_status(bytes_total=total)
+        self._emit("migrate_start", image=img_info["names"][0]
+                   if img_info.get("names") else img_id, id=img_id,
+                   layers=len(rld), bytes=total)
+
+        steps = [
+            ("image_info",
+             lambda: self._copy_image_info(img_id),
+             lambda: self._verify_image_info(img_id)),
+            ("layers",
+             lambda: self._copy_required_layers(rld),
+             lambda: self._verify_layers(rld)),
+            ("overlay",
+             lambda: self._copy_overlay(img_id, rld),
+             lambda: self._verify_overlay(rld)),
+            ("squash",
+             lambda: self._mksq(img_id, top_id, journal),
+             lambda: self._verify_squash(top_id, journal)),
+        ]
+        for step, run, verify in steps:
+            if journal.get(step) and verify():
+                logging.info(f"Step {step} already done")
+                continue
+            logging.debug(f"Running step {step}")
+            self._update_status(step=step)
+            self._emit("step_start", step=step)
+            start = time.time()
+            if run() is False:
+                return False
+            if not verify():
+                logging.error(f"Verification of step {step} failed")
+                return False
+            self._emit("step_end", step=step, seconds=time.time() - start)
+            info = {}
+            if step == "squash":
+                ln = self.dst.read_link_file(top_id)
+                sqf = self.dst.get_squash_filename(ln)
+                info["size"] = os.path.getsize(sqf)
+                self._update_status(bytes_done=total)
+            journal.mark(step, **info)
+
+        # Move the tags from a previously tagged image and add the image
+        # to images.json.  Save this for the end so things are all ready
         self.dst.drop_tag(img_info["names"])
-
-        # Copy image info
-        self._copy_image_info(img_id)
-
-        # Copy layers
-        self._copy_required_layers(rld)
-
-        # Overlay
-        self._copy_overlay(img_id, rld)
-
-        # Generate squash
-        logging.debug(f"squashing {img_id}")
-        resp = self._mksq(img_id, top_id)
-        if not resp:
-            return False
-
-        # Add img to images.json
-        # Save this for the end so things are all ready
         self.dst.add_recs("images", [img_info])
+        journal.remove()
         return True
 
     def remove_image(self, image):
@@ -478,6 +1462,9 @@ class MigrateUtils:
         if os.path.exists(sqf):
             logging.info("Removing squash file")
             os.unlink(sqf)
+        for fn in [checksum_filename(sqf), index_filename(sqf)]:
+            if os.path.exists(fn):
+                os.unlink(fn)
         logging.info("Removing image record")
         self.dst.del_rec("images", img_id)
         return True
@@ -6,17 +6,36 @@ import math
 import socket
 import re
 import time
+import json
+import shutil
+import tarfile
+import tempfile
+import atexit
 import click
 from . import click_passthrough as cpt
 from .migrate2scratch import MigrateUtils
 from .migrate2scratch import ImageStore
+from .migrate2scratch import MigrationStatus, MigrationProgress
+from .squash_rootfs import SquashRootfs
+from .import_archive import ArchiveImporter
+from .bundle import export_bundle, import_bundle
+from .squash_verify import SquashVerifier
+from .squash_verify import format_results as format_verify_results
+from .squash_index import find_files, diff_indexes, image_index
+from .squash_bench import run_squash_bench, format_results
+from .hook_report import read_records, summarize, format_report
 from .siteconfig import SiteConfig
+from .trace import Tracer, merge_traces, TRACE_ENV
 from multiprocessing import Process
-from subprocess import Popen, PIPE
+from threading import Thread, Event
+from subprocess import Popen, PIPE, DEVNULL, STDOUT
 
 
 __version__ = "1.1.4"
 
+# Replaced by podhpc when PODMANHPC_TRACE is set
+tracer = Tracer("podman-hpc", {})
+
 
 def _round_nearest(x, a):
     return round(x / a) * a
@@ -120,10 +139,16 @@ def podhpc(ctx, additional_stores, squash_dir, log_level):
     performance computing environment.
 
     """
+    global tracer
     if not ctx.invoked_subcommand:
         click.echo(ctx.get_help())
         ctx.exit()
 
+    if ctx.invoked_subcommand != "trace-merge":
+        tracer = Tracer("podman-hpc",
+                        root=f"podman-hpc {ctx.invoked_subcommand}")
+        atexit.register(tracer.close)
+    start = time.time()
     # set up site configuration object
     try:
         conf = SiteConfig(squash_dir=squash_dir, log_level=log_level)
@@ -135,6 +160,11 @@ def podhpc(ctx, additional_stores, squash_dir, log_level):
         ImageStore(conf.squash_dir, read_only=False).init_storage()
     conf.read_site_modules()
     conf.config_env(hpc=True)
+    # Put podman, the mount program and the hook into the same trace
+    for k, v in tracer.env().items():
+        conf.env[k] = v
+        conf.default_run_args.extend(["--env", f"{k}={v}"])
+    tracer.add("config", start)
 
     # add appropriate flags to call_podman based on invoked subcommand
     # defcmd = ctx.command.default_command_fn
@@ -167,11 +197,405 @@ def infohpc(siteconf):
 # podman-hpc migrate subcommand ############################################
 @podhpc.command(options_metavar="[options]")
 @pass_siteconf
+@click.option("--profile", type=str, help="Squash profile to use")
+@click.option(
+    "--slim",
+    type=str,
+    help="Slim profile of paths to leave out (\"none\" to disable)",
+)
+@click.option(
+    "--compile-python",
+    is_flag=True,
+    help="Precompile Python bytecode into the squash file",
+)
+@click.option(
+    "--async",
+    "run_async",
+    is_flag=True,
+    help="Migrate in a background process (see migrate-status)",
+)
+@click.option(
+    "--progress-file",
+    type=str,
+    help="Append progress events as JSON lines to this file",
+)
 @click.argument("image", type=str)
-def migrate(siteconf, image):
+def migrate(siteconf, image, profile, slim, compile_python, run_async,
+            progress_file):
     """Migrate an image to squashed."""
-    mu = MigrateUtils(conf=siteconf)
-    mu.migrate_image(image)
+    try:
+        mu = MigrateUtils(conf=siteconf, profile=profile, slim=slim)
+    except ValueError as ex:
+        sys.stderr.write(f"Error: {ex}... Exiting\n")
+        sys.exit(1)
+        return
+    if compile_python:
+        mu.compile_python = True
+    if run_async:
+        _migrate_async(siteconf, image, profile, progress_file, slim,
+                       compile_python)
+        sys.exit()
+        return
+    mu.progress = _progress(siteconf, progress_file)
+    try:
+        mu.migrate_image(image)
+    finally:
+        mu.progress.close()
+    sys.exit()
+
+
+def _progress(conf, progress_file=None):
+    """
+    Returns the progress reporter for a migration run from the command
+    line.
+    """
+    return MigrationProgress(jsonl=progress_file or conf.progress_file)
+
+
+def _migrate_async(conf, image, profile=None, progress_file=None,
+                   slim=None, compile_python=False):
+    """
+    Hand the migration of an image to a detached worker process.  The
+    worker runs in its own session with its output going to a log file
+    in the squash directory, so it survives the login shell exiting.
+    """
+    mdir = os.path.join(conf.squash_dir, "migrations")
+    os.makedirs(mdir, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9_.-]", "_", image)
+    log = os.path.join(mdir, f"{name}.log")
+    cmd = [sys.executable, "-m", "podman_hpc.podman_hpc",
+           "--squash-dir", conf.squash_dir, "migrate", image]
+    if profile:
+        cmd.extend(["--profile", profile])
+    if slim:
+        cmd.extend(["--slim", slim])
+    if compile_python:
+        cmd.append("--compile-python")
+    if progress_file:
+        cmd.extend(["--progress-file", os.path.abspath(progress_file)])
+    with open(log, "ab") as out:
+        proc = Popen(cmd, stdin=DEVNULL, stdout=out, stderr=STDOUT,
+                     start_new_session=True)
+    sys.stdout.write(
+        f"INFO: Migrating {image} in the background (pid {proc.pid}, "
+        f"log {log})\n"
+        "INFO: Use podman-hpc migrate-status to check progress\n"
+    )
+    return proc
+
+
+def _format_age(seconds):
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds < 120:
+        return f"{seconds}s"
+    if seconds < 7200:
+        return f"{seconds // 60}m"
+    return f"{seconds // 3600}h"
+
+
+def format_status(statuses):
+    """
+    Format migration statuses as a table.
+    """
+    lines = [f"{'IMAGE':<32} {'ID':<12} {'STATE':<8} {'STEP':<10} "
+             f"{'PROGRESS':>8} {'ETA':>5} {'STARTED':>7}  WORKER"]
+    now = time.time()
+    for st in statuses:
+        progress = "-"
+        if st["bytes_total"]:
+            pct = 100 * st["bytes_done"] / st["bytes_total"]
+            progress = f"{min(pct, 100):.0f}%"
+        eta = _format_age(st["eta"]) if st["state"] == "running" else "-"
+        lines.append(
+            f"{str(st['image'])[:32]:<32} {st['id'][:12]:<12} "
+            f"{st['state']:<8} {str(st['step'] or '-'):<10} "
+            f"{progress:>8} {eta:>5} "
+            f"{_format_age(now - st['started']):>7}  "
+            f"{st['host']}:{st['pid']}"
+        )
+        if st.get("error"):
+            lines.append(f"    error: {st['error']}")
+    return "\n".join(lines)
+
+
+# podman-hpc migrate-status subcommand #####################################
+@podhpc.command(options_metavar="[options]")
+@pass_siteconf
+@click.option("--json", "as_json", is_flag=True, help="Print JSON")
+def migrate_status(siteconf, as_json):
+    """List in-flight and recent migrations."""
+    statuses = MigrationStatus.list(ImageStore(siteconf.squash_dir))
+    if as_json:
+        print(json.dumps(statuses, indent=2))
+    else:
+        print(format_status(statuses))
+    sys.exit()
+
+
+# podman-hpc import-squash subcommand ######################################
+@podhpc.command(options_metavar="[options]")
+@pass_siteconf
+@click.option("--name", type=str, help="Name for the imported image")
+@click.option("--profile", type=str, help="Squash profile to use")
+@click.argument("archive", type=str)
+def import_squash(siteconf, archive, name, profile):
+    """Import a docker-archive or OCI archive as a squashed image.
+
+    The archive (e.g. from docker save, or - for stdin) is read in one
+    pass and squashed directly into the squash directory without
+    loading it into podman first.
+    """
+    try:
+        imp = ArchiveImporter(conf=siteconf, profile=profile)
+        ids = imp.import_archive(archive, name=name)
+    except (ValueError, OSError, tarfile.TarError) as ex:
+        sys.stderr.write(f"Error: {ex}... Exiting\n")
+        sys.exit(1)
+    for img_id in ids:
+        print(img_id)
+    sys.exit()
+
+
+# podman-hpc export-squash subcommand ######################################
+@podhpc.command(options_metavar="[options]")
+@pass_siteconf
+@click.option(
+    "-o",
+    "--output",
+    type=str,
+    required=True,
+    help="Bundle file to write (- for stdout)",
+)
+@click.argument("image", type=str)
+def export_squash(siteconf, image, output):
+    """Export a squashed image as a single bundle file.
+
+    The bundle holds the squash file and the image store metadata and
+    can be restored with import-squash-bundle.
+    """
+    store = ImageStore(siteconf.squash_dir)
+    try:
+        export_bundle(store, image, output)
+    except (ValueError, OSError) as ex:
+        sys.stderr.write(f"Error: {ex}... Exiting\n")
+        sys.exit(1)
+    sys.exit()
+
+
+# podman-hpc import-squash-bundle subcommand ###############################
+@podhpc.command(options_metavar="[options]")
+@pass_siteconf
+@click.argument("bundle", type=str)
+def import_squash_bundle(siteconf, bundle):
+    """Import a bundle written by export-squash (- for stdin)."""
+    store = ImageStore(siteconf.squash_dir, read_only=False)
+    try:
+        img_id = import_bundle(store, bundle)
+    except (ValueError, OSError, tarfile.TarError) as ex:
+        sys.stderr.write(f"Error: {ex}... Exiting\n")
+        sys.exit(1)
+    print(img_id)
+    sys.exit()
+
+
+# podman-hpc verify subcommand #############################################
+@podhpc.command(options_metavar="[options]")
+@pass_siteconf
+@click.option(
+    "--jobs",
+    type=int,
+    default=4,
+    help="Number of squash files to check in parallel",
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Read every file even if it was verified before",
+)
+@click.argument("images", nargs=-1, type=str)
+def verify(siteconf, images, jobs, no_cache):
+    """Verify squash files against their recorded checksums.
+
+    Checks the given images (default: all squashed images).  Files that
+    were verified before and haven't changed are not read again.
+    """
+    store = ImageStore(siteconf.squash_dir)
+    verifier = SquashVerifier(store, jobs=jobs, use_cache=not no_cache)
+    results = verifier.verify_images(images)
+    print(format_verify_results(results))
+    bad = [r for r in results if r["result"] not in ("ok", "unverified")]
+    sys.exit(1 if bad else 0)
+
+
+# podman-hpc find subcommand ###############################################
+@podhpc.command(options_metavar="[options]")
+@pass_siteconf
+@click.argument("pattern", type=str)
+def find(siteconf, pattern):
+    """Find files in squashed images without mounting them.
+
+    PATTERN is a glob.  Without a / it matches file names, otherwise
+    the full path.  Only images with a content index are searched.
+    """
+    store = ImageStore(siteconf.squash_dir)
+    for image, pth in find_files(store, pattern):
+        print(f"{image}\t{pth}")
+    sys.exit()
+
+
+# podman-hpc diff subcommand ###############################################
+@podhpc.command(options_metavar="[options]")
+@pass_siteconf
+@click.argument("image1", type=str)
+@click.argument("image2", type=str)
+def diff(siteconf, image1, image2):
+    """Compare the files of two squashed images.
+
+    Prints A (added), D (deleted) or M (modified) for every path that
+    differs between IMAGE1 and IMAGE2.
+    """
+    store = ImageStore(siteconf.squash_dir)
+    try:
+        changes = diff_indexes(image_index(store, image1),
+                               image_index(store, image2))
+    except (OSError, ValueError) as ex:
+        sys.stderr.write(f"Error: {ex}... Exiting\n")
+        sys.exit(1)
+        return
+    for change, pth in changes:
+        print(f"{change} /{pth}")
+    sys.exit()
+
+
+# podman-hpc squash-bench subcommand #######################################
+@podhpc.command(options_metavar="[options]")
+@pass_siteconf
+@click.option(
+    "--profile",
+    "profiles",
+    type=str,
+    multiple=True,
+    help="Squash profile to test (default: all profiles)",
+)
+@click.option(
+    "--slim",
+    "slims",
+    type=str,
+    multiple=True,
+    help="Slim profile to compare against no slimming",
+)
+@click.option(
+    "--workdir",
+    type=str,
+    help="Directory for the test squash files (default: /tmp)",
+)
+@click.argument("image", type=str)
+def squash_bench(siteconf, image, profiles, slims, workdir):
+    """Compare squash profiles for an image.
+
+    The image is squashed with each profile and the build time, squash
+    file size and squashfuse read throughput are reported.  With --slim
+    each profile is also built with the slim profiles and the bytes they
+    save are reported.
+    """
+    profiles = profiles or list(siteconf.squash_profiles)
+    try:
+        mu = MigrateUtils(conf=siteconf, slim="none")
+        for slim in slims:
+            mu.get_exclude_options(slim)
+    except ValueError as ex:
+        sys.stderr.write(f"Error: {ex}... Exiting\n")
+        sys.exit(1)
+        return
+    workdir = tempfile.mkdtemp(prefix="squash-bench-", dir=workdir)
+    try:
+        results = run_squash_bench(mu, image, profiles, workdir,
+                                   siteconf.squashfuse_bin, slims)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(format_results(results))
+    sys.exit()
+
+
+# podman-hpc hook-report subcommand ########################################
+@podhpc.command("hook-report", options_metavar="[options]")
+@pass_siteconf
+@click.option(
+    "--file",
+    "timing_file",
+    type=str,
+    help="Timing records to read (default: hook_timing_file)",
+)
+@click.option(
+    "--since",
+    type=float,
+    help="Only report hooks started in the last SINCE seconds",
+)
+@click.option(
+    "--json", "as_json", is_flag=True, help="Print the summary as JSON"
+)
+def hook_report(siteconf, timing_file, since, as_json):
+    """Summarize the timing records of the OCI hook.
+
+    The hook appends a record per phase (plan, setns, actions, ldconfig
+    or ldcache, total) and per module rule (e.g. gpu:bind[0]) to
+    hook_timing_file.  This prints percentiles of their durations
+    across the containers started on this node.
+    """
+    timing_file = timing_file or siteconf.hook_timing_file
+    if not timing_file:
+        sys.stderr.write("Error: hook_timing_file is not set... Exiting\n")
+        sys.exit(1)
+        return
+    try:
+        records = read_records(timing_file)
+    except OSError as ex:
+        sys.stderr.write(f"Error: {ex}... Exiting\n")
+        sys.exit(1)
+        return
+    summary = summarize(records,
+                        time.time() - since if since is not None else None)
+    if as_json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(format_report(summary))
+    sys.exit()
+
+
+# podman-hpc trace-merge subcommand ########################################
+@podhpc.command("trace-merge", options_metavar="[options]")
+@pass_siteconf
+@click.option(
+    "--id", "trace_id", type=str, help="Only merge the spans of this launch"
+)
+@click.option(
+    "--output", "-o", type=str, help="Write the trace to a file"
+)
+@click.argument("trace_dir", type=str, required=False)
+def trace_merge(siteconf, trace_id, output, trace_dir):
+    """Merge launch traces into a Chrome trace event file.
+
+    With PODMANHPC_TRACE=<dir> set, podman-hpc, the OCI hook and
+    fuse-overlayfs-wrap write spans to <dir> tagged with the job step
+    and rank.  This merges them (from TRACE_DIR, default
+    $PODMANHPC_TRACE) into one JSON document that can be opened in
+    chrome://tracing or Perfetto.
+    """
+    trace_dir = trace_dir or os.environ.get(TRACE_ENV)
+    if not trace_dir or not os.path.isdir(trace_dir):
+        sys.stderr.write("Error: no trace directory given... Exiting\n")
+        sys.exit(1)
+        return
+    trace = merge_traces(trace_dir, trace_id)
+    if output:
+        with open(output, "w") as f:
+            json.dump(trace, f)
+        spans = sum(1 for ev in trace["traceEvents"] if ev["ph"] == "X")
+        sys.stdout.write(f"INFO: Wrote {spans} spans to {output}\n")
+    else:
+        print(json.dumps(trace))
     sys.exit()
 
 
@@ -203,24 +627,196 @@ def images(ctx, siteconf, image, podman_args, **site_opts):
 )
 @pass_siteconf
 @click.pass_context
+@click.option(
+    "--direct/--no-direct",
+    default=None,
+    help="Pull into a temporary staging store instead of the local "
+    "graph root and keep only the squashed copy",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Pull even if the image is already squashed",
+)
+@click.option(
+    "--async",
+    "run_async",
+    is_flag=True,
+    help="Migrate in a background process after the pull "
+    "(see migrate-status)",
+)
 @click.argument("podman_args", nargs=-1, type=click.UNPROCESSED)
 @click.argument("image")
-def pull(ctx, siteconf, image, podman_args, **site_opts):
+def pull(ctx, siteconf, image, podman_args, direct, refresh, run_async,
+         **site_opts):
     """Pulls an image to a local repository and makes a squashed copy."""
+    if not refresh and _squashed_image(siteconf, image):
+        sys.stdout.write(f"INFO: {image} is already squashed in "
+                         f"{siteconf.squash_dir} (use --refresh to pull "
+                         "again)\n")
+        return
+    if direct is None:
+        # The direct pull's staging store can't outlive the command
+        direct = siteconf.direct_pull and not run_async
+    if direct and run_async:
+        sys.stderr.write("Error: --async can't be used with --direct... "
+                         "Exiting\n")
+        sys.exit(1)
+        return
+    if direct:
+        _direct_pull(siteconf, image, podman_args, site_opts)
+        return
     cmd = [siteconf.podman_bin, "pull"]
     cmd.extend(podman_args)
     cmd.extend(siteconf.get_cmd_extensions("pull", site_opts))
     cmd.append(image)
     proc = Popen(cmd)
     proc.communicate()
-    if proc.returncode == 0:
+    if proc.returncode == 0 and run_async:
+        _migrate_async(siteconf, image)
+    elif proc.returncode == 0:
         sys.stdout.write(f"INFO: Migrating image to {siteconf.squash_dir}\n")
         mu = MigrateUtils(conf=siteconf)
-        mu.migrate_image(image)
+        mu.progress = _progress(siteconf)
+        if mu.migrate_image(image):
+            _touch_squash(siteconf, image)
+        mu.progress.close()
     else:
         sys.stderr.write("Pull failed.\n")
         sys.exit(proc.returncode)
 
+
+def _squash_file(conf, image):
+    """
+    Returns the squash file of an image in the squash directory or None.
+    This only reads images.json, so it is cheap enough to run on every
+    pull.
+    """
+    store = ImageStore(conf.squash_dir)
+    img_info, _ = store.get_img_info(image)
+    if not img_info:
+        return None
+    try:
+        link = store.read_link_file(img_info["layer"])
+    except OSError:
+        return None
+    return store.get_squash_filename(link)
+
+
+def _squashed_image(conf, image):
+    """
+    Returns True if the image is already squashed and not older than
+    pull_ttl seconds (if set).
+    """
+    sqf = _squash_file(conf, image)
+    if not sqf:
+        return False
+    try:
+        age = time.time() - os.path.getmtime(sqf)
+    except OSError:
+        return False
+    return conf.pull_ttl is None or age <= conf.pull_ttl
+
+
+def _touch_squash(conf, image):
+    """
+    Restart the pull_ttl clock of a squashed image after a pull found it
+    up to date.
+    """
+    sqf = _squash_file(conf, image)
+    try:
+        if sqf:
+            os.utime(sqf)
+    except OSError:
+        pass
+
+
+def _dir_usage(path):
+    """
+    Returns the disk usage of a directory tree in bytes.  Entries that
+    can't be read (e.g. owned by a subuid) are skipped.
+    """
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            total += st.st_blocks * 512
+    return total
+
+
+class UsageMonitor(Thread):
+    """
+    Thread that samples the disk usage of a directory and tracks the
+    peak value.
+    """
+
+    def __init__(self, path, interval=0.5):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._done = Event()
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, _dir_usage(self.path))
+            if self._done.wait(self.interval):
+                break
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return self.peak
+
+
+def _direct_pull(conf, image, podman_args, site_opts):
+    """
+    Pull an image into a temporary store in the staging directory,
+    migrate it from there into the squash directory and discard the
+    temporary store.  The image never lands in the graph root.
+    """
+    os.makedirs(conf.squash_staging_dir, exist_ok=True)
+    stage = tempfile.mkdtemp(prefix="pull-", dir=conf.squash_staging_dir)
+    root = os.path.join(stage, "storage")
+    runroot = os.path.join(stage, "run")
+    start = time.time()
+    usage = UsageMonitor(stage)
+    usage.start()
+    try:
+        cmd = [conf.podman_bin, "pull"]
+        cmd.extend(podman_args)
+        cmd.extend(conf.get_cmd_extensions("pull", site_opts))
+        # The last --root/--runroot wins
+        cmd.extend(["--root", root, "--runroot", runroot])
+        cmd.append(image)
+        proc = Popen(cmd)
+        proc.communicate()
+        if proc.returncode != 0:
+            sys.stderr.write("Pull failed.\n")
+            sys.exit(proc.returncode)
+        sys.stdout.write(f"INFO: Migrating image to {conf.squash_dir}\n")
+        mu = MigrateUtils(src=root, conf=conf)
+        mu.src_run_root = runroot
+        mu.progress = _progress(conf)
+        ok = mu.migrate_image(image)
+        if ok:
+            _touch_squash(conf, image)
+    finally:
+        peak = usage.stop()
+        # Files in the store may be owned by subuids
+        Popen([conf.podman_bin, "unshare", "rm", "-rf", stage],
+              stdout=PIPE, stderr=PIPE).communicate()
+        shutil.rmtree(stage, ignore_errors=True)
+    sys.stdout.write(
+        f"INFO: Direct pull took {time.time() - start:.1f}s, "
+        f"peak staging use {peak / 2**20:.1f} MiB\n"
+    )
+    if not ok:
+        sys.exit(1)
+
 # podman-hpc shared-run subcommand #########################################
 @podhpc.command(
     context_settings=dict(
@@ -262,6 +858,7 @@ def _shared_run(conf, run_args, **site_opts):
     that has shared_run set to True. 
     """
 
+    prepare_start = time.time()
     localid = os.environ.get(conf.localid_var)
     ntasks_raw = os.environ.get(conf.tasks_per_node_var, "1")
     ntasks = int(re.search(conf.ntasks_pattern, ntasks_raw)[0])
@@ -270,28 +867,33 @@ def _shared_run(conf, run_args, **site_opts):
 
     # construct run and exec commands from user options
     # We need to filter out any run args in the run_args
-    cmd = [conf.podman_bin, "run", "--help"]
-    valid_params = cpt.filterValidOptions(list(run_args), cmd)
-    # Find the first occurence not in the valid list
-    idx = 0
-    for idx, item in enumerate(run_args):
-        if item in valid_params:
-            continue
-        break
-    image = run_args[idx]
-    container_cmd = run_args[idx+1:]
+    _, image, container_cmd = _split_run_args(conf, run_args)
     # TODO: maybe do some validation on the iamge and container_cmd
 
     options = sys.argv[
         sys.argv.index("shared-run") + 1: sys.argv.index(image)
     ]
+    run_options = cpt.filterValidOptions(
+        options, [conf.podman_bin, "run", "--help"]
+    )
 
     run_cmd = [conf.podman_bin, "run", "--rm", "-d", "--name", container_name]
-    run_cmd.extend(
-        cpt.filterValidOptions(options, [conf.podman_bin, "run", "--help"])
-    )
-    run_cmd.extend(conf.get_cmd_extensions("run", site_opts))
-    run_cmd.append(image)
+    run_ext = conf.get_cmd_extensions("run", site_opts)
+    squash_rootfs = None
+    if conf.read_only_squash:
+        try:
+            squash_rootfs = SquashRootfs(conf, image)
+            squash_args = squash_rootfs.run_args(run_options)
+        except (OSError, ValueError) as ex:
+            sys.stderr.write(f"Error: {ex}... Exiting\n")
+            sys.exit(1)
+            return
+        run_cmd.extend(run_ext)
+        run_cmd.extend(squash_args)
+    else:
+        run_cmd.extend(run_options)
+        run_cmd.extend(run_ext)
+        run_cmd.append(image)
     run_cmd.extend(conf.shared_run_command)
 
     exec_cmd = [
@@ -307,12 +909,23 @@ def _shared_run(conf, run_args, **site_opts):
     exec_cmd.extend([container_name] + list(container_cmd))
     # click.echo(f"run_cmd is: {run_cmd}")
     # click.echo(f"exec_cmd is: {exec_cmd}")
+    # Building the commands runs podman --help to filter the options
+    tracer.add("prepare", prepare_start, ntasks=ntasks, localid=localid)
 
     # Start monitor and run threads
     monitor_thread = None
     run_thread = None
     proc = None
     if (localid is None or int(localid) == 0):
+        if squash_rootfs:
+            try:
+                with tracer.span("squash-mount"):
+                    squash_rootfs.mount()
+            except OSError as ex:
+                squash_rootfs.release()
+                sys.stderr.write(f"Error: {ex}... Exiting\n")
+                sys.exit(1)
+                return
         monitor_thread = Process(target=monitor, args=(sock_name, ntasks,
                                                        container_name, conf))
         monitor_thread.start()
@@ -325,29 +938,34 @@ def _shared_run(conf, run_args, **site_opts):
         start_time = time.time()
         wait_poll_interval = _param_scale_log2(ntasks, conf.wait_poll_interval)
         wait_timeout = _param_scale_log2(ntasks, conf.wait_timeout)
-        while True:
-            time.sleep(wait_poll_interval)
-            if podman_devnull(comm, conf) == 0:
-                break
-            if time.time() - start_time > wait_timeout:
-                msg = "Timeout waiting for shared-run start"
-                raise OSError(msg)
-            if run_thread and run_thread.exitcode:
-                raise OSError("Failed to start container")
+        with tracer.span("wait-exists", polls=0) as span:
+            while True:
+                time.sleep(wait_poll_interval)
+                span["polls"] += 1
+                if podman_devnull(comm, conf) == 0:
+                    break
+                if time.time() - start_time > wait_timeout:
+                    msg = "Timeout waiting for shared-run start"
+                    raise OSError(msg)
+                if run_thread and run_thread.exitcode:
+                    raise OSError("Failed to start container")
         comm = ["wait", "--condition", "running", container_name]
-        podman_devnull(comm, conf)
+        with tracer.span("wait-running"):
+            podman_devnull(comm, conf)
         fds = [0, 1, 2]
         if 'PMI_FD' in os.environ:
             fds.append(int(os.environ['PMI_FD']))
             conf.env["PMI_FD"] = os.environ["PMI_FD"]
-        proc = Popen(exec_cmd, env=conf.env, pass_fds=fds)
-        proc.communicate()
-        send_complete(sock_name, localid)
-        # Close out threads
-        if monitor_thread:
-            monitor_thread.join()
-        if run_thread:
-            run_thread.join()
+        with tracer.span("exec"):
+            proc = Popen(exec_cmd, env=conf.env, pass_fds=fds)
+            proc.communicate()
+        with tracer.span("teardown"):
+            send_complete(sock_name, localid)
+            # Close out threads
+            if monitor_thread:
+                monitor_thread.join()
+            if run_thread:
+                run_thread.join()
     except Exception as ex:
         sys.stderr.write(str(ex))
         if monitor_thread:
@@ -358,12 +976,70 @@ def _shared_run(conf, run_args, **site_opts):
         if os.path.exists(sock_name):
             os.remove(sock_name)
     finally:
+        if squash_rootfs:
+            squash_rootfs.release()
         exit_code = 1
         if proc:
             exit_code = proc.returncode
         sys.exit(exit_code)
 
 
+def _split_run_args(conf, run_args):
+    """
+    Split podman run arguments into the run options, the image and
+    the container command.
+    """
+    cmd = [conf.podman_bin, "run", "--help"]
+    valid_params = cpt.filterValidOptions(list(run_args), cmd)
+    # Find the first occurence not in the valid list
+    idx = 0
+    for idx, item in enumerate(run_args):
+        if item in valid_params:
+            continue
+        break
+    return list(run_args[:idx]), run_args[idx], list(run_args[idx+1:])
+
+
+def _read_only_squash_run(conf, cmd, podman_args):
+    """
+    Run a container with the squashed image mounted as a read-only
+    rootfs instead of going through fuse-overlayfs.
+
+    Inputs:
+    conf: a podman_hpc config object
+    cmd: podman run command with the site extensions
+    podman_args: arguments given by the user
+    """
+    options, image, container_cmd = _split_run_args(conf, podman_args)
+    try:
+        squash_rootfs = SquashRootfs(conf, image)
+        cmd.extend(squash_rootfs.run_args(options))
+        cmd.extend(squash_rootfs.command(options, container_cmd))
+    except (OSError, ValueError) as ex:
+        sys.stderr.write(f"Error: {ex}... Exiting\n")
+        sys.exit(1)
+        return
+    fds = [0, 1, 2]
+    if 'PMI_FD' in os.environ:
+        fds.append(int(os.environ['PMI_FD']))
+        conf.env["PMI_FD"] = os.environ["PMI_FD"]
+    try:
+        with tracer.span("squash-mount"):
+            squash_rootfs.mount()
+    except OSError as ex:
+        squash_rootfs.release()
+        sys.stderr.write(f"Error: {ex}... Exiting\n")
+        sys.exit(1)
+        return
+    try:
+        with tracer.span("run"):
+            proc = Popen(cmd, env=conf.env, pass_fds=fds)
+            proc.communicate()
+    finally:
+        squash_rootfs.release()
+    sys.exit(proc.returncode)
+
+
 # podman-hpc call_podman subcommand (default, hidden, passthrough) #########
 @podhpc.default_command(
     context_settings=dict(ignore_unknown_options=True, help_option_names=[]),
@@ -410,9 +1086,14 @@ def call_podman(ctx, siteconf, help, podman_args, **site_opts):
                 if arg == "run":
                     sys.argv[idx] = "shared-run"
             _shared_run(siteconf, podman_args, **site_opts)
+        elif siteconf.read_only_squash and ctx.info_name == "run":
+            cmd = cmd[:len(cmd) - len(podman_args)]
+            _read_only_squash_run(siteconf, cmd, podman_args)
         else:
             if 'PMI_FD' in os.environ:
                 siteconf.env["PMI_FD"] = os.environ["PMI_FD"]
+            # atexit handlers don't run after exec
+            tracer.close()
             os.execve(cmd[0], cmd, siteconf.env)
 
 
@@ -11,6 +11,9 @@ from glob import glob
 
 _ENV_PREFIX = "PODMANHPC"
 _MOD_ENV = f"{_ENV_PREFIX}_MODULES_DIR"
+_HOOK_CACHE_ENV = f"{_ENV_PREFIX}_HOOK_CACHE"
+_HOOK_JOBS_ENV = f"{_ENV_PREFIX}_HOOK_JOBS"
+_HOOK_TIMING_ENV = f"{_ENV_PREFIX}_HOOK_TIMING"
 _HOOKS_ANNO = "podman_hpc.hook_tool"
 _CONF_ENV = f"{_ENV_PREFIX}_CONFIG_FILE"
 
@@ -27,11 +30,16 @@ class SiteConfig:
 
     _default_conf_file = "/etc/podman_hpc/podman_hpc.yaml"
     _valid_params = ["podman_bin", "mount_program", "modules_dir",
+                     "hook_cache_dir", "hook_jobs", "hook_timing_file",
                      "shared_run_exec_args", "shared_run_command",
                      "graph_root", "run_root",
                      "additional_stores", "hooks_dir",
                      "localid_var", "tasks_per_node_var", "ntasks_pattern",
-                     "config_home", "mksquashfs_bin",
+                     "config_home", "mksquashfs_bin", "squashfuse_bin",
+                     "squash_profiles", "squash_profile",
+                     "slim_profiles", "slim_profile", "compile_python",
+                     "squash_staging_dir", "squash_index",
+                     "direct_pull", "pull_ttl", "progress_file",
                      "wait_timeout", "wait_poll_interval",
                      "use_default_args",
                      ]
@@ -52,6 +60,9 @@ class SiteConfig:
         "SQUASH_DIR", f'{os.environ.get("SCRATCH", "/tmp")}/storage'
     )
     modules_dir = "/etc/podman_hpc/modules.d"
+    hook_cache_dir = None
+    hook_jobs = 1
+    hook_timing_file = None
     shared_run_exec_args = ["-e", "SLURM_*", "-e", "PALS_*", "-e", "PMI_*"]
     use_default_args = True
     shared_run_command = ["sleep", "infinity"]
@@ -62,9 +73,38 @@ class SiteConfig:
     tasks_per_node_var = "SLURM_STEP_TASKS_PER_NODE"
     ntasks_pattern = r'[0-9]+'
     mksquashfs_bin = "mksquashfs.static"
+    squashfuse_bin = "squashfuse"
+    squash_profiles = {
+        "default": {"compression": "lz4"},
+        "lz4-hc": {"compression": "lz4", "options": ["-Xhc"]},
+        "zstd": {"compression": "zstd", "block_size": "1M"},
+        "gzip": {"compression": "gzip"},
+    }
+    squash_profile = "default"
+    slim_profiles = {
+        "safe": {"exclude": [
+            "var/cache/apt/archives/*.deb",
+            "var/cache/yum/*", "var/cache/dnf/*",
+            "root/.cache/*", "tmp/*", "var/tmp/*",
+        ]},
+        "docs": {"exclude": [
+            "var/cache/apt/archives/*.deb",
+            "var/cache/yum/*", "var/cache/dnf/*",
+            "root/.cache/*", "tmp/*", "var/tmp/*",
+            "usr/share/doc/*", "usr/share/man/*", "usr/share/info/*",
+        ]},
+    }
+    slim_profile = None
+    compile_python = False
+    squash_staging_dir = f"{_xdg_base}/staging"
+    squash_index = False
+    direct_pull = False
+    pull_ttl = None
+    progress_file = None
     wait_poll_interval = 0.2
     wait_timeout = 10
     shared_run = False
+    read_only_squash = False
     source = dict()
 
     def __init__(self, squash_dir=None, log_level=None):
@@ -98,6 +138,19 @@ class SiteConfig:
                 float(self.wait_poll_interval)
         if isinstance(self.wait_timeout, str):
             self.wait_timeout = float(self.wait_timeout)
+        if isinstance(self.direct_pull, str):
+            self.direct_pull = \
+                self.direct_pull.lower() in ["1", "true", "yes"]
+        if isinstance(self.compile_python, str):
+            self.compile_python = \
+                self.compile_python.lower() in ["1", "true", "yes"]
+        if isinstance(self.squash_index, str):
+            self.squash_index = \
+                self.squash_index.lower() in ["1", "true", "yes"]
+        if isinstance(self.pull_ttl, str):
+            self.pull_ttl = float(self.pull_ttl)
+        if isinstance(self.hook_jobs, str):
+            self.hook_jobs = int(self.hook_jobs)
 
         if self.use_default_args is True:
             self.default_args = [
@@ -122,6 +175,17 @@ class SiteConfig:
                     "--env", f"{_MOD_ENV}={self.modules_dir}",
                     "--annotation", f"{_HOOKS_ANNO}=true",
                     ]
+            if self.hook_cache_dir:
+                cache_env = ["--env",
+                             f"{_HOOK_CACHE_ENV}={self.hook_cache_dir}"]
+                self.default_run_args.extend(cache_env)
+                self.default_build_args.extend(cache_env)
+            hook_env = ["--env", f"{_HOOK_JOBS_ENV}={self.hook_jobs}"]
+            if self.hook_timing_file:
+                hook_env.extend(["--env", f"{_HOOK_TIMING_ENV}="
+                                 f"{self.hook_timing_file}"])
+            self.default_run_args.extend(hook_env)
+            self.default_build_args.extend(hook_env)
             self.default_pull_args = [
                     "--storage-opt",
                     "ignore_chown_errors=true",
@@ -200,6 +264,10 @@ class SiteConfig:
             if isinstance(getattr(self, attr), list) and \
                isinstance(newval, str):
                 newval = newval.split(',')
+            # Dictionaries can be given as a YAML/JSON string
+            if isinstance(getattr(self, attr), dict) and \
+               isinstance(newval, str):
+                newval = load(newval, Loader=FullLoader)
             setattr(self, attr, newval)
             self.source[attr] = source
         else:
@@ -403,6 +471,8 @@ class SiteConfig:
             cmds.extend(["-e", f"{mconf['env']}=1"])
             if mconf.get("shared_run"):
                 self.shared_run = True
+            if mconf.get("read_only_squash"):
+                self.read_only_squash = True
 
         # Restore the original formatter
         warnings.formatwarning = original_formatwarning
@@ -0,0 +1,153 @@
+import os
+import time
+import logging
+from subprocess import Popen, PIPE
+
+
+def unmount(mount_dir, retries=5, delay=0.5):
+    """
+    Unmount a squashfuse mount, retrying while it is busy.  Returns True
+    once it is unmounted.
+
+    Inputs:
+    mount_dir: mount point
+    retries: number of attempts
+    delay: seconds to wait between attempts
+    """
+    for i in range(retries):
+        proc = Popen(["fusermount", "-u", mount_dir], stdout=PIPE,
+                     stderr=PIPE)
+        _, err = proc.communicate()
+        if proc.returncode == 0 or not os.path.ismount(mount_dir):
+            return True
+        logging.debug(f"Retry unmount of {mount_dir}: {err.decode()}")
+        if i < retries - 1:
+            time.sleep(delay)
+    return False
+
+
+def read_throughput(squash_file, mount_dir, squashfuse_bin="squashfuse",
+                    block=8 << 20):
+    """
+    Mount a squash file with squashfuse and read every file in it.
+    Returns a dictionary with the bytes read and the read throughput, or
+    an empty dictionary if the file couldn't be mounted.
+
+    Inputs:
+    squash_file: squash file to read
+    mount_dir: directory to mount it on
+    squashfuse_bin: squashfuse binary
+    block: read size
+    """
+    os.makedirs(mount_dir, exist_ok=True)
+    proc = Popen([squashfuse_bin, squash_file, mount_dir],
+                 stdout=PIPE, stderr=PIPE)
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        logging.warning(f"Unable to mount {squash_file}: {err.decode()}")
+        os.rmdir(mount_dir)
+        return {}
+    nbytes = 0
+    start = time.time()
+    try:
+        for root, _, files in os.walk(mount_dir):
+            for fn in files:
+                pth = os.path.join(root, fn)
+                if os.path.islink(pth) or not os.path.isfile(pth):
+                    continue
+                try:
+                    with open(pth, "rb", buffering=0) as f:
+                        while True:
+                            buf = f.read(block)
+                            if not buf:
+                                break
+                            nbytes += len(buf)
+                except OSError:
+                    continue
+        elapsed = time.time() - start
+    finally:
+        if unmount(mount_dir):
+            os.rmdir(mount_dir)
+        else:
+            logging.warning(f"Unable to unmount {mount_dir}, leaving it "
+                            "mounted")
+    return {
+        "read_bytes": nbytes,
+        "read_seconds": elapsed,
+        "read_mb_per_sec": nbytes / elapsed / 2**20 if elapsed else 0,
+    }
+
+
+def run_squash_bench(mu, image, profiles, workdir,
+                     squashfuse_bin="squashfuse", slims=()):
+    """
+    Squash an image with several squash profiles and report the build
+    time, file size and read throughput of each.
+
+    Inputs:
+    mu: MigrateUtils object for the source store
+    image: image name
+    profiles: list of profile names
+    workdir: scratch directory for the squash files
+    squashfuse_bin: squashfuse binary
+    slims: list of slim profile names.  Each squash profile is also
+           built with these and the bytes saved are reported.
+    """
+    mu._lazy_init()
+    img_info, _ = mu.src.get_img_info(image)
+    if not img_info:
+        raise ValueError(f"Image {image} not found")
+    results = []
+    for name in profiles:
+        options = mu.get_mksq_options(name)
+        base = None
+        for slim in [None] + list(slims):
+            label = f"{name}+{slim}" if slim else name
+            sqname = f"bench-{label}.squash"
+            sqfile = os.path.join(workdir, sqname)
+            logging.info(f"Squashing {image} with profile {label}")
+            start = time.time()
+            ok = mu._run_mksq(img_info["id"], workdir, sqname, options,
+                              mu.get_exclude_options(slim))
+            res = {
+                "profile": label,
+                "slim": slim,
+                "options": " ".join(options),
+                "ok": ok,
+                "build_seconds": time.time() - start,
+            }
+            if ok and os.path.exists(sqfile):
+                res["size"] = os.path.getsize(sqfile)
+                if slim is None:
+                    base = res["size"]
+                elif base is not None:
+                    res["saved"] = base - res["size"]
+                mnt = os.path.join(workdir, f"bench-{label}.mnt")
+                res.update(read_throughput(sqfile, mnt, squashfuse_bin))
+                os.unlink(sqfile)
+            results.append(res)
+    return results
+
+
+def format_results(results):
+    """
+    Format the benchmark results as a table.
+    """
+    slim = any(res.get("slim") for res in results)
+    lines = [f"{'PROFILE':<16} {'BUILD (s)':>10} {'SIZE (MiB)':>11} "
+             f"{'READ (MiB/s)':>13}" + (f" {'SAVED (MiB)':>12}"
+                                        if slim else "")]
+    for res in results:
+        if not res["ok"]:
+            lines.append(f"{res['profile']:<16} {'failed':>10}")
+            continue
+        size = f"{res.get('size', 0) / 2**20:.1f}"
+        read = "n/a"
+        if "read_mb_per_sec" in res:
+            read = f"{res['read_mb_per_sec']:.1f}"
+        line = (f"{res['profile']:<16} {res['build_seconds']:>10.1f} "
+                f"{size:>11} {read:>13}")
+        if slim and "saved" in res:
+            line += f" {res['saved'] / 2**20:>12.1f}"
+        lines.append(line)
+    return "\n".join(lines)
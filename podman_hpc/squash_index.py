@@ -0,0 +1,288 @@
+import os
+import re
+import json
+import stat
+import zlib
+import shutil
+import hashlib
+import logging
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
+
+INDEX_MAGIC = b"PHIDX1\n"
+INDEX_COLUMNS = ["paths", "sizes", "modes", "hashes"]
+HASH_SIZE = 8
+READ_SIZE = 1 << 20
+
+
+def index_filename(sqf):
+    """
+    Returns the name of the content index of a squash file.
+    """
+    return f"{sqf}.idx"
+
+
+def _hash_file(pth):
+    h = hashlib.blake2b(digest_size=HASH_SIZE)
+    try:
+        with open(pth, "rb", buffering=0) as f:
+            while True:
+                buf = f.read(READ_SIZE)
+                if not buf:
+                    break
+                h.update(buf)
+    except OSError:
+        return b"\0" * HASH_SIZE
+    return h.digest()
+
+
+def build_index(root, attrs=None, jobs=8):
+    """
+    Walk a root filesystem tree and return its index columns.  Paths
+    are relative to root and sorted.  Regular files get a content hash,
+    everything else a hash of zeros.
+
+    Inputs:
+    root: directory to index
+    attrs: optional dictionary of relative path to (mode, uid, gid) that
+           overrides the permission bits found on disk
+    jobs: number of files to hash in parallel
+    """
+    entries = []
+    for dirpath, dirs, files in os.walk(root):
+        for name in dirs + files:
+            pth = os.path.join(dirpath, name)
+            rel = os.path.relpath(pth, root)
+            if "\n" in rel:
+                continue
+            try:
+                st = os.lstat(pth)
+            except OSError:
+                continue
+            mode = st.st_mode
+            if attrs and rel in attrs:
+                mode = stat.S_IFMT(mode) | attrs[rel][0]
+            entries.append((rel, st.st_size, mode, pth))
+    entries.sort()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        hashes = pool.map(
+            lambda e: _hash_file(e[3]) if stat.S_ISREG(e[2])
+            else b"\0" * HASH_SIZE, entries)
+        hashes = list(hashes)
+    return {
+        "paths": [e[0] for e in entries],
+        "sizes": [e[1] for e in entries],
+        "modes": [e[2] for e in entries],
+        "hashes": hashes,
+    }
+
+
+def write_index(fn, cols):
+    """
+    Write index columns to a file.  Each column is compressed separately
+    so a query only has to decompress the columns it needs.
+    """
+    blobs = {
+        "paths": "\n".join(cols["paths"]).encode("utf-8",
+                                                 "surrogateescape"),
+        "sizes": array("Q", cols["sizes"]).tobytes(),
+        "modes": array("I", cols["modes"]).tobytes(),
+        "hashes": b"".join(cols["hashes"]),
+    }
+    comp = {k: zlib.compress(v, 6) for k, v in blobs.items()}
+    header = {"count": len(cols["paths"]),
+              "columns": [[k, len(comp[k])] for k in INDEX_COLUMNS]}
+    tmp = f"{fn}.tmp-{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(json.dumps(header).encode() + b"\n")
+        for k in INDEX_COLUMNS:
+            f.write(comp[k])
+    os.rename(tmp, fn)
+
+
+def read_index(fn, columns=INDEX_COLUMNS):
+    """
+    Read the given columns of an index.  The paths column is returned as
+    the raw newline separated bytes (see index_paths).
+    """
+    res = {}
+    with open(fn, "rb") as f:
+        if f.readline() != INDEX_MAGIC:
+            raise ValueError(f"{fn} is not a squash index")
+        header = json.loads(f.readline())
+        for name, size in header["columns"]:
+            if name not in columns:
+                f.seek(size, os.SEEK_CUR)
+                continue
+            data = zlib.decompress(f.read(size))
+            if name == "sizes":
+                data = array("Q", data)
+            elif name == "modes":
+                data = array("I", data)
+            elif name == "hashes":
+                data = [data[i:i + HASH_SIZE]
+                        for i in range(0, len(data), HASH_SIZE)]
+            res[name] = data
+    res["count"] = header["count"]
+    return res
+
+
+def index_paths(paths):
+    """
+    Split the raw paths column into a list of strings.
+    """
+    if not paths:
+        return []
+    return paths.decode("utf-8", "surrogateescape").split("\n")
+
+
+def index_squash(sqf, mount_dir, out, squashfuse_bin="squashfuse"):
+    """
+    Build the index of a squash file by mounting it with squashfuse.
+
+    Inputs:
+    sqf: squash file
+    mount_dir: empty directory to mount it on
+    out: index file to write
+    squashfuse_bin: squashfuse binary
+
+    Raises OSError if squashfuse or fusermount isn't available or the
+    squash file can't be mounted.
+    """
+    for binary in [squashfuse_bin, "fusermount"]:
+        if not shutil.which(binary):
+            raise OSError(f"{binary} not found")
+    os.makedirs(mount_dir, exist_ok=True)
+    proc = Popen([squashfuse_bin, sqf, mount_dir], stdout=PIPE, stderr=PIPE)
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        os.rmdir(mount_dir)
+        raise OSError(f"Unable to mount {sqf}: {err.decode()}")
+    try:
+        cols = build_index(mount_dir)
+    finally:
+        proc = Popen(["fusermount", "-u", mount_dir],
+                     stdout=PIPE, stderr=PIPE)
+        _, err = proc.communicate()
+        if proc.returncode != 0:
+            logging.warning(f"Unable to unmount {mount_dir}: "
+                            f"{err.decode().strip()}")
+        else:
+            os.rmdir(mount_dir)
+    write_index(out, cols)
+
+
+def glob_regex(pattern):
+    """
+    Returns a multi-line regex for a glob pattern to scan the raw paths
+    column.  Patterns without a / match the file name, others match the
+    whole path.
+    """
+    any_char = "[^\\n]" if "/" in pattern else "[^/\\n]"
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "*":
+            out.append(f"{any_char}*")
+        elif c == "?":
+            out.append(any_char)
+        elif c == "[" and "]" in pattern[i + 1:]:
+            j = pattern.index("]", i + 1)
+            cls = pattern[i + 1:j].replace("\\", "\\\\")
+            if cls.startswith("!"):
+                cls = "^" + cls[1:]
+            out.append(f"[{cls}]")
+            i = j
+        else:
+            out.append(re.escape(c))
+        i += 1
+    core = "".join(out)
+    if "/" in pattern:
+        core = core.lstrip("/")
+        return re.compile(f"^{core}$".encode(), re.M)
+    return re.compile(f"^(?:[^\\n]*/)?{core}$".encode(), re.M)
+
+
+def _image_indexes(store):
+    """
+    Yields (image info, index file) for every image in a store that has
+    an index.
+    """
+    for img in store.images:
+        try:
+            link = store.read_link_file(img["layer"])
+        except OSError:
+            continue
+        idx = index_filename(store.get_squash_filename(link))
+        if os.path.exists(idx):
+            yield img, idx
+
+
+def find_files(store, pattern):
+    """
+    Find files matching a glob pattern in every indexed image of a
+    store.  Returns a list of (image name, path) tuples.
+    """
+    regex = glob_regex(pattern)
+    res = []
+    done = {}
+    for img, idx in _image_indexes(store):
+        name = (img.get("names") or [img["id"][:12]])[0]
+        if idx not in done:
+            try:
+                paths = read_index(idx, ["paths"])["paths"]
+            except (OSError, ValueError, zlib.error) as ex:
+                logging.warning(f"Skipping {idx}: {ex}")
+                continue
+            done[idx] = [m.group(0).decode("utf-8", "surrogateescape")
+                         for m in regex.finditer(paths)]
+        res.extend((name, "/" + p) for p in done[idx])
+    return res
+
+
+def load_index(fn):
+    """
+    Returns a dictionary of path to (size, mode, hash) for an index.
+    """
+    cols = read_index(fn)
+    paths = index_paths(cols["paths"])
+    return dict(zip(paths, zip(cols["sizes"], cols["modes"],
+                               cols["hashes"])))
+
+
+def diff_indexes(old, new):
+    """
+    Compare two indexes.  Returns a sorted list of (change, path) where
+    change is A (added), D (deleted) or M (modified).
+    """
+    a = load_index(old)
+    b = load_index(new)
+    res = []
+    for pth in a.keys() | b.keys():
+        if pth not in b:
+            res.append(("D", pth))
+        elif pth not in a:
+            res.append(("A", pth))
+        elif a[pth] != b[pth]:
+            # Directory sizes depend on the filesystem
+            if stat.S_ISDIR(a[pth][1]) and a[pth][1:] == b[pth][1:]:
+                continue
+            res.append(("M", pth))
+    return sorted(res, key=lambda r: r[1])
+
+
+def image_index(store, image):
+    """
+    Returns the index file of an image in a store.
+    """
+    img_info, _ = store.get_img_info(image)
+    if not img_info:
+        raise ValueError(f"Image {image} not found")
+    link = store.read_link_file(img_info["layer"])
+    idx = index_filename(store.get_squash_filename(link))
+    if not os.path.exists(idx):
+        raise ValueError(f"Image {image} has no index")
+    return idx
@@ -0,0 +1,139 @@
+import os
+import fcntl
+import logging
+from subprocess import Popen, PIPE
+from .migrate2scratch import ImageStore
+
+
+class SquashRootfs:
+    """
+    Class to run a container directly on the squash file of a migrated
+    image.  The squash file is mounted with squashfuse and handed to podman
+    as a read-only rootfs, so no fuse-overlayfs layer is stacked on top.
+
+    The mount is shared by all containers on the node that use the same
+    image.  Each user of the mount holds a shared lock on a lock file next
+    to the mount point and the last one out unmounts it.
+    """
+
+    def __init__(self, conf, image):
+        """
+        Inputs:
+        conf: a podman_hpc config object
+        image: image name or ID in the squash directory
+        """
+        self.conf = conf
+        self.store = ImageStore(conf.squash_dir)
+        self.img_info, _ = self.store.get_img_info(image)
+        if not self.img_info:
+            raise OSError(
+                f"Image {image} is not in {conf.squash_dir}. "
+                "Use podman-hpc pull or migrate first."
+            )
+        link = self.store.read_link_file(self.img_info["layer"])
+        self.squash_file = self.store.get_squash_filename(link)
+        if not os.path.exists(self.squash_file):
+            raise OSError(f"Squash file {self.squash_file} not found")
+        self.mount_dir = os.path.join(conf.run_root, "squash-rootfs", link)
+        self.lock_file = f"{self.mount_dir}.lock"
+        self._lock_fd = None
+
+    def _squashfuse(self):
+        com = [self.conf.squashfuse_bin, self.squash_file, self.mount_dir]
+        proc = Popen(com, stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            raise OSError(
+                f"Failed to mount {self.squash_file}: {err.decode()}"
+            )
+
+    def _unmount(self):
+        proc = Popen(["fusermount", "-u", self.mount_dir],
+                     stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate()
+        if proc.returncode != 0:
+            logging.warning(f"Failed to unmount {self.mount_dir}: "
+                            f"{err.decode()}")
+
+    def mount(self):
+        """
+        Mount the squash file (if it isn't already) and take a shared
+        lock on the mount.
+        """
+        os.makedirs(self.mount_dir, exist_ok=True)
+        self._lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT)
+        while True:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            if not os.path.ismount(self.mount_dir):
+                logging.debug(f"Mounting {self.squash_file}")
+                self._squashfuse()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+            # A releasing container may have unmounted it while the lock
+            # was converted.
+            if os.path.ismount(self.mount_dir):
+                return self.mount_dir
+
+    def release(self):
+        """
+        Drop our lock and unmount if nobody else is using the mount.
+        """
+        if self._lock_fd is None:
+            return
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.path.ismount(self.mount_dir):
+                self._unmount()
+        except BlockingIOError:
+            pass
+        os.close(self._lock_fd)
+        self._lock_fd = None
+
+    def get_config(self):
+        """
+        Returns the runtime config (Env, Cmd, Entrypoint, ...) of the
+        image.
+        """
+        cfg = self.store.get_image_config(self.img_info["id"])
+        return cfg.get("config") or {}
+
+    def run_args(self, options):
+        """
+        Returns the podman run arguments that replace the image name.
+        Settings from the image config come first so the user's options
+        can override them.
+
+        Inputs:
+        options: podman run options given by the user
+        """
+        cfg = self.get_config()
+        args = []
+        for env in cfg.get("Env") or []:
+            args.extend(["--env", env])
+        if cfg.get("WorkingDir"):
+            args.extend(["--workdir", cfg["WorkingDir"]])
+        if cfg.get("User"):
+            args.extend(["--user", cfg["User"]])
+        args.extend(options)
+        args.extend(["--read-only", "--rootfs", self.mount_dir])
+        return args
+
+    def command(self, options, container_cmd):
+        """
+        Returns the container command, taking the entrypoint and default
+        command from the image config.
+
+        Inputs:
+        options: podman run options given by the user
+        container_cmd: command given by the user
+        """
+        cfg = self.get_config()
+        cmd = []
+        entrypoint = any(opt == "--entrypoint" or
+                         opt.startswith("--entrypoint=") for opt in options)
+        if not entrypoint:
+            cmd.extend(cfg.get("Entrypoint") or [])
+        if container_cmd:
+            cmd.extend(container_cmd)
+        else:
+            cmd.extend(cfg.get("Cmd") or [])
+        return cmd
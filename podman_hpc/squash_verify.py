@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .migrate2scratch import squash_file_ok, read_checksum, write_json
+
+READ_SIZE = 16 << 20
+
+
+def file_checksum(fn, bufsize=READ_SIZE):
+    """
+    Returns the sha256 digest of a file, read with large sequential
+    reads.
+    """
+    h = hashlib.sha256()
+    with open(fn, "rb", buffering=0) as f:
+        while True:
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            h.update(buf)
+    return "sha256:" + h.hexdigest()
+
+
+class SquashVerifier:
+    """
+    Class to verify the squash files of an image store against the
+    checksums recorded when they were written.
+
+    Files are checked in parallel.  Successful results are cached by
+    (size, mtime, inode) of the squash file, so verifying an unchanged
+    file again only costs a stat.
+
+    Results:
+    ok: the content matches the recorded checksum
+    unverified: no checksum was recorded, but the superblock looks sane
+    missing: the squash file doesn't exist
+    truncated: the size or superblock is wrong
+    corrupt: the content doesn't match the recorded checksum
+    """
+
+    def __init__(self, store, jobs=4, use_cache=True):
+        """
+        Inputs:
+        store: ImageStore to verify
+        jobs: number of files to verify in parallel
+        use_cache: set to False to always read the files
+        """
+        self.store = store
+        self.jobs = jobs
+        self.use_cache = use_cache
+        self.cache_file = os.path.join(store.base, "migrations",
+                                       "verify-cache.json")
+        self.cache = {}
+        if use_cache and os.path.exists(self.cache_file):
+            try:
+                self.cache = json.load(open(self.cache_file))
+            except ValueError:
+                pass
+
+    @staticmethod
+    def _key(st):
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def verify_file(self, sqf):
+        """
+        Verify one squash file.  Returns (result, cached).
+        """
+        try:
+            st = os.stat(sqf)
+        except OSError:
+            return "missing", False
+        csum = read_checksum(sqf)
+        if not csum:
+            return ("unverified" if squash_file_ok(sqf)
+                    else "truncated"), False
+        if csum["size"] != st.st_size or not squash_file_ok(sqf):
+            return "truncated", False
+        ent = self.cache.get(sqf)
+        if self.use_cache and ent and ent["key"] == self._key(st) and \
+           ent["digest"] == csum["digest"]:
+            return "ok", True
+        if file_checksum(sqf) != csum["digest"]:
+            return "corrupt", False
+        self.cache[sqf] = {"key": self._key(st), "digest": csum["digest"],
+                           "time": time.time()}
+        return "ok", False
+
+    def _check(self, img_info):
+        res = {"image": (img_info.get("names") or ["<none>"])[0],
+               "id": img_info["id"]}
+        start = time.time()
+        try:
+            link = self.store.read_link_file(img_info["layer"])
+            res["file"] = self.store.get_squash_filename(link)
+            res["result"], res["cached"] = self.verify_file(res["file"])
+        except OSError:
+            res["file"] = None
+            res["result"], res["cached"] = "missing", False
+        res["seconds"] = time.time() - start
+        return res
+
+    def verify_images(self, images=None):
+        """
+        Verify the squash files of the given images (default: all images
+        in the store).  Returns a list of result dictionaries.
+        """
+        self.store.refresh()
+        infos = []
+        missing = []
+        if images:
+            for image in images:
+                img_info, _ = self.store.get_img_info(image)
+                if img_info:
+                    infos.append(img_info)
+                else:
+                    missing.append({"image": image, "id": "",
+                                    "file": None, "result": "not found",
+                                    "cached": False, "seconds": 0})
+        else:
+            infos = list(self.store.images)
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            results = list(pool.map(self._check, infos))
+        self._save_cache()
+        return missing + results
+
+    def _save_cache(self):
+        if not self.use_cache:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            write_json(self.cache_file, self.cache)
+        except OSError as ex:
+            # e.g. a read-only store
+            logging.debug(f"Unable to save verify cache: {ex}")
+
+
+def format_results(results):
+    """
+    Format verification results as a table.
+    """
+    lines = [f"{'IMAGE':<40} {'ID':<12} {'RESULT':<10} TIME"]
+    for res in results:
+        when = "cached" if res["cached"] else f"{res['seconds']:.1f}s"
+        lines.append(f"{res['image'][:40]:<40} {res['id'][:12]:<12} "
+                     f"{res['result']:<10} {when}")
+    return "\n".join(lines)
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import socket
+import logging
+from glob import glob
+from contextlib import contextmanager
+
+TRACE_ENV = "PODMANHPC_TRACE"
+TRACE_ID_ENV = "PODMANHPC_TRACE_ID"
+TRACE_RANK_ENV = "PODMANHPC_TRACE_RANK"
+# Launcher variables that identify a job step and a rank
+_STEP_VARS = [("SLURM_JOB_ID", "SLURM_STEP_ID"), ("PBS_JOBID", None)]
+_RANK_VARS = ["SLURM_PROCID", "PMI_RANK", "PALS_RANKID",
+              "OMPI_COMM_WORLD_RANK"]
+# Lanes of the merged trace, in the order the components run
+COMPONENTS = ["podman-hpc", "fuse-overlayfs-wrap", "hook"]
+
+
+def default_trace_id(env):
+    """
+    Returns the correlation ID of a launch: the job step of the
+    launcher if there is one, so every rank of a step shares it.
+    """
+    for job, step in _STEP_VARS:
+        if env.get(job):
+            return f"{env[job]}.{env.get(step, '0')}" if step \
+                else env[job]
+    return f"{socket.gethostname()}-{os.getppid()}-{int(time.time())}"
+
+
+def default_rank(env):
+    for var in _RANK_VARS:
+        if env.get(var):
+            return env[var]
+    return "0"
+
+
+class Tracer:
+    """
+    Write spans of one process to PODMANHPC_TRACE when it is set.
+    Spans are collected in memory and appended to
+    <trace dir>/<trace id>.<component>.<host>.<pid>.jsonl by close.
+    The file is opened up front so it can still be written after the
+    process changed its mount namespace or root (as the hook does).
+
+    Inputs:
+    component: name of the traced program
+    env: environment to read the trace settings from
+    root: optional name of a span from the creation of the tracer to
+          close
+    """
+
+    def __init__(self, component, env=None, root=None):
+        env = os.environ if env is None else env
+        self.component = component
+        self.root = root
+        self.start = time.time()
+        self.trace_dir = env.get(TRACE_ENV)
+        self.events = []
+        self.fd = None
+        if not self.trace_dir:
+            return
+        self.trace_id = env.get(TRACE_ID_ENV) or default_trace_id(env)
+        self.rank = env.get(TRACE_RANK_ENV) or default_rank(env)
+        self.host = socket.gethostname()
+        fn = os.path.join(self.trace_dir,
+                          f"{self.trace_id}.{component}.{self.host}."
+                          f"{os.getpid()}.jsonl")
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            self.fd = os.open(fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                              0o644)
+        except OSError as ex:
+            logging.warning(f"Unable to open trace file {fn}: {ex}")
+
+    @property
+    def enabled(self):
+        return self.fd is not None
+
+    def env(self):
+        """
+        Returns the environment that puts child processes (and
+        containers) into the same trace.
+        """
+        if not self.enabled:
+            return {}
+        return {TRACE_ENV: self.trace_dir, TRACE_ID_ENV: self.trace_id,
+                TRACE_RANK_ENV: self.rank}
+
+    def add(self, name, start, end=None, **args):
+        """
+        Record a span from start to end (seconds since the epoch, end
+        defaults to now).
+        """
+        if not self.enabled:
+            return
+        end = time.time() if end is None else end
+        self.events.append({
+            "name": name, "cat": self.component, "ph": "X",
+            "ts": int(start * 1e6), "dur": int((end - start) * 1e6),
+            "trace_id": self.trace_id, "rank": self.rank,
+            "host": self.host, "pid": os.getpid(), "args": args})
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.time()
+        try:
+            yield args
+        finally:
+            self.add(name, start, **args)
+
+    def close(self):
+        """
+        Append the spans to the trace file.  Safe to call more than once.
+        """
+        if not self.enabled:
+            return
+        if self.root:
+            self.add(self.root, self.start)
+        data = "".join(json.dumps(ev) + "\n" for ev in self.events)
+        self.events = []
+        try:
+            os.write(self.fd, data.encode())
+        except OSError as ex:
+            logging.warning(f"Unable to write trace: {ex}")
+        os.close(self.fd)
+        self.fd = None
+
+
+def read_spans(trace_dir, trace_id=None):
+    """
+    Read the spans of every component in a trace directory, optionally
+    only those of one launch.
+    """
+    pattern = f"{trace_id}.*.jsonl" if trace_id else "*.jsonl"
+    res = []
+    for fn in sorted(glob(os.path.join(trace_dir, pattern))):
+        with open(fn) as f:
+            for line in f:
+                try:
+                    ev = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(ev, dict) or ev.get("ph") != "X":
+                    continue
+                if trace_id and ev.get("trace_id") != trace_id:
+                    continue
+                res.append(ev)
+    return res
+
+
+def merge_traces(trace_dir, trace_id=None):
+    """
+    Merge the spans of a trace directory into a Chrome trace event
+    document.  Every rank on every host becomes a process and every
+    component a thread of it, so one launch can be read as a timeline
+    per rank.  Timestamps start at the earliest span.
+    """
+    spans = read_spans(trace_dir, trace_id)
+
+    def lane(ev):
+        return (ev.get("trace_id") or "", ev.get("host") or "",
+                str(ev.get("rank")))
+
+    # Ranks in numeric order
+    keys = sorted({lane(ev) for ev in spans},
+                  key=lambda k: (k[0], k[1], len(k[2]), k[2]))
+    lanes = {key: i + 1 for i, key in enumerate(keys)}
+    events = []
+    t0 = min((ev["ts"] for ev in spans), default=0)
+    for ev in sorted(spans, key=lambda e: e["ts"]):
+        key = lane(ev)
+        cat = ev.get("cat")
+        tid = COMPONENTS.index(cat) + 1 if cat in COMPONENTS \
+            else len(COMPONENTS) + 1
+        args = dict(ev.get("args") or {}, pid=ev.get("pid"))
+        events.append({"name": ev["name"], "cat": cat, "ph": "X",
+                       "ts": ev["ts"] - t0, "dur": ev.get("dur", 0),
+                       "pid": lanes[key], "tid": tid, "args": args})
+    meta = []
+    ids = {key[0] for key in lanes}
+    for (trace, host, rank), pid in lanes.items():
+        name = f"{host} rank {rank}"
+        if len(ids) > 1:
+            name = f"{trace} {name}"
+        meta.append({"name": "process_name", "ph": "M", "pid": pid,
+                     "args": {"name": name}})
+        meta.append({"name": "process_sort_index", "ph": "M", "pid": pid,
+                     "args": {"sort_index": pid}})
+        for i, comp in enumerate(COMPONENTS):
+            meta.append({"name": "thread_name", "ph": "M", "pid": pid,
+                         "tid": i + 1, "args": {"name": comp}})
+    return {"traceEvents": meta + events, "displayTimeUnit": "ms",
+            "otherData": {"trace_ids": sorted(i for i in ids if i)}}
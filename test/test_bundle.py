@@ -0,0 +1,96 @@
+from podman_hpc.bundle import export_bundle, import_bundle
+from podman_hpc.migrate2scratch import ImageStore, read_checksum
+import io
+import os
+import json
+import shutil
+import tarfile
+import pytest
+
+
+@pytest.fixture
+def src(tmp_path):
+    tdir = os.path.dirname(__file__)
+    sdir = os.path.join(tmp_path, "src")
+    shutil.copytree(os.path.join(tdir, "storage"), sdir, symlinks=True)
+    sq = os.path.join(sdir, "overlay", "l", "ZV7QWNQETS5AJXTGA6EY2FM2WE")
+    shutil.copy(f"{sq}.squash.bk", f"{sq}.squash")
+    return ImageStore(sdir)
+
+
+def test_bundle_roundtrip(tmp_path, src):
+    bundle = os.path.join(tmp_path, "alpine.sqb")
+    img_id = export_bundle(src, "alpine", bundle)
+    with tarfile.open(bundle) as tf:
+        names = tf.getnames()
+    assert names[0] == "bundle.json"
+    assert names[-1] == "checksums.json"
+    assert "squash" in names
+
+    dst = ImageStore(os.path.join(tmp_path, "dst"), read_only=False)
+    assert import_bundle(dst, bundle) == img_id
+    img, _ = dst.get_img_info("alpine")
+    assert img["id"] == img_id
+    assert dst.get_image_config(img_id) == src.get_image_config(img_id)
+    assert [rec["id"] for rec in dst.layers] == [img["layer"]]
+    link = dst.read_link_file(img["layer"])
+    assert link == "ZV7QWNQETS5AJXTGA6EY2FM2WE"
+    with open(dst.get_squash_filename(link), "rb") as f:
+        data = f.read()
+    with open(src.get_squash_filename(link), "rb") as f:
+        assert data == f.read()
+    assert os.path.islink(os.path.join(dst.overlay_dir, "l", link))
+    csum = read_checksum(dst.get_squash_filename(link))
+    assert csum["size"] == len(data)
+    # Importing again is a no-op
+    assert import_bundle(dst, bundle) == img_id
+
+
+def test_bundle_corrupt(tmp_path, src):
+    bundle = os.path.join(tmp_path, "alpine.sqb")
+    export_bundle(src, "alpine", bundle)
+    # Flip a byte in the squash file data
+    with tarfile.open(bundle) as tf:
+        offset = tf.getmember("squash").offset_data
+    with open(bundle, "r+b") as f:
+        f.seek(offset + 10)
+        byte = f.read(1)
+        f.seek(offset + 10)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+    dst = ImageStore(os.path.join(tmp_path, "dst"), read_only=False)
+    with pytest.raises(ValueError):
+        import_bundle(dst, bundle)
+    dst.refresh()
+    assert dst.images == []
+    assert os.listdir(os.path.join(dst.overlay_dir, "l")) == []
+    # No partial files are left behind
+    assert sorted(os.listdir(dst.images_dir)) == ["images.json",
+                                                  "images.lock"]
+
+
+@pytest.mark.parametrize("field", ["link", "id"])
+def test_bundle_bad_manifest(tmp_path, src, field):
+    bundle = os.path.join(tmp_path, "alpine.sqb")
+    export_bundle(src, "alpine", bundle)
+    # Rewrite the manifest with a path in it
+    crafted = os.path.join(tmp_path, "crafted.sqb")
+    with tarfile.open(bundle) as tf, tarfile.open(crafted, "w") as out:
+        for m in tf:
+            data = tf.extractfile(m).read()
+            if m.name == "bundle.json":
+                man = json.loads(data)
+                layer = man["image"]["layer"]
+                if field == "link":
+                    man["links"][layer] = "../../x"
+                else:
+                    man["image"]["id"] = "../../x"
+                data = json.dumps(man).encode()
+                m.size = len(data)
+            out.addfile(m, io.BytesIO(data))
+
+    dst = ImageStore(os.path.join(tmp_path, "dst"), read_only=False)
+    with pytest.raises(ValueError, match="Invalid"):
+        import_bundle(dst, crafted)
+    assert not os.path.exists(os.path.join(tmp_path, "x"))
+    assert os.listdir(os.path.join(dst.overlay_dir, "l")) == []
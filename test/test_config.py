@@ -29,6 +29,11 @@ def test_conf_defaults(fix_paths):
     assert conf.get_default_store_conf() is not None
     assert conf.get_default_containers_conf() is not None
     assert f"/tmp/{uid}_hpc/storage" in conf.default_args
+    # The hook cache is opt-in
+    assert conf.hook_cache_dir is None
+    assert not any(a.startswith(config._HOOK_CACHE_ENV)
+                   for a in conf.default_run_args)
+    assert f"{config._HOOK_JOBS_ENV}=1" in conf.default_run_args
     conf.config_env(True)
     assert conf.env is not None
 
@@ -0,0 +1,62 @@
+from podman_hpc.hook_report import (read_records, percentile, summarize,
+                                    format_report)
+import os
+import json
+
+
+def _records(cid, start, plan, actions, copy_bytes):
+    common = {"container": cid, "start": start, "modules": ["gpu"]}
+    recs = [
+        {"kind": "phase", "name": "plan", "duration": plan},
+        {"kind": "phase", "name": "actions", "duration": actions},
+        {"kind": "phase", "name": "total", "duration": plan + actions},
+        {"kind": "rule", "name": "gpu:copy[0]", "module": "gpu",
+         "action": "copy", "rule": "copy[0]", "pattern": "/etc/gpu/*",
+         "srcs": 2, "bytes": copy_bytes, "duration": actions},
+    ]
+    return [dict(common, **r) for r in recs]
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3, 1, 2], 90) == 3
+    assert percentile([5], 50) == 5
+    assert percentile([], 50) is None
+
+
+def test_hook_report(tmp_path):
+    fn = os.path.join(tmp_path, "timing.jsonl")
+    with open(fn, "w") as f:
+        for i in range(10):
+            for rec in _records(f"c{i}", 1000 + i, (i + 1) / 1000,
+                                (i + 1) / 100, 2**20):
+                f.write(json.dumps(rec) + "\n")
+        f.write('{"kind": "phase", "name": "pl')
+    records = read_records(fn)
+    assert len(records) == 40
+
+    summary = summarize(records)
+    assert summary["containers"] == 10
+    plan = summary["phases"]["plan"]
+    assert plan["count"] == 10
+    assert plan["p50"] == 0.005
+    assert plan["p90"] == 0.009
+    assert plan["max"] == 0.01
+    rule = summary["rules"]["gpu:copy[0]"]
+    assert rule["srcs"] == 2
+    assert rule["pattern"] == "/etc/gpu/*"
+    assert rule["mean_bytes"] == 2**20
+
+    # Only the hooks started in the last 3 seconds
+    assert summarize(records, since=1007)["containers"] == 3
+
+    out = format_report(summary).splitlines()
+    assert out[0] == "Containers: 10"
+    assert out[2].split()[:2] == ["PHASE", "COUNT"]
+    assert [line.split()[0] for line in out[3:6]] == \
+        ["plan", "actions", "total"]
+    assert out[-2].split()[-1] == "PATTERN"
+    assert out[-1].split()[:4] == ["gpu:copy[0]", "10", "2", "1.0"]
+    assert out[-1].split()[-1] == "/etc/gpu/*"
@@ -0,0 +1,213 @@
+from podman_hpc.import_archive import ArchiveImporter, chain_ids
+from podman_hpc.import_archive import normalize_name
+from podman_hpc.migrate2scratch import ImageStore
+from podman_hpc.squash_index import find_files, index_filename
+import os
+import io
+import gzip
+import json
+import hashlib
+import tarfile
+import pytest
+
+
+def _tar(entries):
+    """
+    Build a tarball from (name, type, data/linkname, uid) tuples.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tf:
+        for name, typ, data, uid in entries:
+            ti = tarfile.TarInfo(name)
+            ti.type = typ
+            ti.uid = uid
+            ti.mode = 0o755 if typ == tarfile.DIRTYPE else 0o644
+            if typ == tarfile.REGTYPE:
+                ti.size = len(data)
+                tf.addfile(ti, io.BytesIO(data))
+                continue
+            if typ == tarfile.SYMTYPE:
+                ti.linkname = data
+            if typ == tarfile.CHRTYPE:
+                ti.devmajor, ti.devminor = 1, 3
+            tf.addfile(ti)
+    return buf.getvalue()
+
+
+LAYER1 = _tar([
+    ("etc", tarfile.DIRTYPE, None, 0),
+    ("etc/hello", tarfile.REGTYPE, b"a", 0),
+    ("etc/gone", tarfile.REGTYPE, b"x", 0),
+    ("usr/lib/old", tarfile.REGTYPE, b"x", 0),
+    ("bin", tarfile.SYMTYPE, "usr/bin", 0),
+    ("dev/null", tarfile.CHRTYPE, None, 0),
+])
+LAYER2 = _tar([
+    ("etc/hello", tarfile.REGTYPE, b"b", 1000),
+    ("etc/.wh.gone", tarfile.REGTYPE, b"", 0),
+    ("usr/lib/.wh..wh..opq", tarfile.REGTYPE, b"", 0),
+    ("usr/lib/new", tarfile.REGTYPE, b"y", 0),
+])
+
+
+def _digest(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+
+def _config():
+    return json.dumps({
+        "created": "2023-01-01T00:00:00Z",
+        "config": {"Env": ["PATH=/bin"]},
+        "rootfs": {"type": "layers",
+                   "diff_ids": [_digest(LAYER1), _digest(LAYER2)]},
+    }).encode()
+
+
+def _add(tf, name, data):
+    ti = tarfile.TarInfo(name)
+    ti.size = len(data)
+    tf.addfile(ti, io.BytesIO(data))
+
+
+def docker_archive(path):
+    config = _config()
+    with tarfile.open(path, "w") as tf:
+        _add(tf, "l1/layer.tar", LAYER1)
+        _add(tf, "l1/VERSION", b"1.0")
+        _add(tf, "l2/layer.tar", LAYER2)
+        _add(tf, "cfg.json", config)
+        # docker save writes the manifest last
+        _add(tf, "manifest.json", json.dumps([{
+            "Config": "cfg.json",
+            "RepoTags": ["test:1"],
+            "Layers": ["l1/layer.tar", "l2/layer.tar"],
+        }]).encode())
+    return config
+
+
+def oci_archive(path):
+    config = _config()
+    blobs = [gzip.compress(LAYER1), gzip.compress(LAYER2)]
+    manifest = json.dumps({
+        "schemaVersion": 2,
+        "config": {"digest": _digest(config), "size": len(config)},
+        "layers": [{"digest": _digest(b), "size": len(b)} for b in blobs],
+    }).encode()
+    with tarfile.open(path, "w") as tf:
+        _add(tf, "oci-layout", b'{"imageLayoutVersion": "1.0.0"}')
+        _add(tf, "index.json", json.dumps({"manifests": [{
+            "digest": _digest(manifest),
+            "annotations": {
+                "org.opencontainers.image.ref.name": "localhost/test:oci"},
+        }]}).encode())
+        for data in blobs + [config, manifest]:
+            _add(tf, f"blobs/sha256/{_digest(data)[7:]}", data)
+    return config
+
+
+class mockproc():
+    returncode = 0
+
+    def communicate(self):
+        return b"", b""
+
+
+@pytest.fixture
+def mksq(mocker):
+    seen = {}
+
+    def run(com, **kwargs):
+        rootfs, out, pseudo = com[1], com[2], com[5]
+        seen["files"] = sorted(
+            os.path.relpath(os.path.join(r, f), rootfs)
+            for r, ds, fs in os.walk(rootfs) for f in fs + ds)
+        seen["hello"] = open(os.path.join(rootfs, "etc", "hello")).read()
+        seen["pseudo"] = open(pseudo).read()
+        seen["com"] = com
+        with open(out, "wb") as f:
+            f.write(b"hsqs" + b"\0" * 92)
+        return mockproc()
+
+    popen = mocker.patch("podman_hpc.import_archive.Popen")
+    popen.side_effect = run
+    return seen
+
+
+def test_names():
+    assert normalize_name("alpine") == "docker.io/library/alpine:latest"
+    assert normalize_name("a/b:1") == "docker.io/a/b:1"
+    assert normalize_name("localhost/x") == "localhost/x:latest"
+    assert normalize_name("reg.io:5000/x:2") == "reg.io:5000/x:2"
+
+
+def test_import_docker_archive(tmp_path, mksq):
+    archive = os.path.join(tmp_path, "img.tar")
+    config = docker_archive(archive)
+    dst = os.path.join(tmp_path, "dst")
+    imp = ArchiveImporter(dst=dst)
+    imp.mu.staging_dir = os.path.join(tmp_path, "stage")
+    imp.mu.squash_index = True
+    ids = imp.import_archive(archive)
+    img_id = hashlib.sha256(config).hexdigest()
+    assert ids == [img_id]
+
+    # The whiteouts were applied
+    assert mksq["files"] == ["bin", "dev", "etc", "etc/hello", "usr",
+                             "usr/lib", "usr/lib/new"]
+    assert mksq["hello"] == "b"
+    assert '"/etc/hello" m 644 1000 0' in mksq["pseudo"]
+    assert '"/dev/null" c 644 0 0 1 3' in mksq["pseudo"]
+    # Directories only implied by their files (usr/lib/old, dev/null)
+    for pth in ["/usr", "/usr/lib", "/dev"]:
+        assert f'"{pth}" m 755 0 0' in mksq["pseudo"]
+    assert "-pf" in mksq["com"] and "lz4" in mksq["com"]
+
+    store = ImageStore(dst)
+    img, _ = store.get_img_info("test:1")
+    assert img["id"] == img_id
+    assert store.get_image_config(img_id)["config"]["Env"] == ["PATH=/bin"]
+    ids = chain_ids([_digest(LAYER1), _digest(LAYER2)])
+    assert img["layer"] == ids[1]
+    layers = {rec["id"]: rec for rec in store.layers}
+    assert layers[ids[1]]["parent"] == ids[0]
+    assert layers[ids[1]]["uidset"] == [0, 1000]
+    link = store.read_link_file(ids[1])
+    assert len(link) == 26
+    assert os.path.exists(store.get_squash_filename(link))
+    assert os.path.islink(os.path.join(store.overlay_dir, "l", link))
+    assert os.path.exists(index_filename(store.get_squash_filename(link)))
+    assert find_files(store, "hel*") == [
+        ("docker.io/library/test:1", "/etc/hello")]
+    assert os.listdir(os.path.join(tmp_path, "stage")) == []
+
+    # A second import doesn't squash again
+    mksq.clear()
+    ArchiveImporter(dst=dst).import_archive(archive)
+    assert mksq == {}
+
+
+def test_import_oci(tmp_path, mksq):
+    archive = os.path.join(tmp_path, "img.tar")
+    config = oci_archive(archive)
+    dst = os.path.join(tmp_path, "dst")
+    imp = ArchiveImporter(dst=dst)
+    imp.mu.staging_dir = os.path.join(tmp_path, "stage")
+    imp.import_archive(archive)
+    assert mksq["hello"] == "b"
+    store = ImageStore(dst)
+    img, _ = store.get_img_info("localhost/test:oci")
+    assert img["id"] == hashlib.sha256(config).hexdigest()
+    rec = [r for r in store.layers if r["id"] == img["layer"]][0]
+    assert rec["compression"] == 2
+    assert rec["diff-digest"] == _digest(LAYER2)
+    assert rec["compressed-diff-digest"] == _digest(gzip.compress(LAYER2))
+
+
+def test_import_bad_archive(tmp_path, mksq):
+    archive = os.path.join(tmp_path, "img.tar")
+    with tarfile.open(archive, "w") as tf:
+        _add(tf, "manifest.json", json.dumps([{
+            "Config": "cfg.json", "Layers": []}]).encode())
+    imp = ArchiveImporter(dst=os.path.join(tmp_path, "dst"))
+    with pytest.raises(ValueError):
+        imp.import_archive(archive)
@@ -1,6 +1,13 @@
-from podman_hpc.migrate2scratch import MigrateUtils
+from podman_hpc.migrate2scratch import MigrateUtils, publish_file
+from podman_hpc.migrate2scratch import ImageStore, ImageLock, MigrationStatus
+from podman_hpc.migrate2scratch import MigrationProgress, MigrationJournal
 import os
+import io
 import json
+import hashlib
+import time
+import socket
+import threading
 import pytest
 from tempfile import TemporaryDirectory
 
@@ -18,13 +25,31 @@ def get_count(fn, img):
 class mockproc():
     returncode = 0
 
-    def __init__(self, rcode=None):
+    def __init__(self, rcode=None, out=b"blah"):
         if rcode:
             self.returncode = rcode
+        self.stdout = io.BytesIO(out)
 
     def communicate(self):
         return b"blah", b"blah"
 
+    def wait(self):
+        return self.returncode
+
+
+def mock_mksq(com, out=b"blah", **kwargs):
+    """
+    Mimic the mksquashfs container by creating the output file.
+    """
+    for idx, arg in enumerate(com):
+        if arg == "-v" and com[idx + 1].endswith(":/sqout"):
+            outdir = com[idx + 1].split(":")[0]
+        if arg.startswith("/sqout/"):
+            outname = arg.replace("/sqout/", "")
+    with open(os.path.join(outdir, outname), "wb") as f:
+        f.write(b"hsqs" + b"\0" * 92)
+    return mockproc(out=out)
+
 
 @pytest.fixture
 def src():
@@ -75,11 +100,14 @@ def test_migrate_remove(src, tmp_path, mocker):
     assert resp is False
 
     # Now a successful one
-    popen.return_value = mockproc()
+    popen.side_effect = mock_mksq
     resp = mu.migrate_image(img)
     assert resp
     assert get_count(mu.dst.images_json, img) == 1
     popen.assert_called()
+    sqf = os.path.join(tmp_path, "overlay/l/ZV7QWNQETS5AJXTGA6EY2FM2WE.squash")
+    assert os.path.exists(sqf)
+    assert not any(".tmp-" in fn for fn in os.listdir(os.path.dirname(sqf)))
 
     # Remigrate to test check logic
     resp = mu.migrate_image(img)
@@ -95,3 +123,303 @@ def test_migrate_remove(src, tmp_path, mocker):
     resp = mu.remove_image(img)
     assert resp
     assert get_count(mu.dst.images_json, img) == 0
+
+
+def test_squash_profiles(src, tmp_path):
+    mu = MigrateUtils(src=src, dst=tmp_path)
+    opts = mu.get_mksq_options()
+    assert opts[:2] == ["-comp", "lz4"]
+    assert "security.capability" in opts
+    mu.squash_profiles = {
+        "small": {"compression": "zstd", "block_size": "64K",
+                  "compression_level": 3, "options": ["-no-fragments"]},
+    }
+    opts = mu.get_mksq_options("small")
+    assert opts[:8] == ["-comp", "zstd", "-b", "64K",
+                        "-Xcompression-level", "3", "-no-fragments",
+                        "-xattrs-exclude"]
+    with pytest.raises(ValueError):
+        MigrateUtils(src=src, dst=tmp_path, profile="bogus")
+
+
+def test_slim_profiles(src, tmp_path):
+    mu = MigrateUtils(src=src, dst=tmp_path)
+    assert mu.get_exclude_options() == ["-e", "/sqout", "-e", "/mksq",
+                                        "-e", "/proc", "-e", "/sys",
+                                        "-e", "/dev"]
+    mu.slim_profiles = {
+        "docs": {"exclude": ["usr/share/doc/*", "... __pycache__"]},
+        "re": {"exclude": ["^usr$/^share$/^man$"], "regex": True},
+    }
+    opts = mu.get_exclude_options("docs")
+    assert opts == ["-wildcards", "-e", "sqout", "mksq", "proc", "sys",
+                    "dev", "usr/share/doc/*", "... __pycache__"]
+    opts = mu.get_exclude_options("re")
+    assert opts[:4] == ["-regex", "-e", "^sqout$", "^mksq$"]
+    assert opts[-1] == "^usr$/^share$/^man$"
+    with pytest.raises(ValueError):
+        MigrateUtils(src=src, dst=tmp_path, slim="bogus")
+
+
+def test_publish_file(tmp_path):
+    src = os.path.join(tmp_path, "src.squash")
+    tgt = os.path.join(tmp_path, "tgt.squash")
+    with open(src, "wb") as f:
+        f.write(b"hsqs" * 1000)
+    assert publish_file(src, tgt, bufsize=1000) == 4000
+    assert open(tgt, "rb").read() == b"hsqs" * 1000
+    with pytest.raises(OSError):
+        publish_file(os.path.join(tmp_path, "missing"), tgt)
+    assert sorted(os.listdir(tmp_path)) == ["src.squash", "tgt.squash"]
+
+
+def test_migrate_resume(src, tmp_path, mocker):
+    img = "docker.io/library/alpine:latest"
+    hash = "9c6f0724472873bb50a2ae67a9e7adcb57673a183cea8b06eb778dca859181b5"
+    popen = mocker.patch("podman_hpc.migrate2scratch.Popen")
+    popen.return_value = mockproc(rcode=1)
+    mu = MigrateUtils(src=src, dst=tmp_path)
+    assert mu.migrate_image(img) is False
+    jfile = os.path.join(tmp_path, "migrations", f"{hash}.journal")
+    steps = json.load(open(jfile))["steps"]
+    assert sorted(steps) == ["image_info", "layers", "overlay"]
+    assert get_count(mu.dst.images_json, img) == 0
+
+    # Leave a truncated squash file and a partial copy behind
+    sqf = os.path.join(tmp_path, "overlay/l/ZV7QWNQETS5AJXTGA6EY2FM2WE.squash")
+    with open(sqf, "w") as f:
+        f.write("junk")
+    dead = f"{sqf}.tmp-{socket.gethostname()}-{2**22 + 1}"
+    with open(dead, "w") as f:
+        f.write("junk")
+
+    popen.side_effect = mock_mksq
+    copy_info = mocker.spy(mu, "_copy_image_info")
+    assert mu.migrate_image(img)
+    copy_info.assert_not_called()
+    assert open(sqf, "rb").read(4) == b"hsqs"
+    assert not os.path.exists(dead)
+    assert not os.path.exists(jfile)
+    assert get_count(mu.dst.images_json, img) == 1
+    # The checksum was recorded while publishing
+    csum = json.load(open(f"{sqf}.json"))
+    assert csum["size"] == 96
+    assert csum["digest"] == "sha256:" + hashlib.sha256(
+        b"hsqs" + b"\0" * 92).hexdigest()
+
+
+def test_cleanup_shared_layer(src, tmp_path):
+    # Two images sharing their base layer: cleaning up after one must
+    # not touch the temporary files of a running migration of the other.
+    mu = MigrateUtils(src=src, dst=tmp_path)
+    mu._lazy_init()
+    mu.dst.init_storage()
+    img = mu.src.get_img_info("alpine")[0]
+    base = mu._get_img_layers(mu.src, img["layer"])[-1]
+    other = {"id": "0" * 64}
+    ts = os.path.join(mu.dst.layers_dir, f"{base['id']}.tar-split.gz")
+    host = socket.gethostname()
+    live = f"{ts}.tmp-{host}-{os.getppid()}"
+    dead = f"{ts}.tmp-{host}-{2**22 + 1}"
+    remote = f"{ts}.tmp-othernode-{2**22 + 1}"
+    for fn in [live, dead, remote]:
+        with open(fn, "w") as f:
+            f.write("junk")
+    journal = MigrationJournal(mu.dst, img["id"]).load()
+    mu._cleanup_partial(img["id"], [other, base], journal)
+    assert os.path.exists(live)
+    assert os.path.exists(remote)
+    assert not os.path.exists(dead)
+
+
+def test_index_unavailable(src, tmp_path, mocker):
+    # Indexing is skipped with a warning when squashfuse is missing
+    img = "docker.io/library/alpine:latest"
+    mocker.patch("podman_hpc.migrate2scratch.Popen", side_effect=mock_mksq)
+    warn = mocker.patch("podman_hpc.migrate2scratch.logging.warning")
+    mu = MigrateUtils(src=src, dst=tmp_path)
+    assert mu.squash_index is False
+    mu.squash_index = True
+    mu.squashfuse_bin = os.path.join(tmp_path, "missing", "squashfuse")
+    assert mu.migrate_image(img)
+    sqf = os.path.join(tmp_path, "overlay/l/ZV7QWNQETS5AJXTGA6EY2FM2WE.squash")
+    assert os.path.exists(sqf)
+    assert not os.path.exists(f"{sqf}.idx")
+    assert any("squashfuse" in str(c) for c in warn.call_args_list)
+
+
+def test_compile_python(src, tmp_path, mocker):
+    img = "docker.io/library/alpine:latest"
+    coms = []
+
+    def run(com, **kwargs):
+        coms.append(com)
+        if com[com.index("--entrypoint") + 1] == "/bin/sh":
+            script = os.path.join(com[com.index("-v") + 3].split(":")[0],
+                                  ".compile-python.sh")
+            assert "compileall" in open(script).read()
+            # e.g. an image without a shell
+            return mockproc(rcode=127)
+        return mock_mksq(com)
+
+    mocker.patch("podman_hpc.migrate2scratch.Popen", side_effect=run)
+    mu = MigrateUtils(src=src, dst=tmp_path)
+    mu.compile_python = True
+    assert mu.migrate_image(img)
+    assert len(coms) == 2
+    idx = coms[0].index("/bin/sh")
+    assert coms[0][idx + 2:idx + 5] == ["/sqout/.compile-python.sh",
+                                        "/mksq", "/"]
+    assert coms[1][coms[1].index("--entrypoint") + 1] == "/mksq"
+    assert get_count(mu.dst.images_json, img) == 1
+
+
+def test_image_lock(tmp_path):
+    store = ImageStore(str(tmp_path), read_only=False)
+    lock = ImageLock(store, "abc")
+    lock.poll_interval = 0.05
+    assert lock.acquire() is False
+
+    other = ImageLock(store, "abc")
+    other.poll_interval = 0.05
+    threading.Timer(0.3, lock.release).start()
+    assert other.acquire(status=lambda: "copying") is True
+    other.release()
+    assert not os.path.exists(lock.fn)
+
+    # A lock left by a dead process on this host is broken
+    with open(lock.fn, "w") as f:
+        json.dump({"host": socket.gethostname(), "pid": 2**22 + 1}, f)
+    assert lock.acquire() is False
+    lock.release()
+
+    # So is one that hasn't been refreshed
+    with open(lock.fn, "w") as f:
+        json.dump({"host": "othernode", "pid": 1}, f)
+    old = time.time() - 1000
+    os.utime(lock.fn, (old, old))
+    assert lock.acquire() is False
+    lock.release()
+
+
+def test_image_lock_replaced(tmp_path):
+    store = ImageStore(str(tmp_path), read_only=False)
+    lock = ImageLock(store, "abc")
+    os.makedirs(os.path.dirname(lock.fn))
+    with open(lock.fn, "w") as f:
+        json.dump({"host": "othernode", "pid": 1}, f)
+    old = time.time() - 1000
+    os.utime(lock.fn, (old, old))
+    snapshot = lock._snapshot()
+    assert lock.is_stale(snapshot)
+
+    # Another process breaks the stale lock and a new owner takes it
+    # before we get to break it
+    os.unlink(lock.fn)
+    live = ImageLock(store, "abc")
+    live.owner = {"host": "othernode", "pid": 2}
+    assert live._try_create()
+    lock._break_stale(snapshot)
+    assert live.read_owner() == live.owner
+    assert os.listdir(os.path.dirname(lock.fn)) == ["abc.lock"]
+
+
+def test_concurrent_migrate(src, tmp_path, mocker):
+    img = "docker.io/library/alpine:latest"
+
+    def slow_mksq(com, **kwargs):
+        time.sleep(0.5)
+        return mock_mksq(com, **kwargs)
+
+    popen = mocker.patch("podman_hpc.migrate2scratch.Popen")
+    popen.side_effect = slow_mksq
+    mocker.patch.object(ImageLock, "poll_interval", 0.05)
+    results = []
+
+    def migrate():
+        mu = MigrateUtils(src=src, dst=tmp_path)
+        results.append(mu.migrate_image(img))
+
+    threads = [threading.Thread(target=migrate) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [True] * 4
+    assert popen.call_count == 1
+    imgf = os.path.join(tmp_path, "overlay-images/images.json")
+    assert get_count(imgf, img) == 1
+
+
+def test_migration_status(src, tmp_path, mocker):
+    img = "docker.io/library/alpine:latest"
+    hash = "9c6f0724472873bb50a2ae67a9e7adcb57673a183cea8b06eb778dca859181b5"
+    popen = mocker.patch("podman_hpc.migrate2scratch.Popen")
+    popen.return_value = mockproc(rcode=1)
+    mu = MigrateUtils(src=src, dst=tmp_path)
+    assert mu.migrate_image(img) is False
+    st = MigrationStatus.list(mu.dst)
+    assert len(st) == 1
+    assert st[0]["state"] == "failed"
+    assert st[0]["step"] == "squash"
+
+    popen.side_effect = mock_mksq
+    assert mu.migrate_image(img)
+    st = MigrationStatus.list(mu.dst)[0]
+    assert st["id"] == hash
+    assert st["image"] == img
+    assert st["state"] == "done"
+    assert st["bytes_total"] == 5826560
+    assert st["bytes_done"] == st["bytes_total"]
+    assert st["eta"] == 0
+
+    # A running migration without a live lock is stale
+    status = MigrationStatus(mu.dst, "abc", "busybox")
+    status.update(step="layers")
+    states = {s["id"]: s["state"] for s in MigrationStatus.list(mu.dst)}
+    assert states["abc"] == "stale"
+
+    # Old finished migrations are dropped
+    status.data.update(state="done", updated=0)
+    with open(status.fn, "w") as f:
+        json.dump(status.data, f)
+    ids = [s["id"] for s in MigrationStatus.list(mu.dst)]
+    assert ids == [hash]
+    assert not os.path.exists(status.fn)
+
+
+def test_migrate_progress(src, tmp_path, mocker):
+    img = "docker.io/library/alpine:latest"
+    bar = (b"Parallel mksquashfs: Using 4 processors\n"
+           b"[==    ] 10/100  10%\r[===   ] 50/1"
+           b"00  50%\r[======] 100/100 100%\n")
+
+    def mksq(com, **kwargs):
+        return mock_mksq(com, out=bar)
+
+    popen = mocker.patch("podman_hpc.migrate2scratch.Popen")
+    popen.side_effect = mksq
+    term = io.StringIO()
+    jsonl = os.path.join(tmp_path, "progress.jsonl")
+    mu = MigrateUtils(src=src, dst=os.path.join(tmp_path, "dst"))
+    mu.progress = MigrationProgress(stream=term, jsonl=jsonl)
+    assert mu.migrate_image(img)
+    mu.progress.close()
+
+    events = [json.loads(line) for line in open(jsonl)]
+    names = [e["event"] for e in events]
+    assert names[0] == "migrate_start"
+    assert names[-1] == "migrate_end"
+    assert events[-1]["ok"] is True
+    pcts = [e["percent"] for e in events if e["event"] == "squash_progress"]
+    assert pcts == [10, 50, 100]
+    steps = [e["step"] for e in events if e["event"] == "step_end"]
+    assert steps == ["image_info", "layers", "overlay", "squash"]
+    end = [e for e in events if e["event"] == "squash_end"][0]
+    assert end["bytes"] == 96
+    assert end["input_bytes"] == 5826560
+    copies = [e for e in events if e["event"] == "copy"]
+    assert copies[-1]["file"].endswith(".squash")
+    out = term.getvalue()
+    assert "INFO: Squashing 100%" in out
+    assert "INFO: Migration done" in out
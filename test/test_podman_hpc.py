@@ -153,6 +153,7 @@ def test_pull(monkeypatch, fix_paths, mock_podman, mock_exit,
     phpc.main()
     captured = capsys.readouterr()
     assert "Migrating" in captured.out
+    assert "Squashing 100%" in captured.out
     assert str(tmp_path) in captured.out
     out = open(mock_podman).read()
     assert "pull " in out
@@ -199,3 +200,120 @@ def test_modules(monkeypatch, fix_paths, mock_exit):
     phpc.main()
     assert "--gpu" not in args_passed[0]
     assert "ENABLE_GPU=1" in args_passed[0]
+
+
+def test_migrate_profile(fix_paths, mock_podman, mock_exit, tmp_path,
+                         monkeypatch):
+    tdir = os.path.dirname(__file__)
+    src = os.path.join(tdir, "storage")
+    monkeypatch.setenv("PODMANHPC_GRAPH_ROOT", src)
+    sys.argv = ["podman_hpc", "--squash-dir", str(tmp_path),
+                "migrate", "--profile", "zstd", "alpine"]
+    phpc.main()
+    out = open(mock_podman).read()
+    assert "-comp zstd -b 1M" in out
+
+
+def test_pull_direct(monkeypatch, fix_paths, mock_podman, mock_exit,
+                     tmp_path, capsys):
+    tdir = os.path.dirname(__file__)
+    monkeypatch.setenv("MOCK_STORAGE", os.path.join(tdir, "storage"))
+    staging = os.path.join(tmp_path, "staging")
+    monkeypatch.setenv("PODMANHPC_SQUASH_STAGING_DIR", staging)
+    sqdir = os.path.join(tmp_path, "squash")
+    sys.argv = ["podman_hpc", "--squash-dir", sqdir,
+                "pull", "--direct", "alpine"]
+    phpc.main()
+    captured = capsys.readouterr()
+    assert "peak staging use" in captured.out
+    out = open(mock_podman).read()
+    assert f"--root {staging}/pull-" in out
+    imagej = os.path.join(sqdir, "overlay-images", "images.json")
+    assert len(json.load(open(imagej))) == 1
+    assert os.listdir(staging) == []
+
+
+def test_pull_cached(monkeypatch, fix_paths, mock_podman, mock_exit,
+                     tmp_path, capsys):
+    tdir = os.path.dirname(__file__)
+    monkeypatch.setenv("PODMANHPC_GRAPH_ROOT", os.path.join(tdir, "storage"))
+    sqdir = os.path.join(tmp_path, "squash")
+    sys.argv = ["podman_hpc", "--squash-dir", sqdir, "pull", "alpine"]
+    phpc.main()
+    assert "pull " in open(mock_podman).read()
+
+    # Already squashed, so podman isn't called
+    os.unlink(mock_podman)
+    capsys.readouterr()
+    phpc.main()
+    assert "already squashed" in capsys.readouterr().out
+    assert not os.path.exists(mock_podman)
+
+    # Forced
+    sys.argv = ["podman_hpc", "--squash-dir", sqdir, "pull", "--refresh",
+                "alpine"]
+    phpc.main()
+    assert "pull " in open(mock_podman).read()
+
+    # Older than the TTL
+    os.unlink(mock_podman)
+    sqfs = [fn for fn in os.listdir(os.path.join(sqdir, "overlay", "l"))
+            if fn.endswith(".squash")]
+    sqf = os.path.join(sqdir, "overlay", "l", sqfs[0])
+    os.utime(sqf, (0, 0))
+    monkeypatch.setenv("PODMANHPC_PULL_TTL", "3600")
+    sys.argv = ["podman_hpc", "--squash-dir", sqdir, "pull", "alpine"]
+    phpc.main()
+    assert "pull " in open(mock_podman).read()
+    assert os.path.getmtime(sqf) > 0
+
+
+def test_migrate_async(fix_paths, mock_podman, mock_exit, tmp_path, capsys,
+                       mocker):
+    popen = mocker.patch("podman_hpc.podman_hpc.Popen")
+    popen.return_value.pid = 1234
+    sys.argv = ["podman_hpc", "--squash-dir", str(tmp_path), "migrate",
+                "--async", "alpine"]
+    phpc.main()
+    assert "background (pid 1234" in capsys.readouterr().out
+    cmd = popen.call_args[0][0]
+    assert cmd[1:3] == ["-m", "podman_hpc.podman_hpc"]
+    assert cmd[-2:] == ["migrate", "alpine"]
+    assert popen.call_args[1]["start_new_session"] is True
+    assert os.path.exists(os.path.join(tmp_path, "migrations",
+                                       "alpine.log"))
+
+    mdir = os.path.join(tmp_path, "migrations")
+    with open(os.path.join(mdir, "abc.status"), "w") as f:
+        json.dump({"id": "abc", "image": "alpine", "host": "n1",
+                   "pid": 1, "state": "failed", "step": "squash",
+                   "bytes_done": 5, "bytes_total": 10, "eta": 5,
+                   "started": 0, "updated": 1e12, "error": "oops"}, f)
+    sys.argv = ["podman_hpc", "--squash-dir", str(tmp_path),
+                "migrate-status"]
+    phpc.main()
+    out = capsys.readouterr().out
+    assert "alpine" in out and "failed" in out and "50%" in out
+    assert "error: oops" in out
+
+
+def test_read_only_squash_missing(monkeypatch, fix_paths, mock_podman,
+                                  mock_exit, tmp_path, capsys):
+    test_dir = os.path.dirname(__file__)
+    modules_dir = os.path.join(test_dir, "..", "etc", "modules.d")
+    monkeypatch.setenv("PODMANHPC_MODULES_DIR", modules_dir)
+    monkeypatch.setenv("PODMANHPC_SQUASH_DIR", str(tmp_path / "squash"))
+    monkeypatch.setenv("SLURM_LOCALID", "0")
+    monkeypatch.setenv("SLURM_STEP_TASKS_PER_NODE", "1")
+    for sub in ["run", "shared-run"]:
+        sys.argv = ["podman_hpc", sub, "--read-only-squash", "ubuntu",
+                    "uptime"]
+        phpc.main()
+        err = capsys.readouterr().err
+        assert "Error: Image ubuntu is not in" in err
+        assert "Exiting" in err
+        assert "Traceback" not in err
+    # Only the help calls that filter the options ran
+    with open(mock_podman) as f:
+        assert all(line.startswith(("run --help", "exec --help"))
+                   for line in f if line.strip())
@@ -0,0 +1,75 @@
+from podman_hpc.migrate2scratch import MigrateUtils
+from podman_hpc import squash_bench
+import os
+
+
+def test_squash_bench(tmp_path, mocker):
+    tdir = os.path.dirname(__file__)
+    src = os.path.join(tdir, "storage")
+    mu = MigrateUtils(src=src, dst=os.path.join(tmp_path, "dst"))
+    mu.squash_profiles = {"a": {"compression": "lz4"},
+                          "b": {"compression": "gzip"}}
+
+    def mock_mksq(img_id, outdir, outname, options, excludes):
+        size = 1024 if "gzip" in options else 2048
+        if "usr/share/doc/*" in excludes:
+            size -= 512
+        with open(os.path.join(outdir, outname), "wb") as f:
+            f.write(b"x" * size)
+        return True
+
+    mocker.patch.object(mu, "_run_mksq", side_effect=mock_mksq)
+    mocker.patch("podman_hpc.squash_bench.read_throughput",
+                 return_value={"read_mb_per_sec": 100.0})
+    res = squash_bench.run_squash_bench(mu, "alpine", ["a", "b"],
+                                        str(tmp_path))
+    assert [r["size"] for r in res] == [2048, 1024]
+    assert not os.path.exists(os.path.join(tmp_path, "bench-a.squash"))
+    table = squash_bench.format_results(res)
+    assert "gzip" not in table
+    assert "100.0" in table
+
+
+def test_squash_bench_slim(tmp_path, mocker):
+    tdir = os.path.dirname(__file__)
+    src = os.path.join(tdir, "storage")
+    mu = MigrateUtils(src=src, dst=os.path.join(tmp_path, "dst"))
+    mu.squash_profiles = {"a": {"compression": "lz4"}}
+    mu.slim_profiles = {"docs": {"exclude": ["usr/share/doc/*"]}}
+    seen = []
+
+    def mock_mksq(img_id, outdir, outname, options, excludes):
+        seen.append(excludes)
+        size = 1536 if "usr/share/doc/*" in excludes else 2048
+        with open(os.path.join(outdir, outname), "wb") as f:
+            f.write(b"x" * size)
+        return True
+
+    mocker.patch.object(mu, "_run_mksq", side_effect=mock_mksq)
+    mocker.patch("podman_hpc.squash_bench.read_throughput",
+                 return_value={})
+    res = squash_bench.run_squash_bench(mu, "alpine", ["a"], str(tmp_path),
+                                        slims=["docs"])
+    assert [r["profile"] for r in res] == ["a", "a+docs"]
+    assert res[1]["saved"] == 512
+    assert seen[0][:2] == ["-e", "/sqout"]
+    assert seen[1][:3] == ["-wildcards", "-e", "sqout"]
+    assert "SAVED" in squash_bench.format_results(res)
+
+
+def test_read_throughput_busy(tmp_path, monkeypatch, mocker):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    fm = bindir / "fusermount"
+    fm.write_text("#!/bin/sh\necho busy >&2\nexit 1\n")
+    fm.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bindir), prepend=os.pathsep)
+    mocker.patch("podman_hpc.squash_bench.os.path.ismount",
+                 return_value=True)
+    mocker.patch("podman_hpc.squash_bench.time.sleep")
+    mnt = tmp_path / "mnt"
+    res = squash_bench.read_throughput("x.squash", str(mnt),
+                                       squashfuse_bin="true")
+    assert res["read_bytes"] == 0
+    # The busy mount point is left alone
+    assert mnt.is_dir()
@@ -0,0 +1,85 @@
+from podman_hpc.squash_index import build_index, write_index, read_index
+from podman_hpc.squash_index import index_paths, index_filename
+from podman_hpc.squash_index import glob_regex, find_files, diff_indexes
+from podman_hpc.squash_index import image_index
+from podman_hpc.migrate2scratch import ImageStore
+import os
+import stat
+import shutil
+import pytest
+
+
+def _tree(root, files):
+    for pth, data in files.items():
+        fn = os.path.join(root, pth)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, "w") as f:
+            f.write(data)
+    return root
+
+
+@pytest.fixture
+def store(tmp_path):
+    tdir = os.path.dirname(__file__)
+    sdir = os.path.join(tmp_path, "storage")
+    shutil.copytree(os.path.join(tdir, "storage"), sdir, symlinks=True)
+    return ImageStore(sdir)
+
+
+def test_index_roundtrip(tmp_path):
+    root = _tree(os.path.join(tmp_path, "root"), {
+        "etc/hosts": "localhost",
+        "usr/lib/libfoo.so.1": "foo",
+    })
+    os.symlink("libfoo.so.1", os.path.join(root, "usr/lib/libfoo.so"))
+    cols = build_index(root, attrs={"etc/hosts": (0o600, 0, 0)})
+    fn = os.path.join(tmp_path, "idx")
+    write_index(fn, cols)
+
+    res = read_index(fn, ["paths"])
+    assert list(res) == ["paths", "count"]
+    assert index_paths(res["paths"]) == [
+        "etc", "etc/hosts", "usr", "usr/lib", "usr/lib/libfoo.so",
+        "usr/lib/libfoo.so.1"]
+    res = read_index(fn)
+    assert res["count"] == 6
+    assert res["sizes"][1] == len("localhost")
+    assert stat.S_IMODE(res["modes"][1]) == 0o600
+    assert stat.S_ISLNK(res["modes"][4])
+    assert res["hashes"][4] == b"\0" * 8
+    assert res["hashes"][1] != res["hashes"][5]
+
+
+def test_glob_regex():
+    paths = b"etc\netc/hosts\nusr/lib/libfoo.so\nusr/lib/libfoo.so.1"
+
+    def match(pattern):
+        return [m.group(0) for m in glob_regex(pattern).finditer(paths)]
+
+    assert match("libfoo.so*") == [b"usr/lib/libfoo.so",
+                                   b"usr/lib/libfoo.so.1"]
+    assert match("hosts") == [b"etc/hosts"]
+    assert match("/usr/*") == [b"usr/lib/libfoo.so", b"usr/lib/libfoo.so.1"]
+    assert match("libfoo.so.[0-9]") == [b"usr/lib/libfoo.so.1"]
+    assert match("e?c") == [b"etc"]
+
+
+def test_find_and_diff(tmp_path, store):
+    old = _tree(os.path.join(tmp_path, "old"), {
+        "etc/hosts": "localhost", "etc/gone": "x", "bin/sh": "sh"})
+    new = _tree(os.path.join(tmp_path, "new"), {
+        "etc/hosts": "127.0.0.1", "etc/added": "y", "bin/sh": "sh"})
+    sqf = store.get_squash_filename("ZV7QWNQETS5AJXTGA6EY2FM2WE")
+    write_index(index_filename(sqf), build_index(old))
+    assert image_index(store, "alpine") == index_filename(sqf)
+    assert find_files(store, "hosts") == [
+        ("docker.io/library/alpine:latest", "/etc/hosts")]
+    assert find_files(store, "nothing*") == []
+
+    new_idx = os.path.join(tmp_path, "new.idx")
+    write_index(new_idx, build_index(new))
+    assert diff_indexes(index_filename(sqf), new_idx) == [
+        ("A", "etc/added"), ("D", "etc/gone"), ("M", "etc/hosts")]
+
+    with pytest.raises(ValueError):
+        image_index(store, "ubuntu")
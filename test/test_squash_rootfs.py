@@ -0,0 +1,70 @@
+from podman_hpc.squash_rootfs import SquashRootfs
+import os
+import shutil
+import pytest
+
+
+class mockconf():
+    squashfuse_bin = "squashfuse"
+
+    def __init__(self, squash_dir, run_root):
+        self.squash_dir = squash_dir
+        self.run_root = run_root
+
+
+class mockproc():
+    returncode = 0
+
+    def communicate(self):
+        return b"", b""
+
+
+@pytest.fixture
+def conf(tmp_path):
+    tdir = os.path.dirname(__file__)
+    sdir = os.path.join(tmp_path, "storage")
+    shutil.copytree(os.path.join(tdir, "storage"), sdir, symlinks=True)
+    sq = os.path.join(sdir, "overlay", "l", "ZV7QWNQETS5AJXTGA6EY2FM2WE")
+    shutil.copy(f"{sq}.squash.bk", f"{sq}.squash")
+    return mockconf(sdir, os.path.join(tmp_path, "run"))
+
+
+def test_run_args(conf):
+    sr = SquashRootfs(conf, "alpine")
+    args = sr.run_args(["-e", "A=1"])
+    assert args[:2] == ["--env", "PATH=/usr/local/sbin:/usr/local/bin:"
+                        "/usr/sbin:/usr/bin:/sbin:/bin"]
+    assert args.index("A=1") < args.index("--rootfs")
+    assert "--read-only" in args
+    assert args[-1] == sr.mount_dir
+    assert sr.command([], []) == ["/bin/sh"]
+    assert sr.command([], ["uptime"]) == ["uptime"]
+
+
+def test_entrypoint(conf, monkeypatch):
+    sr = SquashRootfs(conf, "alpine")
+    monkeypatch.setattr(sr, "get_config", lambda: {
+        "Entrypoint": ["/entry.sh"], "Cmd": ["serve"]})
+    assert sr.command([], []) == ["/entry.sh", "serve"]
+    # The user's entrypoint replaces the image's in either form
+    assert sr.command(["--entrypoint", "/bin/sh"], ["-c", "x"]) == \
+        ["-c", "x"]
+    assert sr.command(["--entrypoint=/bin/sh"], ["-c", "x"]) == ["-c", "x"]
+
+
+def test_missing_image(conf):
+    with pytest.raises(OSError):
+        SquashRootfs(conf, "ubuntu")
+
+
+def test_mount_release(conf, mocker):
+    popen = mocker.patch("podman_hpc.squash_rootfs.Popen")
+    popen.return_value = mockproc()
+    mounted = mocker.patch("os.path.ismount")
+    mounted.side_effect = [False, True, True]
+    sr = SquashRootfs(conf, "alpine")
+    assert sr.mount() == sr.mount_dir
+    assert popen.call_args[0][0] == ["squashfuse", sr.squash_file,
+                                     sr.mount_dir]
+    sr.release()
+    assert popen.call_args[0][0] == ["fusermount", "-u", sr.mount_dir]
@@ -0,0 +1,54 @@
+from podman_hpc.squash_verify import SquashVerifier, file_checksum
+from podman_hpc.squash_verify import format_results
+from podman_hpc.migrate2scratch import ImageStore, write_checksum
+import podman_hpc.squash_verify as sv
+import os
+import shutil
+import pytest
+
+
+@pytest.fixture
+def store(tmp_path):
+    tdir = os.path.dirname(__file__)
+    sdir = os.path.join(tmp_path, "storage")
+    shutil.copytree(os.path.join(tdir, "storage"), sdir, symlinks=True)
+    sq = os.path.join(sdir, "overlay", "l", "ZV7QWNQETS5AJXTGA6EY2FM2WE")
+    shutil.copy(f"{sq}.squash.bk", f"{sq}.squash")
+    return ImageStore(sdir)
+
+
+def test_verify(store, mocker):
+    sqf = store.get_squash_filename("ZV7QWNQETS5AJXTGA6EY2FM2WE")
+    res = SquashVerifier(store).verify_images()
+    assert res[0]["result"] == "unverified"
+
+    write_checksum(sqf, file_checksum(sqf), os.path.getsize(sqf))
+    res = SquashVerifier(store).verify_images(["alpine"])
+    assert res[0]["result"] == "ok"
+    assert res[0]["cached"] is False
+
+    # The second run comes from the cache
+    spy = mocker.spy(sv, "file_checksum")
+    res = SquashVerifier(store).verify_images()
+    assert res[0]["result"] == "ok"
+    assert res[0]["cached"] is True
+    spy.assert_not_called()
+    res = SquashVerifier(store, use_cache=False).verify_images()
+    assert spy.call_count == 1
+
+    # Same size, different content
+    with open(sqf, "r+b") as f:
+        f.seek(200)
+        f.write(b"garbage")
+    res = SquashVerifier(store).verify_images()
+    assert res[0]["result"] == "corrupt"
+
+    with open(sqf, "r+b") as f:
+        f.truncate(1000)
+    assert SquashVerifier(store).verify_images()[0]["result"] == "truncated"
+    os.unlink(sqf)
+    assert SquashVerifier(store).verify_images()[0]["result"] == "missing"
+
+    res = SquashVerifier(store).verify_images(["ubuntu"])
+    assert res[0]["result"] == "not found"
+    assert "not found" in format_results(res)
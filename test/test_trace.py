@@ -0,0 +1,63 @@
+from podman_hpc.trace import Tracer, merge_traces, default_trace_id
+import os
+import json
+
+
+def test_trace_ids():
+    env = {"SLURM_JOB_ID": "123", "SLURM_STEP_ID": "4"}
+    assert default_trace_id(env) == "123.4"
+    assert default_trace_id({"PBS_JOBID": "9.pbs"}) == "9.pbs"
+
+
+def test_tracer_disabled(tmp_path):
+    tracer = Tracer("podman-hpc", {})
+    assert not tracer.enabled
+    assert tracer.env() == {}
+    with tracer.span("config"):
+        pass
+    tracer.close()
+    assert tracer.events == []
+
+
+def test_trace_merge(tmp_path):
+    tdir = os.path.join(tmp_path, "trace")
+    for rank in ["10", "2"]:
+        env = {"PODMANHPC_TRACE": tdir, "SLURM_JOB_ID": "123",
+               "SLURM_STEP_ID": "0", "SLURM_PROCID": rank}
+        tracer = Tracer("podman-hpc", env, root="podman-hpc shared-run")
+        with tracer.span("wait-exists", polls=0) as span:
+            span["polls"] += 2
+        # The hook gets the trace settings through the container env
+        hook = Tracer("hook", tracer.env())
+        assert hook.trace_id == "123.0"
+        assert hook.rank == rank
+        hook.add("actions", tracer.start, tracer.start + 0.01)
+        hook.close()
+        tracer.close()
+        tracer.close()
+    # Another launch in the same directory
+    other = Tracer("podman-hpc", {"PODMANHPC_TRACE": tdir,
+                                  "PODMANHPC_TRACE_ID": "other"})
+    other.add("config", other.start)
+    other.close()
+    with open(os.path.join(tdir, "123.0.bad.jsonl"), "w") as f:
+        f.write("{not json\n")
+
+    trace = merge_traces(tdir, "123.0")
+    events = trace["traceEvents"]
+    names = {ev["args"]["name"]: ev["pid"] for ev in events
+             if ev["name"] == "process_name"}
+    host = os.uname()[1]
+    # Ranks in numeric order
+    assert names == {f"{host} rank 2": 1, f"{host} rank 10": 2}
+    spans = [ev for ev in events if ev["ph"] == "X"]
+    assert len(spans) == 6
+    assert min(ev["ts"] for ev in spans) == 0
+    wait = [ev for ev in spans if ev["name"] == "wait-exists"]
+    assert [ev["args"]["polls"] for ev in wait] == [2, 2]
+    hook = [ev for ev in spans if ev["cat"] == "hook"]
+    assert {ev["tid"] for ev in hook} == {3}
+    assert trace["otherData"]["trace_ids"] == ["123.0"]
+    json.dumps(trace)
+
+    assert len(merge_traces(tdir)["otherData"]["trace_ids"]) == 2
@@ -6,6 +6,7 @@ import os
 import json
 import ctypes
 import time
+import threading
 import pytest
 
 
@@ -88,3 +89,348 @@ def test_conf_hook(monkeypatch, tmp_path, capsys):
     assert "Successfully" in captured.out
     ho = json.load(open(hook_out))
     assert "version" in ho
+
+
+def test_bind_mount(monkeypatch, tmp_path):
+    src = os.path.join(tmp_path, "src")
+    tgt = os.path.join(tmp_path, "root", "tgt")
+    os.makedirs(os.path.dirname(tgt))
+    open(src, "w").close()
+    calls = []
+
+    def mock_mount(*args):
+        calls.append(("mount", args))
+
+    def mock_check_output(com):
+        calls.append(("binary", com))
+
+    monkeypatch.setattr(ht, "mount", mock_mount)
+    monkeypatch.setattr(ht.subprocess, "check_output", mock_check_output)
+    ht.bind_mount(src, tgt)
+    assert os.path.exists(tgt)
+    assert calls == [("mount", (src, tgt, None, ht.MS_BIND | ht.MS_REC))]
+
+    # Fall back to the mount binary if mount(2) fails
+    def mock_fail(*args):
+        raise OSError(1, "Operation not permitted", args[1])
+
+    calls.clear()
+    monkeypatch.setattr(ht, "mount", mock_fail)
+    ht.bind_mount(src, tgt)
+    assert calls == [("binary", ["mount", "--rbind", src, tgt])]
+
+
+def test_ro_bind_mount(monkeypatch, tmp_path):
+    src = os.path.join(tmp_path, "src")
+    tgt = os.path.join(tmp_path, "tgt")
+    os.makedirs(src)
+    calls = []
+
+    class statvfs:
+        f_flag = os.ST_NOSUID | os.ST_NODEV | os.ST_RELATIME
+
+    def mock_mount(*args):
+        calls.append(("mount", args))
+
+    def mock_check_output(com, **kwargs):
+        calls.append(("binary", com))
+        raise ht.subprocess.CalledProcessError(32, com, b"denied")
+
+    monkeypatch.setattr(ht, "mount", mock_mount)
+    monkeypatch.setattr(ht.os, "statvfs", lambda pth: statvfs)
+    monkeypatch.setattr(ht.subprocess, "check_output", mock_check_output)
+    ht.ro_bind_mount(src, tgt)
+    # The remount keeps the locked flags of the bind
+    flags = ht.MS_BIND | ht.MS_REMOUNT | ht.MS_RDONLY | ht.MS_NOSUID | \
+        ht.MS_NODEV | ht.MS_RELATIME
+    assert calls[1] == ("mount", (None, tgt, None, flags))
+
+    # A failing mount binary is reported as an OSError
+    def mock_fail(*args):
+        if args[0] is None:
+            raise OSError(1, "Operation not permitted", args[1])
+
+    calls.clear()
+    monkeypatch.setattr(ht, "mount", mock_fail)
+    with pytest.raises(OSError):
+        ht.ro_bind_mount(src, tgt)
+    assert calls[-1] == ("binary", [
+        "mount", "-o", "remount,bind,ro,nosuid,nodev,relatime", tgt])
+
+
+def test_mount_error(tmp_path):
+    with pytest.raises(OSError) as ex:
+        ht.mount(os.path.join(tmp_path, "missing"), str(tmp_path), None,
+                 ht.MS_BIND)
+    assert ex.value.filename == str(tmp_path)
+
+
+def test_plan_cache(monkeypatch, tmp_path):
+    mdir = os.path.join(tmp_path, "modules.d")
+    libs = os.path.join(tmp_path, "libs")
+    os.mkdir(mdir)
+    os.mkdir(libs)
+    open(os.path.join(libs, "liba.so"), "w").close()
+    mod = os.path.join(mdir, "test.yaml")
+    with open(mod, "w") as f:
+        f.write(f"name: test\nenv: ENABLE_TEST\nbind:\n"
+                f"  - {libs}/lib*:/opt/lib/\n")
+    cache = os.path.join(tmp_path, "cache")
+    env = {"ENABLE_TEST": "1"}
+
+    plan = ht.get_plan(env, mdir, cache)
+    assert plan["actions"] == [["test", "bind", f"{libs}/liba.so",
+                                "/opt/lib/liba.so",
+                                ["bind[0]", f"{libs}/lib*"]]]
+    assert libs in plan["deps"]
+    assert ht.get_plan({}, mdir, cache)["actions"] == []
+
+    # A warm cache doesn't read the modules
+    def fail(mdir):
+        raise AssertionError("modules were read")
+
+    monkeypatch.setattr(ht, "read_confs", fail)
+    assert ht.get_plan(env, mdir, cache) == plan
+    monkeypatch.undo()
+
+    # New files on the host invalidate the plan
+    open(os.path.join(libs, "libb.so"), "w").close()
+    os.utime(libs, ns=(0, 1))
+    plan = ht.get_plan(env, mdir, cache)
+    assert len(plan["actions"]) == 2
+
+    # So does changing a module
+    motd = os.path.join(tmp_path, "motd")
+    open(motd, "w").close()
+    with open(mod, "a") as f:
+        f.write(f"copy:\n  - {motd}:/etc/\n")
+    os.utime(mod, ns=(0, 2))
+    plan = ht.get_plan(env, mdir, cache)
+    assert plan["actions"][0][1:] == ["copy", motd, "/etc/motd",
+                                      ["copy[0]", motd]]
+
+    # Replay into a container root
+    calls = []
+    monkeypatch.setitem(ht._ACTIONS, "copy",
+                        lambda src, tgt: calls.append(tgt))
+    monkeypatch.setitem(ht._ACTIONS, "bind",
+                        lambda src, tgt: calls.append(tgt))
+    rp = os.path.join(tmp_path, "root")
+    ht.run_plan(rp, plan)
+    assert calls == [f"{rp}/etc/motd", f"{rp}/opt/lib/liba.so",
+                     f"{rp}/opt/lib/libb.so"]
+    assert os.path.isdir(os.path.join(rp, "opt", "lib"))
+
+
+def test_assemble_module(monkeypatch, tmp_path):
+    mdir = os.path.join(tmp_path, "modules.d")
+    libs = os.path.join(tmp_path, "libs")
+    os.mkdir(mdir)
+    os.makedirs(os.path.join(libs, "sub"))
+    for lib in ["liba.so", "libb.so", "other.so", "motd"]:
+        with open(os.path.join(libs, lib), "w") as f:
+            f.write(lib)
+    with open(os.path.join(mdir, "test.yaml"), "w") as f:
+        f.write(f"name: test\nenv: ENABLE_TEST\nassemble: true\nbind:\n"
+                f"  - {libs}/lib*:/usr/lib64/\n"
+                f"  - {libs}/sub:/opt/sub\n"
+                f"  - {libs}/liba.so:/opt/test/lib/liba.so\n"
+                f"copy:\n"
+                f"  - {libs}/motd:/etc/motd\n")
+    cache = os.path.join(tmp_path, "cache")
+    plan = ht.get_plan({"ENABLE_TEST": "1"}, mdir, cache)
+    stage = plan["actions"][0][2]
+    assert os.path.dirname(stage) == os.path.join(cache, "assembled")
+    # Only the selected files are staged
+    staged = sorted(os.path.relpath(os.path.join(d, f), stage)
+                    for d, _, files in os.walk(stage) for f in files)
+    assert staged == ["etc/motd", "opt/test/lib/liba.so",
+                      "usr/lib64/liba.so", "usr/lib64/libb.so"]
+    host = "/opt/udiImage/host/test"
+    rule = ["assemble", stage]
+    assert plan["actions"] == [
+        ["test", "robind", stage, host, rule],
+        ["test", "link_tree", f"{host}/etc", "/etc", rule,
+         [["motd", "copy", f"{libs}/motd"]]],
+        ["test", "link_tree", f"{host}/opt/test/lib", "/opt/test/lib", rule,
+         [["liba.so", "bind", f"{libs}/liba.so"]]],
+        ["test", "link_tree", f"{host}/usr/lib64", "/usr/lib64", rule,
+         [["liba.so", "bind", f"{libs}/liba.so"],
+          ["libb.so", "bind", f"{libs}/libb.so"]]],
+        ["test", "bind", f"{libs}/sub", "/opt/sub",
+         ["bind[1]", f"{libs}/sub"]],
+    ]
+    # The staging directory is reused by the next plan
+    assert ht.build_plan(ht.read_confs(mdir), ["test"], mdir,
+                         cache)["actions"] == plan["actions"]
+    assert os.listdir(os.path.join(cache, "assembled")) == \
+        [os.path.basename(stage)]
+
+    binds = []
+    monkeypatch.setitem(ht._ACTIONS, "bind",
+                        lambda src, tgt: binds.append((src, tgt)))
+    monkeypatch.setitem(ht._ACTIONS, "robind",
+                        lambda src, tgt: binds.append((src, tgt)))
+    rp = os.path.join(tmp_path, "root")
+    os.makedirs(os.path.join(rp, "usr", "lib64", "libb.so"))
+    os.makedirs(os.path.join(rp, "etc"))
+    ht.run_plan(rp, plan)
+    # An existing directory gets a link per file, a new one a single link
+    assert os.readlink(os.path.join(rp, "usr/lib64/liba.so")) == \
+        f"{host}/usr/lib64/liba.so"
+    assert os.readlink(os.path.join(rp, "etc/motd")) == f"{host}/etc/motd"
+    assert os.readlink(os.path.join(rp, "opt/test/lib")) == \
+        f"{host}/opt/test/lib"
+    # A directory in the way falls back to a bind mount
+    assert binds == [(stage, f"{rp}{host}"),
+                     (f"{libs}/libb.so", f"{rp}/usr/lib64/libb.so"),
+                     (f"{libs}/sub", f"{rp}/opt/sub")]
+
+    # Without a cache directory nothing is assembled
+    plan = ht.get_plan({"ENABLE_TEST": "1"}, mdir)
+    assert [act[1] for act in plan["actions"]] == \
+        ["copy", "bind", "bind", "bind", "bind"]
+
+    # Files that can't be hardlinked keep their bind, copies are copied
+    def no_link(src, tgt):
+        raise OSError(18, "Invalid cross-device link", src)
+
+    monkeypatch.setattr(ht.os, "link", no_link)
+    cache = os.path.join(tmp_path, "cache2")
+    plan = ht.get_plan({"ENABLE_TEST": "1"}, mdir, cache)
+    stage = plan["actions"][0][2]
+    assert [(act[1], act[3]) for act in plan["actions"]] == [
+        ("robind", host), ("link_tree", "/etc"),
+        ("bind", "/usr/lib64/liba.so"), ("bind", "/usr/lib64/libb.so"),
+        ("bind", "/opt/sub"), ("bind", "/opt/test/lib/liba.so")]
+    assert os.listdir(os.path.join(stage, "etc")) == ["motd"]
+
+
+def test_ldcache(tmp_path):
+    # <graph root>/overlay-containers/<id>/userdata
+    bundle = os.path.join(tmp_path, "overlay-containers", "c1", "userdata")
+    os.makedirs(bundle)
+    with open(os.path.join(tmp_path, "overlay-containers",
+                           "containers.json"), "w") as f:
+        json.dump([{"id": "c1", "image": "img1"}], f)
+    assert ht.image_id("c1", bundle) == "img1"
+    assert ht.image_id("c2", bundle) is None
+
+    rp = os.path.join(tmp_path, "root")
+    os.makedirs(os.path.join(rp, "etc", "ld.so.conf.d"))
+    src = os.path.join(tmp_path, "libfoo.so")
+    open(src, "w").close()
+    plan = {"actions": [["gpu", "bind", src, "/usr/lib64/libfoo.so"]],
+            "deps": {}}
+    key = ht.ldcache_key("img1", plan, rp)
+    assert ht.ldcache_key("img2", plan, rp) != key
+    with open(os.path.join(rp, "etc", "ld.so.conf.d", "gpu.conf"), "w") as f:
+        f.write("/opt/gpu\n")
+    assert ht.ldcache_key("img1", plan, rp) != key
+    key = ht.ldcache_key("img1", plan, rp)
+
+    cache = os.path.join(tmp_path, "cache")
+    assert not ht.install_ldcache(cache, key, rp)
+    generated = os.path.join(rp, "etc", "ld.so.cache")
+    with open(generated, "w") as f:
+        f.write("ld cache")
+    dir_fd = ht.open_ldcache_dir(cache)
+    ht.save_ldcache(dir_fd, key, generated)
+    os.close(dir_fd)
+    assert os.listdir(os.path.join(cache, "ld.so.cache")) == [key]
+
+    rp2 = os.path.join(tmp_path, "root2")
+    os.makedirs(os.path.join(rp2, "etc"))
+    assert ht.install_ldcache(cache, key, rp2)
+    assert open(os.path.join(rp2, "etc", "ld.so.cache")).read() == \
+        "ld cache"
+    assert os.listdir(os.path.join(rp2, "etc")) == ["ld.so.cache"]
+
+
+def test_run_plan_parallel(monkeypatch, tmp_path):
+    actions = [
+        ["a", "copy", "/src/etc", "/etc/a"],
+        ["b", "bind", "/src/lib", "/usr/lib64/libb.so"],
+        ["a", "bind", "/src/conf", "/etc/a/conf"],
+        ["c", "bind", "/src/c", "/opt/c"],
+        ["d", "copy", "/src/etc2", "/etc"],
+        ["e", "bind", "/src/lib", "/usr/lib64/libb.so"],
+    ]
+    # Nested and repeated destinations are ordered, the rest independent
+    assert ht.group_actions(actions) == [[0, 2, 4], [1, 5], [3]]
+
+    calls = []
+    lock = threading.Lock()
+
+    def act(src, tgt):
+        if src == "/src/c":
+            time.sleep(0.05)
+        with lock:
+            calls.append(src)
+        if src == "/src/conf":
+            raise OSError(13, "Permission denied", tgt)
+
+    monkeypatch.setitem(ht._ACTIONS, "copy", act)
+    monkeypatch.setitem(ht._ACTIONS, "bind", act)
+    logger = io.StringIO()
+    monkeypatch.setattr(ht, "logger", logger)
+    rp = os.path.join(tmp_path, "root")
+    plan = {"actions": actions, "deps": {}}
+    with pytest.raises(OSError):
+        ht.run_plan(rp, plan, jobs=4)
+    # The group stops at the failure, other groups finish
+    assert "/src/etc2" not in calls
+    assert sorted(calls) == ["/src/c", "/src/conf", "/src/etc",
+                             "/src/lib", "/src/lib"]
+    assert calls.index("/src/etc") < calls.index("/src/conf")
+    # Logs are in plan order
+    assert [line.split()[1] for line in
+            logger.getvalue().splitlines()] == \
+        ["/src/etc", "/src/lib", "/src/conf", "/src/c", "/src/lib"]
+
+
+def test_timing(monkeypatch, tmp_path):
+    src = os.path.join(tmp_path, "motd")
+    with open(src, "w") as f:
+        f.write("x" * 100)
+    plan = {"modules": ["a"], "deps": {}, "actions": [
+        ["a", "copy", src, "/etc/motd", ["copy[0]", src]],
+        ["a", "copy", src, "/etc/motd2", ["copy[1]", src]],
+        ["a", "bind", src, "/etc/motd3", ["bind[0]", src]],
+        ["a", "bind", src, "/etc/motd4", ["bind[0]", src]],
+    ]}
+    stats = [None] * 4
+    rp = os.path.join(tmp_path, "root")
+
+    def fail(src, tgt):
+        raise OSError(1, "Operation not permitted", tgt)
+
+    monkeypatch.setitem(ht._ACTIONS, "bind", fail)
+    with pytest.raises(OSError):
+        ht.run_plan(rp, plan, stats=stats)
+    # The copies are counted, the failed bind mount isn't
+    assert [st[1] for st in stats[:2]] == [100, 100]
+    assert stats[2] is None
+    # Each rule gets its own record
+    stats = [(0.5, 100), (0.25, 100), (0.125, 0), (0.125, 0)]
+    recs = ht.rule_records(plan, stats)
+    assert recs == [
+        {"kind": "rule", "name": "a:copy[0]", "module": "a",
+         "action": "copy", "rule": "copy[0]", "pattern": src, "srcs": 1,
+         "bytes": 100, "duration": 0.5},
+        {"kind": "rule", "name": "a:copy[1]", "module": "a",
+         "action": "copy", "rule": "copy[1]", "pattern": src, "srcs": 1,
+         "bytes": 100, "duration": 0.25},
+        {"kind": "rule", "name": "a:bind[0]", "module": "a",
+         "action": "bind", "rule": "bind[0]", "pattern": src, "srcs": 2,
+         "bytes": 0, "duration": 0.25},
+    ]
+
+    fn = os.path.join(tmp_path, "timing", "hook.jsonl")
+    for cid in ["c1", "c2"]:
+        fd = ht.open_timing(fn)
+        ht.write_timing(fd, recs, container=cid)
+    with open(fn) as f:
+        lines = [json.loads(line) for line in f]
+    assert [r["container"] for r in lines] == ["c1"] * 3 + ["c2"] * 3
+    assert lines[3]["name"] == "a:copy[0]"